@@ -0,0 +1,212 @@
+import json
+import os
+import sys
+import time
+
+import numpy
+
+from BusquedaKNN import agrupar_caracteristicas
+from Etiquetas import Etiquetas
+from Indices import Exacto, Index, KDTree, KMeansTree, muestra_busquedas, recall
+
+# clases de índice que se pueden ajustar, por nombre del algoritmo de FLANN
+CLASES = {'kdtree': KDTree, 'kmeans': KMeansTree}
+
+# configuraciones candidatas: (algoritmo, parámetros de construcción), de más barata a más cara de construir
+CANDIDATOS = [
+    *[('kdtree', {'trees': trees}) for trees in (1, 4, 8, 16)],
+    *[('kmeans', {'branching': branching}) for branching in (16, 32, 64)],
+]
+
+# checks a probar con cada índice construido, de menor a mayor
+CHECKS = (16, 32, 64, 128, 256, 512, 1024, 2048)
+
+ARCHIVO_PERFIL = 'perfil_indice.json'
+
+
+class Perfil:
+    """
+    Configuración de índice elegida para un corpus: algoritmo, parámetros de construcción y checks, junto al recall y
+    velocidad medidos. Se guarda en la carpeta de características del corpus, asociada a la huella de sus etiquetas.
+    """
+
+    def __init__(self, algoritmo: str, parametros: dict, checks: int, k: int, recall_objetivo: float,
+                 recall: float, busquedas_segundo: float, etiquetas: str = ''):
+        """
+        :param algoritmo: 'kdtree' o 'kmeans'.
+        :param parametros: parámetros de construcción del índice (trees o branching).
+        :param checks: número de checks a usar en las búsquedas.
+        :param k: número de vecinos con el que se midió el recall.
+        :param recall_objetivo: recall@k pedido al ajustar.
+        :param recall: recall@k medido con esta configuración.
+        :param busquedas_segundo: búsquedas por segundo medidas con esta configuración.
+        :param etiquetas: huella de la tabla de etiquetas del corpus sobre el que se ajustó.
+        """
+        self.algoritmo = algoritmo
+        self.parametros = parametros
+        self.checks = checks
+        self.k = k
+        self.recall_objetivo = recall_objetivo
+        self.recall = recall
+        self.busquedas_segundo = busquedas_segundo
+        self.etiquetas = etiquetas
+
+    def __repr__(self):
+        return (f'{self.algoritmo} {self.parametros} checks={self.checks}: recall@{self.k} {self.recall:.3f}, '
+                f'{self.busquedas_segundo:.0f} búsquedas/s')
+
+    def construir(self, datos: numpy.ndarray, etiquetas: Etiquetas, cores: int = 1, cache: str = None) -> Index:
+        """
+        :return: el índice de esta configuración construido (o recargado desde cache) sobre los datos.
+        """
+        return CLASES[self.algoritmo](datos, etiquetas, cores=cores, cache=cache, **self.parametros)
+
+    @staticmethod
+    def archivo(carpeta: str) -> str:
+        return f'{carpeta}/{ARCHIVO_PERFIL}'
+
+    def guardar(self, carpeta: str):
+        """
+        Guarda el perfil en la carpeta del corpus, junto a los perfiles de otras tablas de etiquetas (por ejemplo con
+        los tramos colapsados).
+        """
+        perfiles = _leer_perfiles(carpeta)
+        perfiles[self.etiquetas] = dict(vars(self), fecha=time.strftime('%Y-%m-%dT%H:%M:%S'))
+
+        if not os.path.isdir(carpeta):
+            os.makedirs(carpeta, exist_ok=True)
+
+        with open(Perfil.archivo(carpeta), 'w') as salida:
+            json.dump(perfiles, salida, indent=2)
+
+    @staticmethod
+    def cargar(carpeta: str, etiquetas: Etiquetas) -> 'Perfil':
+        """
+        :return: el perfil guardado en la carpeta del corpus para esta tabla de etiquetas, o None si no hay uno.
+        """
+        perfil = _leer_perfiles(carpeta).get(etiquetas.huella())
+        if perfil is None:
+            return None
+
+        perfil.pop('fecha', None)
+        return Perfil(**perfil)
+
+
+def _leer_perfiles(carpeta: str) -> dict:
+    if not os.path.isfile(Perfil.archivo(carpeta)):
+        return {}
+
+    with open(Perfil.archivo(carpeta), 'r') as archivo:
+        return json.load(archivo)
+
+
+def ajustar_indice(datos: numpy.ndarray, etiquetas: Etiquetas, recall_objetivo: float = 0.95,
+                   tiempo_max: float = 600, k: int = 20, n_busquedas: int = 1000, ruido: float = 4.0,
+                   cores: int = 0, candidatos=None, checks=CHECKS) -> Perfil:
+    """
+    Busca la configuración de índice más rápida que alcanza el recall@k objetivo. Las búsquedas son una muestra de
+    frames del corpus con ruido gaussiano, y el recall se mide contra la búsqueda exacta. Los frames de la muestra se
+    sacan de los datos con que se construyen los índices, para que las búsquedas no encuentren su propio frame, como
+    al buscar un video que no está en el corpus.
+
+    Construye los candidatos de más barato a más caro y prueba cada uno con checks crecientes, deteniéndose en el
+    primer valor que alcanza el objetivo (más checks solo sería más lento). Si se acaba el tiempo, no se construyen
+    más candidatos. Si ninguno alcanza el objetivo, se elige el de mayor recall.
+
+    :param datos: las características del corpus.
+    :param etiquetas: las etiquetas del corpus.
+    :param recall_objetivo: recall@k mínimo, entre 0 y 1.
+    :param tiempo_max: segundos máximos para el ajuste.
+    :param k: el número de vecinos a buscar.
+    :param n_busquedas: número de búsquedas de la muestra.
+    :param ruido: desviación estándar del ruido agregado a las búsquedas.
+    :param cores: núcleos a usar en las búsquedas (0 usa todos los disponibles), como al buscar los clips.
+    :param candidatos: lista de (algoritmo, parámetros), por defecto CANDIDATOS.
+    :param checks: valores de checks a probar, de menor a mayor.
+
+    :return: el perfil elegido.
+    """
+    if candidatos is None:
+        candidatos = CANDIDATOS
+
+    if datos.shape[0] <= k:
+        raise Exception(f'el corpus tiene {datos.shape[0]} frames, se necesitan más de {k} para ajustar el índice')
+
+    inicio = time.time()
+    busquedas, filas = muestra_busquedas(datos, min(n_busquedas, datos.shape[0] - k), ruido=ruido,
+                                         devolver_filas=True)
+
+    # construir los índices sin los frames de la muestra
+    restantes = numpy.ones(datos.shape[0], dtype=bool)
+    restantes[filas] = False
+    datos = numpy.ascontiguousarray(datos[restantes])
+    huella_etiquetas = etiquetas.huella()
+    etiquetas = Etiquetas(etiquetas.tabla[restantes], etiquetas.nombres)
+
+    exactos = Exacto(datos, etiquetas).search(busquedas, k=k)
+
+    mejor = None
+    for algoritmo, parametros in candidatos:
+        if time.time() - inicio > tiempo_max:
+            print(f'se acabó el tiempo de ajuste ({tiempo_max:.0f} segundos), no se prueban más candidatos')
+            break
+
+        indice = CLASES[algoritmo](datos, etiquetas, cores=cores, **parametros)
+        print(f'{algoritmo} {parametros}: construcción {indice.build_time:.1f} segundos')
+
+        for c in checks:
+            t0 = time.time()
+            encontrados = indice.search(busquedas, k=k, checks=c)
+            t1 = time.time()
+
+            perfil = Perfil(algoritmo, parametros, c, k, recall_objetivo, recall(encontrados, exactos),
+                            busquedas.shape[0] / max(t1 - t0, 1e-9), etiquetas=huella_etiquetas)
+            print(f'  {perfil}')
+
+            if _mejor(perfil, mejor):
+                mejor = perfil
+
+            if perfil.recall >= recall_objetivo or time.time() - inicio > tiempo_max:
+                break
+
+    if mejor is None:
+        raise Exception('no se alcanzó a probar ninguna configuración')
+
+    if mejor.recall < recall_objetivo:
+        print(f'ninguna configuración alcanzó recall@{k} {recall_objetivo}, se usa la de mayor recall')
+
+    return mejor
+
+
+def _mejor(perfil: Perfil, actual: Perfil) -> bool:
+    # primero alcanzar el objetivo, luego lo más rápido; sin objetivo alcanzado, el mayor recall
+    if actual is None:
+        return True
+
+    cumple, cumple_actual = perfil.recall >= perfil.recall_objetivo, actual.recall >= actual.recall_objetivo
+    if cumple != cumple_actual:
+        return cumple
+    if cumple:
+        return perfil.busquedas_segundo > actual.busquedas_segundo
+    return perfil.recall > actual.recall
+
+
+def main(carpeta: str, recall_objetivo: float = 0.95, tiempo_max: float = 600, tamano=(10, 10)):
+    """
+    Ajusta el índice del corpus de la carpeta y guarda el perfil en ella.
+    """
+    etiquetas, caracteristicas = agrupar_caracteristicas(carpeta, recargar=True, tamano=tamano)
+
+    perfil = ajustar_indice(caracteristicas, etiquetas, recall_objetivo=recall_objetivo, tiempo_max=tiempo_max)
+    perfil.guardar(carpeta)
+    print(f'perfil elegido: {perfil}, guardado en {Perfil.archivo(carpeta)}')
+
+
+if __name__ == '__main__':
+    # python Ajuste.py [carpeta] [--recall=0.95] [--tiempo=600]
+    opciones = dict(argumento[2:].split('=', 1) for argumento in sys.argv[1:] if argumento.startswith('--') and
+                    '=' in argumento)
+    posicionales = [argumento for argumento in sys.argv[1:] if not argumento.startswith('--')]
+
+    main(posicionales[0] if posicionales else '../videos/Shippuden_car_(10, 10)_6',
+         recall_objetivo=float(opciones.get('recall', 0.95)), tiempo_max=float(opciones.get('tiempo', 600)))
@@ -0,0 +1,417 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+import sys
+from typing import Dict, List, Tuple
+
+import numpy
+
+from Etiquetas import Etiquetas
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+def dimension_caracteristicas(tamano: Tuple[int, int] = (10, 10), tipo: str = 'gris') -> int:
+    """
+    Calcula el número de bytes del vector de características de un frame.
+
+    :param tamano: el tamaño al cual se reduce la imagen.
+    :param tipo: 'gris' guarda un byte por pixel, los hashes binarios ('mediana' o 'dct') un bit por pixel.
+
+    :return: la dimensión del vector en el almacén.
+    """
+    if tipo == 'gris':
+        return tamano[0] * tamano[1]
+
+    return (tamano[0] * tamano[1] + 7) // 8
+
+
+class Almacen:
+    """
+    Almacén binario de características de un corpus de videos. Todos los vectores se guardan como uint8 de manera
+    contigua en un solo archivo, junto a un archivo con el tiempo de cada frame y una tabla de offsets por video.
+
+    Archivos dentro de la carpeta:
+        - caracteristicas.u8: matriz (n, dimension) de uint8, fila por frame.
+        - tiempos.f32: arreglo (n,) de float32 con el tiempo de cada frame en segundos.
+        - videos.txt: primera linea 'dimension d', luego una linea 'nombre inicio cantidad' por video. Un video
+          eliminado se marca con una linea 'nombre -1 0'.
+        - manifiesto.json: tamaño y fecha de modificación de cada archivo .txt convertido (ver sincronizar_carpeta).
+    """
+
+    ARCHIVO_CARACTERISTICAS = 'caracteristicas.u8'
+    ARCHIVO_TIEMPOS = 'tiempos.f32'
+    ARCHIVO_VIDEOS = 'videos.txt'
+    ARCHIVO_MANIFIESTO = 'manifiesto.json'
+
+    def __init__(self, carpeta: str, dimension: int = None):
+        self.carpeta = carpeta
+        self.dimension = dimension
+
+        dimension_guardada = self._leer_dimension()
+        if dimension_guardada is not None:
+            if dimension is not None and dimension != dimension_guardada:
+                raise Exception(f'el almacén {carpeta} tiene dimensión {dimension_guardada}, no {dimension}')
+            self.dimension = dimension_guardada
+
+        elif dimension is None:
+            raise Exception(f'el almacén {carpeta} no existe y no se especificó la dimensión')
+
+    def _leer_dimension(self) -> int:
+        """
+        Lee la dimensión de la tabla de videos, con el mismo candado que las escrituras. Otro proceso puede haber
+        creado la tabla sin alcanzar a escribir su encabezado: una tabla vacía se trata como un almacén nuevo.
+
+        :return: la dimensión guardada, o None si el almacén no existe o su tabla está vacía.
+        """
+        if not Almacen.existe(self.carpeta):
+            return None
+
+        with open(self._ruta(Almacen.ARCHIVO_VIDEOS), 'r') as tabla:
+            if fcntl is not None:
+                fcntl.flock(tabla, fcntl.LOCK_SH)
+
+            encabezado = tabla.readline()
+
+            if fcntl is not None:
+                fcntl.flock(tabla, fcntl.LOCK_UN)
+
+        if not encabezado.strip():
+            return None
+
+        return int(encabezado.split(' ')[1])
+
+    @staticmethod
+    def existe(carpeta: str) -> bool:
+        # una tabla vacía es un almacén que otro proceso está creando
+        ruta = f'{carpeta}/{Almacen.ARCHIVO_VIDEOS}'
+        return os.path.isfile(ruta) and os.path.getsize(ruta) > 0
+
+    def _ruta(self, archivo: str) -> str:
+        return f'{self.carpeta}/{archivo}'
+
+    def agregar_video(self, nombre: str, tiempos: numpy.ndarray, caracteristicas: numpy.ndarray):
+        """
+        Agrega las características de un video al final del almacén. Si el video ya existía, la nueva entrada
+        reemplaza a la anterior (los datos antiguos quedan sin referencia hasta compactar).
+
+        :param nombre: nombre del video.
+        :param tiempos: arreglo (n,) con el tiempo de cada frame.
+        :param caracteristicas: matriz (n, dimension) con las características de cada frame.
+        """
+        caracteristicas = numpy.ascontiguousarray(caracteristicas, dtype=numpy.uint8)
+        tiempos = numpy.ascontiguousarray(tiempos, dtype=numpy.float32)
+
+        if caracteristicas.ndim != 2 or caracteristicas.shape[1] != self.dimension:
+            raise Exception(f'dimensión {caracteristicas.shape} no compatible con el almacén ({self.dimension})')
+        if tiempos.shape[0] != caracteristicas.shape[0]:
+            raise Exception('el número de tiempos y de vectores no coincide')
+
+        if not os.path.isdir(self.carpeta):
+            os.makedirs(self.carpeta, exist_ok=True)
+
+        # la tabla de videos hace de candado para permitir escritura desde varios procesos
+        with open(self._ruta(Almacen.ARCHIVO_VIDEOS), 'a') as tabla:
+            if fcntl is not None:
+                fcntl.flock(tabla, fcntl.LOCK_EX)
+
+            # otro proceso pudo haber creado la tabla primero
+            if tabla.tell() == 0:
+                tabla.write(f'dimension {self.dimension}\n')
+                tabla.flush()
+
+            # la posición de inicio se calcula desde las entradas confirmadas, ignorando escrituras incompletas
+            inicio = self._total()
+            with open(self._ruta(Almacen.ARCHIVO_CARACTERISTICAS), 'ab') as datos:
+                datos.truncate(inicio * self.dimension)
+                datos.seek(inicio * self.dimension)
+                datos.write(caracteristicas.tobytes())
+            with open(self._ruta(Almacen.ARCHIVO_TIEMPOS), 'ab') as archivo_tiempos:
+                archivo_tiempos.truncate(inicio * 4)
+                archivo_tiempos.seek(inicio * 4)
+                archivo_tiempos.write(tiempos.tobytes())
+
+            tabla.write(f'{nombre} {inicio} {caracteristicas.shape[0]}\n')
+            tabla.flush()
+
+            if fcntl is not None:
+                fcntl.flock(tabla, fcntl.LOCK_UN)
+
+    def eliminar_video(self, nombre: str):
+        """
+        Elimina un video del almacén. Sus datos quedan sin referencia hasta compactar.
+
+        :param nombre: nombre del video.
+        """
+        if nombre not in self.videos():
+            raise Exception(f'el video {nombre} no está en el almacén {self.carpeta}')
+
+        with open(self._ruta(Almacen.ARCHIVO_VIDEOS), 'a') as tabla:
+            if fcntl is not None:
+                fcntl.flock(tabla, fcntl.LOCK_EX)
+
+            tabla.write(f'{nombre} -1 0\n')
+            tabla.flush()
+
+            if fcntl is not None:
+                fcntl.flock(tabla, fcntl.LOCK_UN)
+
+    def entradas(self) -> List[Tuple[str, int, int]]:
+        """
+        Entradas de la tabla de videos, en orden, incluidas las reemplazadas y las eliminaciones.
+
+        :return: una lista de (nombre, fila de inicio, número de frames), con inicio -1 en las eliminaciones.
+        """
+        if not Almacen.existe(self.carpeta):
+            return []
+
+        entradas = []
+        with open(self._ruta(Almacen.ARCHIVO_VIDEOS), 'r') as tabla:
+            tabla.readline()
+            for linea in tabla:
+                nombre, inicio, cantidad = linea.rsplit(' ', 2)
+                entradas.append((nombre, int(inicio), int(cantidad)))
+
+        return entradas
+
+    def _total(self) -> int:
+        return max((inicio + cantidad for _, inicio, cantidad in self.entradas()), default=0)
+
+    def videos(self) -> Dict[str, Tuple[int, int]]:
+        """
+        Tabla de offsets del almacén.
+
+        :return: un diccionario nombre -> (fila de inicio, número de frames), en orden de inserción.
+        """
+        videos = {}
+        for nombre, inicio, cantidad in self.entradas():
+            # la última entrada de un video es la vigente
+            videos.pop(nombre, None)
+            if inicio >= 0:
+                videos[nombre] = (inicio, cantidad)
+
+        return videos
+
+    def huella(self) -> str:
+        """
+        Hash del estado del almacén, sin leer las características: como solo se agregan datos al final (y compactar
+        reescribe la tabla), la tabla de videos y el tamaño de los archivos de datos identifican su contenido.
+
+        :return: el hash sha1 en hexadecimal.
+        """
+        h = hashlib.sha1(str(self.dimension).encode())
+        if Almacen.existe(self.carpeta):
+            with open(self._ruta(Almacen.ARCHIVO_VIDEOS), 'rb') as tabla:
+                h.update(tabla.read())
+            for archivo in (Almacen.ARCHIVO_CARACTERISTICAS, Almacen.ARCHIVO_TIEMPOS):
+                ruta = self._ruta(archivo)
+                h.update(str(os.path.getsize(ruta) if os.path.isfile(ruta) else 0).encode())
+
+        return h.hexdigest()
+
+    def abrir(self) -> Tuple[numpy.ndarray, numpy.ndarray]:
+        """
+        Abre el almacén completo con numpy.memmap, sin copiar datos.
+
+        :return: 2 arreglos, uno (n,) de tiempos y otro (n, dimension) de características, en ese orden.
+        """
+        total = self._total()
+        if total == 0:
+            return numpy.empty(0, dtype=numpy.float32), numpy.empty((0, self.dimension), dtype=numpy.uint8)
+
+        caracteristicas = numpy.memmap(self._ruta(Almacen.ARCHIVO_CARACTERISTICAS), dtype=numpy.uint8, mode='r',
+                                       shape=(total, self.dimension))
+        tiempos = numpy.memmap(self._ruta(Almacen.ARCHIVO_TIEMPOS), dtype=numpy.float32, mode='r', shape=(total,))
+
+        return tiempos, caracteristicas
+
+    def leer_video(self, nombre: str) -> Tuple[numpy.ndarray, numpy.ndarray]:
+        """
+        Lee las características de un video del almacén (como vistas sobre el memmap).
+
+        :param nombre: nombre del video.
+
+        :return: 2 arreglos, uno de tiempos y otro de características, en ese orden.
+        """
+        videos = self.videos()
+        if nombre not in videos:
+            raise Exception(f'el video {nombre} no está en el almacén {self.carpeta}')
+
+        inicio, cantidad = videos[nombre]
+        tiempos, caracteristicas = self.abrir()
+
+        return tiempos[inicio:inicio + cantidad], caracteristicas[inicio:inicio + cantidad]
+
+    def contiguo(self) -> bool:
+        """
+        Determina si las entradas vigentes cubren el almacén completo en orden, es decir, si el memmap completo
+        corresponde exactamente a la concatenación de todos los videos.
+        """
+        fin = 0
+        for inicio, cantidad in self.videos().values():
+            if inicio != fin:
+                return False
+            fin += cantidad
+
+        return fin == self._total()
+
+    def compactar(self):
+        """
+        Reescribe el almacén dejando solo las entradas vigentes, de manera contigua.
+        """
+        videos = self.videos()
+        tiempos, caracteristicas = self.abrir()
+
+        shutil.rmtree(f'{self.carpeta}/.compactando', ignore_errors=True)
+        temporal = Almacen(f'{self.carpeta}/.compactando', dimension=self.dimension)
+        for nombre, (inicio, cantidad) in videos.items():
+            temporal.agregar_video(nombre, tiempos[inicio:inicio + cantidad],
+                                   caracteristicas[inicio:inicio + cantidad])
+
+        del tiempos, caracteristicas
+        for archivo in (Almacen.ARCHIVO_CARACTERISTICAS, Almacen.ARCHIVO_TIEMPOS, Almacen.ARCHIVO_VIDEOS):
+            if os.path.isfile(temporal._ruta(archivo)):
+                os.replace(temporal._ruta(archivo), self._ruta(archivo))
+            elif os.path.isfile(self._ruta(archivo)):
+                os.remove(self._ruta(archivo))
+        shutil.rmtree(temporal.carpeta, ignore_errors=True)
+
+
+def leer_txt(archivo: str) -> Tuple[numpy.ndarray, numpy.ndarray]:
+    """
+    Lee un archivo de características en el formato de texto antiguo ('tiempo v1 v2 ... vn' por linea).
+
+    :param archivo: el archivo a leer.
+
+    :return: 2 arreglos, uno de tiempos y otro de características (uint8), en ese orden.
+    """
+    datos = numpy.loadtxt(archivo, dtype=numpy.float64, ndmin=2)
+    if datos.shape[0] == 0:
+        return numpy.empty(0, dtype=numpy.float32), numpy.empty((0, 0), dtype=numpy.uint8)
+
+    return datos[:, 0].astype(numpy.float32), datos[:, 1:].astype(numpy.uint8)
+
+
+def convertir_carpeta(carpeta: str, destino: str = None) -> Almacen:
+    """
+    Convierte una carpeta con archivos de características .txt (uno por video) a un almacén binario.
+
+    :param carpeta: carpeta con los archivos .txt.
+    :param destino: carpeta del almacén a crear, por defecto la misma carpeta.
+
+    :return: el almacén con todos los videos convertidos.
+    """
+    if destino is None:
+        destino = carpeta
+
+    almacen = None
+    archivos = _archivos_txt(carpeta)
+
+    for i, archivo in enumerate(archivos):
+        tiempos, caracteristicas = leer_txt(f'{carpeta}/{archivo}')
+        if tiempos.shape[0] == 0:
+            continue
+
+        if almacen is None:
+            almacen = Almacen(destino, dimension=caracteristicas.shape[1])
+
+        nombre = re.split('[/.]', archivo)[-2]
+        almacen.agregar_video(nombre, tiempos, caracteristicas)
+        print(f'{i + 1}/{len(archivos)} {nombre}: {tiempos.shape[0]:,d} frames convertidos')
+
+    return almacen
+
+
+def _archivos_txt(carpeta: str) -> List[str]:
+    # los .txt del almacén y de las etiquetas guardadas en la misma carpeta no son videos
+    return sorted(archivo for archivo in os.listdir(carpeta) if archivo.endswith('.txt') and
+                  archivo not in (Almacen.ARCHIVO_VIDEOS, Etiquetas.ARCHIVO_NOMBRES))
+
+
+def _estado_archivo(archivo: str) -> dict:
+    estado = os.stat(archivo)
+    return {'tamano': estado.st_size, 'modificacion': estado.st_mtime_ns}
+
+
+def sincronizar_carpeta(carpeta: str, destino: str = None) -> Tuple[List[str], List[str]]:
+    """
+    Actualiza el almacén con los archivos de características .txt de una carpeta, leyendo solo los archivos nuevos o
+    modificados según el manifiesto (tamaño y fecha de modificación de cada archivo ya convertido). Los videos cuyo
+    archivo .txt fue borrado se eliminan del almacén. Los videos agregados al almacén de otra forma (por ejemplo por
+    Extraccion) no están en el manifiesto y no se tocan.
+
+    :param carpeta: carpeta con los archivos .txt.
+    :param destino: carpeta del almacén, por defecto la misma carpeta.
+
+    :return: los nombres de los videos agregados o reemplazados, y los de los videos eliminados, en ese orden.
+    """
+    if destino is None:
+        destino = carpeta
+
+    ruta_manifiesto = f'{destino}/{Almacen.ARCHIVO_MANIFIESTO}'
+    archivos = _archivos_txt(carpeta)
+
+    if not archivos and not os.path.isfile(ruta_manifiesto):
+        return [], []
+
+    if os.path.isfile(ruta_manifiesto):
+        with open(ruta_manifiesto, 'r') as entrada:
+            manifiesto = json.load(entrada)
+
+    else:
+        # almacén convertido antes de que existiera el manifiesto: sus videos se dan por actualizados
+        manifiesto = {}
+        if Almacen.existe(destino):
+            videos = Almacen(destino).videos()
+            manifiesto = {archivo: _estado_archivo(f'{carpeta}/{archivo}') for archivo in archivos
+                          if re.split('[/.]', archivo)[-2] in videos}
+
+    almacen = Almacen(destino) if Almacen.existe(destino) else None
+    agregados, eliminados = [], []
+
+    for i, archivo in enumerate(archivos):
+        estado = _estado_archivo(f'{carpeta}/{archivo}')
+        if manifiesto.get(archivo) == estado:
+            continue
+
+        nombre = re.split('[/.]', archivo)[-2]
+        tiempos, caracteristicas = leer_txt(f'{carpeta}/{archivo}')
+        manifiesto[archivo] = estado
+        if tiempos.shape[0] == 0:
+            continue
+
+        if almacen is None:
+            almacen = Almacen(destino, dimension=caracteristicas.shape[1])
+
+        almacen.agregar_video(nombre, tiempos, caracteristicas)
+        agregados.append(nombre)
+        print(f'{i + 1}/{len(archivos)} {nombre}: {tiempos.shape[0]:,d} frames convertidos')
+
+    # videos cuyo archivo ya no existe
+    for archivo in sorted(set(manifiesto) - set(archivos)):
+        nombre = re.split('[/.]', archivo)[-2]
+        del manifiesto[archivo]
+
+        if almacen is not None and nombre in almacen.videos():
+            almacen.eliminar_video(nombre)
+            eliminados.append(nombre)
+            print(f'{nombre}: eliminado')
+
+    if almacen is not None:
+        with open(ruta_manifiesto, 'w') as salida:
+            json.dump(manifiesto, salida, indent=1)
+
+    return agregados, eliminados
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('uso: python Almacen.py carpeta_txt [carpeta_destino]')
+        sys.exit(1)
+
+    sincronizar_carpeta(*sys.argv[1:3])
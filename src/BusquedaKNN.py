@@ -6,137 +6,313 @@ from typing import Tuple
 
 import numpy
 
-from Indices import Index, KDTree
+from Almacen import Almacen, dimension_caracteristicas, leer_txt, sincronizar_carpeta
+from Cache import Cache
+from Etiquetas import ETIQUETA_TRAMO, Etiquetas
+from Indices import Exacto, Index, KDTree, pyflann
+from Metricas import contar, etapa
+from Resultados import ResultadosKNN
 
 
-def leer_caracteristicas(archivo: str) -> Tuple[numpy.ndarray, numpy.ndarray]:
+def leer_caracteristicas(archivo: str) -> Tuple[Etiquetas, numpy.ndarray]:
     """
-    Lee los datos de un archivo y las retorna en 2 arreglos de numpy, 1 para características y otro para etiquetas.
+    Lee los datos de un video y las retorna en una tabla de etiquetas y un arreglo de numpy de características.
+    El video puede ser un archivo .txt en el formato antiguo o un video dentro de un almacén binario, dado como
+    'carpeta_almacen/nombre'.
 
     :param archivo: el archivo a leer.
 
-    :return: 2 arreglos de numpy, uno para etiquetas y otro para características, en ese orden.
+    :return: las etiquetas y un arreglo de numpy de características, en ese orden.
     """
-    # nombre e índice de frame
-    nombre = re.split('[/.]', archivo)[-2]
-    i = 1
+    carpeta, nombre = os.path.split(archivo)
 
-    # leer archivo y pasar a listas
-    etiqueta_list = []
-    caracteristicas_list = []
-    with open(archivo, "r") as log:
-        for linea in log:
-            datos = linea.split(" ")
-            etiqueta_list.append(f'{nombre} # {datos[0]} # {i}')
-            caracteristicas_list.append([int(x) for x in datos[1:]])
-            i += 1
-
-    # transformar listas a arreglos y agregar a los arreglos existentes
-    etiqueta = numpy.array(etiqueta_list)
-    caracteristicas = numpy.array(caracteristicas_list, dtype=numpy.int32)
+    if archivo.endswith('.txt'):
+        nombre = re.split('[/.]', archivo)[-2]
+        tiempos, caracteristicas = leer_txt(archivo)
+    else:
+        tiempos, caracteristicas = Almacen(carpeta).leer_video(nombre)
 
-    return etiqueta, caracteristicas
+    return Etiquetas.de_video(nombre, tiempos), caracteristicas
 
 
-def agrupar_caracteristicas(carpeta: str, recargar: bool = True, tamano=(10, 10)
-                            ) -> Tuple[numpy.ndarray, numpy.ndarray]:
+def agrupar_caracteristicas(carpeta: str, recargar: bool = True, tamano=(10, 10), tipo: str = 'gris',
+                            cache: Cache = None) -> Tuple[Etiquetas, numpy.ndarray]:
     """
-    Agrupa todos los datos de la carpeta dada en 2 arreglos de numpy, 1 para características y otro para etiquetas.
-    Finalmente los guarda en archivos para reutilizarlos si se vuelve a intentar agrupar la misma carpeta.
+    Agrupa todos los datos de la carpeta dada en una tabla de etiquetas y un arreglo de numpy de características.
+    Las características se leen del almacén binario de la carpeta con numpy.memmap, sin copiarlas. Si la carpeta
+    tiene archivos .txt, primero se agregan al almacén los nuevos o modificados y se eliminan los borrados (ver
+    Almacen.sincronizar_carpeta).
+    Las etiquetas se guardan en la carpeta para reutilizarlas si se vuelve a intentar agrupar la misma carpeta.
 
     :param carpeta: carpeta donde están las características que agrupar.
     :param recargar: determina si se deben recargar los archivos previamente generados (si es que existen).
     :param tamano: tamaño del vector de características.
+    :param tipo: tipo de características (ver Extraccion.extraer_caracteristicas).
+    :param cache: si se da, las etiquetas se guardan y recargan como un artefacto de esta cache, con la huella del
+    almacén como clave (ver Almacen.huella), en vez de guardarse en la carpeta.
 
-    :return: 2 arreglos de numpy, uno para etiquetas y otro para características, en ese orden.
+    :return: las etiquetas y un arreglo de numpy de características, en ese orden.
+    """
+    with etapa('agrupacion') as medida:
+        cambios = ([], [])
+        if any(archivo.endswith('.txt') and archivo != Almacen.ARCHIVO_VIDEOS for archivo in os.listdir(carpeta)):
+            cambios = sincronizar_carpeta(carpeta)
+
+        almacen = Almacen(carpeta, dimension=dimension_caracteristicas(tamano, tipo))
+        videos = almacen.videos()
+        tiempos, caracteristicas = almacen.abrir()
+
+        # si hay videos reemplazados, juntar solo las entradas vigentes (una sola copia)
+        if not almacen.contiguo():
+            caracteristicas = numpy.concatenate([caracteristicas[inicio:inicio + cantidad]
+                                                 for inicio, cantidad in videos.values()])
+            tiempos = numpy.concatenate([tiempos[inicio:inicio + cantidad] for inicio, cantidad in videos.values()])
+
+        # reutilizar etiquetas si ya se hizo agrupación antes
+        etiquetas = None
+        if cache is not None:
+            clave = Cache.clave('agrupacion', almacen=almacen.huella(), tamano=tamano, tipo=tipo)
+            ruta = cache.obtener(clave) if recargar else None
+            if ruta is not None:
+                etiquetas = Etiquetas.cargar(ruta)
+
+        elif Etiquetas.existe(carpeta) and recargar and not any(cambios):
+            etiquetas = Etiquetas.cargar(carpeta)
+            if len(etiquetas) != caracteristicas.shape[0] or etiquetas.nombres != list(videos.keys()):
+                etiquetas = None
+
+        if etiquetas is None:
+            # generar etiquetas de todos los videos
+            cantidades = [cantidad for _, cantidad in videos.values()]
+            etiquetas = Etiquetas.de_videos(list(videos.keys()), cantidades, tiempos)
+            print(f'{len(etiquetas):,d} frames leídos en {len(videos)} videos')
+
+            # guardar etiquetas
+            if cache is not None:
+                with cache.guardar(clave) as temporal:
+                    etiquetas.guardar(temporal)
+                etiquetas.carpeta = cache.ruta(clave)
+            else:
+                etiquetas.guardar(carpeta)
+
+    print(f'la agrupación de datos tomó {medida.duracion:.2f} segundos')
+    return etiquetas, caracteristicas
+
+
+def colapsar_tramos(etiquetas: Etiquetas, caracteristicas: numpy.ndarray, umbral: float = 4.0,
+                    max_tramo: int = 30, filas: int = 1 << 20) -> Tuple[Etiquetas, numpy.ndarray]:
+    """
+    Colapsa los tramos de frames consecutivos casi iguales de cada video (tomas estáticas) en su primer frame, que
+    queda como representante del tramo. La tabla de etiquetas resultante guarda además el número y el tiempo del
+    último frame de cada tramo (ver Etiquetas.ETIQUETA_TRAMO), para que la detección pueda seguir calculando offsets.
+
+    :param etiquetas: las etiquetas del corpus.
+    :param caracteristicas: las características del corpus (distancia L2, no sirve para hashes binarios).
+    :param umbral: un frame se une al tramo del anterior si su distancia al cuadrado, dividida por la dimensión, es
+    menor o igual a este valor.
+    :param max_tramo: número máximo de frames por tramo, que acota cuánto puede cambiar la imagen dentro de un tramo.
+    :param filas: filas por bloque al calcular las distancias.
+
+    :return: las etiquetas de los tramos y las características de sus representantes, en ese orden.
+    """
+    n = caracteristicas.shape[0]
+    if n == 0:
+        return Etiquetas(numpy.empty(0, dtype=ETIQUETA_TRAMO), etiquetas.nombres), caracteristicas[:0]
+
+    # distancia de cada frame al anterior, por bloques
+    distancias = numpy.empty(n, dtype=numpy.float32)
+    distancias[0] = numpy.inf
+    for inicio in range(1, n, filas):
+        fin = min(inicio + filas, n)
+        bloque = numpy.asarray(caracteristicas[inicio - 1:fin], dtype=numpy.float32)
+        diferencias = bloque[1:] - bloque[:-1]
+        distancias[inicio:fin] = numpy.einsum('ij,ij->i', diferencias, diferencias) / caracteristicas.shape[1]
+
+    # un tramo nuevo empieza en cada cambio de video o de toma
+    nuevo = distancias > umbral
+    nuevo[1:] |= etiquetas.video[1:] != etiquetas.video[:-1]
+
+    # cortar los tramos largos cada max_tramo frames
+    inicios = numpy.flatnonzero(nuevo)
+    posiciones = numpy.arange(n) - numpy.repeat(inicios, numpy.diff(numpy.append(inicios, n)))
+    inicios = numpy.flatnonzero(posiciones % max_tramo == 0)
+    fines = numpy.append(inicios[1:], n) - 1
+
+    tabla = numpy.empty(inicios.shape[0], dtype=ETIQUETA_TRAMO)
+    tabla['video'] = etiquetas.video[inicios]
+    tabla['tiempo'] = etiquetas.tiempo[inicios]
+    tabla['indice'] = etiquetas.indice[inicios]
+    tabla['indice_fin'] = etiquetas.indice[fines]
+    tabla['tiempo_fin'] = etiquetas.tiempo[fines]
+
+    return Etiquetas(tabla, etiquetas.nombres), numpy.asarray(caracteristicas[inicios])
+
+
+def comparar_tramos(carpeta: str, tamano=(10, 10), umbral: float = 4.0, max_tramo: int = 30, k: int = 20,
+                    checks=500, n_busquedas: int = 1000):
     """
-    # reutilizar archivos si ya se hizo agrupación antes
-    if os.path.isfile(f'{carpeta}/caracteristicas.npy') and os.path.isfile(f'{carpeta}/etiqueta.npy') and recargar:
-        caracteristicas = numpy.load(f'{carpeta}/caracteristicas.npy')
-        etiqueta = numpy.load(f'{carpeta}/etiqueta.npy')
+    Compara el tamaño del índice, el tiempo de construcción y el de búsqueda antes y después de colapsar los tramos
+    de frames casi iguales (ver colapsar_tramos). Usa un KDTree, o un índice Exacto si pyflann no está instalado.
+    Las búsquedas son frames del corpus al azar.
+
+    :param carpeta: la carpeta con las características del corpus.
+    :param tamano: el tamaño de las características.
+    :param umbral: umbral de distancia de colapsar_tramos.
+    :param max_tramo: número máximo de frames por tramo.
+    :param k: el número de vecinos a buscar.
+    :param checks: el número de checks a realizar en la búsqueda.
+    :param n_busquedas: número de búsquedas.
+    """
+    etiquetas, caracteristicas = agrupar_caracteristicas(carpeta, recargar=True, tamano=tamano)
+
+    rng = numpy.random.RandomState(0)
+    seleccion = numpy.sort(rng.choice(caracteristicas.shape[0], min(n_busquedas, caracteristicas.shape[0]),
+                                      replace=False))
+    busquedas = numpy.asarray(caracteristicas[seleccion])
+
+    t0 = time.time()
+    etiquetas_tramos, caracteristicas_tramos = colapsar_tramos(etiquetas, caracteristicas, umbral=umbral,
+                                                               max_tramo=max_tramo)
+    print(f'colapsar {len(etiquetas):,d} frames en {len(etiquetas_tramos):,d} tramos tomó '
+          f'{time.time() - t0:.1f} segundos')
 
-        return etiqueta, caracteristicas
+    for nombre, (etiquetas_indice, datos) in (('original', (etiquetas, caracteristicas)),
+                                              ('tramos', (etiquetas_tramos, caracteristicas_tramos))):
+        if pyflann is not None:
+            indice = KDTree(datos, etiquetas_indice, trees=10, cores=0)
+        else:
+            indice = Exacto(datos, etiquetas_indice)
 
-    # obtener todos los archivos en la carpeta
-    archivos = os.listdir(carpeta)
+        t0 = time.time()
+        indice.search(busquedas, k=k, checks=checks)
+        t1 = time.time()
 
-    etiqueta = numpy.empty(0, dtype=numpy.str)
-    caracteristicas = numpy.empty((0, tamano[0] * tamano[1]), dtype=numpy.int32)
+        print(f'{nombre}: {datos.shape[0]:,d} vectores ({datos.nbytes / 2 ** 20:.1f} MB), '
+              f'construcción {indice.build_time:.1f} segundos, {busquedas.shape[0] / (t1 - t0):.0f} búsquedas/s')
 
-    # leer las caracteristicas de todos los videos y agruparlas
-    i = 0
-    for archivo in archivos:
-        if not archivo.endswith('.txt'):
-            continue
 
-        # leer características y juntar con los arreglos.
-        etiqueta_video, caracteristicas_video = leer_caracteristicas(f'{carpeta}/{archivo}')
-        etiqueta = numpy.concatenate((etiqueta, etiqueta_video))
-        caracteristicas = numpy.concatenate((caracteristicas, caracteristicas_video))
+def buscar_cercanos(indice: Index, caracteristicas: numpy.ndarray, k: int = 5, checks=100,
+                    tamano_lote: int = 0) -> Tuple[numpy.ndarray, numpy.ndarray]:
+    """
+    Busca los k frames más cercanos a cada vector dado, enviando las búsquedas al índice por lotes.
 
-        i += 1
-        print(f'{etiqueta.shape[0]:,d} lineas leídas en {i} archivos')
+    :param indice: el índice de busqueda a usar.
+    :param caracteristicas: matriz con un vector de características por fila.
+    :param k: el número de frames cercanos a buscar.
+    :param checks: el número de checks a realizar en la búsqueda.
+    :param tamano_lote: número de vectores por llamada al índice, 0 envía todos en una sola llamada.
 
-    # guardar archivos
-    numpy.save(f'{carpeta}/caracteristicas.npy', caracteristicas)
-    numpy.save(f'{carpeta}/etiqueta.npy', etiqueta)
+    :return: 2 matrices (n, k), una con los índices de los frames más cercanos a cada vector y otra con sus
+    distancias, en ese orden.
+    """
+    n = caracteristicas.shape[0]
+    if tamano_lote <= 0:
+        tamano_lote = max(n, 1)
+
+    cercanos = numpy.empty((n, k), dtype=numpy.int32)
+    distancias = numpy.empty((n, k), dtype=numpy.float32)
+    contar('busquedas', n)
+    for inicio in range(0, n, tamano_lote):
+        fin = inicio + tamano_lote
+        cercanos[inicio:fin], distancias[inicio:fin] = indice.search(caracteristicas[inicio:fin], k=k,
+                                                                     checks=checks, distancias=True)
 
-    return etiqueta, caracteristicas
+    return cercanos, distancias
 
 
-def frames_mas_cercanos_video(archivo: str, carpeta_log: str, indice: Index, k: int = 5, checks=100):
+def frames_mas_cercanos_video(archivo: str, carpeta_log: str, indice: Index, k: int = 5, checks=100,
+                              tamano_lote: int = 0, formato: str = 'bin'):
     """
     Encuentra los k frames más cercanos a cada frame del video dado, dentro de todos los frames en una lista de Videos,
-    registra esta información en un log txt.
+    y registra esta información en la carpeta log (ver ResultadosKNN).
 
     :param archivo: el archivo del cuál buscar frames cercanos.
     :param carpeta_log: la carpeta en la cual guardar el log.
     :param indice: el índice de busqueda a usar.
     :param k: el número de frames cercanos a buscar.
     :param checks: el número de checks a realizar en la búsqueda.
+    :param tamano_lote: número de frames por llamada al índice, 0 envía todos en una sola llamada.
+    :param formato: 'bin' guarda ids y distancias como matrices en la carpeta log/nombre,
+    'txt' los exporta como texto en log/nombre.txt.
     """
 
-    # medir tiempo
-    t0 = time.time()
-
-    # leer caracteristicas del video
-    etiqueta_video, caracteristicas_video = leer_caracteristicas(archivo)
+    with etapa('busqueda') as medida:
+        # leer caracteristicas del video
+        etiqueta_video, caracteristicas_video = leer_caracteristicas(archivo)
 
-    # abrir log
-    nombre = re.split('[/.]', archivo)[-2]
-    if not os.path.isdir(carpeta_log):
-        os.mkdir(carpeta_log)
-    log = open(f'{carpeta_log}/{nombre}.txt', 'w')
+        # abrir log
+        nombre = os.path.basename(archivo)
+        if archivo.endswith('.txt'):
+            nombre = re.split('[/.]', archivo)[-2]
+        if not os.path.isdir(carpeta_log):
+            os.mkdir(carpeta_log)
 
-    print(f'buscando {k} frames más cercanos para {nombre}')
+        print(f'buscando {k} frames más cercanos para {nombre}')
 
-    # buscar los frames más cercanos de cada frame
-    for i in range(caracteristicas_video.shape[0]):
-        cercanos = indice.search(caracteristicas_video[i], k=k, checks=checks)[0]
-        cercanos_str = ' | '.join([f'{indice.etiquetas[frame]}' for frame in cercanos])
+        # buscar los frames más cercanos de todos los frames
+        cercanos, distancias = buscar_cercanos(indice, caracteristicas_video, k=k, checks=checks,
+                                               tamano_lote=tamano_lote)
 
         # registrar resultado
-        tiempo = re.split(' # ', etiqueta_video[i])[1]
-        log.write(f'{tiempo} $ {cercanos_str}\n')
+        resultados = ResultadosKNN(etiqueta_video.tiempo, cercanos, distancias, indice.etiquetas)
+        if formato == 'txt':
+            resultados.guardar_txt(f'{carpeta_log}/{nombre}.txt')
+        else:
+            resultados.guardar_bin(f'{carpeta_log}/{nombre}')
 
-    log.close()
-    print(f'la búsqueda de {k} frames más cercanos tomó {int(time.time() - t0)} segundos')
+    print(f'la búsqueda de {k} frames más cercanos tomó {medida.duracion:.2f} segundos')
     return
 
 
-def main(video: str):
+def comparar_busqueda(archivo: str, indice: Index, k: int = 5, checks=100, tamano_lote: int = 0, cores: int = 0):
+    """
+    Compara el tiempo de buscar los frames más cercanos de un video frame a frame con 1 núcleo (la forma original)
+    contra buscarlos por lotes con varios núcleos, e imprime la aceleración.
+
+    :param archivo: el archivo del cuál buscar frames cercanos.
+    :param indice: el índice de busqueda a usar.
+    :param k: el número de frames cercanos a buscar.
+    :param checks: el número de checks a realizar en la búsqueda.
+    :param tamano_lote: número de frames por llamada al índice en la búsqueda por lotes.
+    :param cores: número de núcleos de la búsqueda por lotes (0 usa todos los disponibles).
+    """
+    _, caracteristicas_video = leer_caracteristicas(archivo)
+    cores_originales = indice.cores
+
+    indice.cores = 1
+    t0 = time.time()
+    buscar_cercanos(indice, caracteristicas_video, k=k, checks=checks, tamano_lote=1)
+    tiempo_frames = time.time() - t0
+
+    indice.cores = cores
+    t0 = time.time()
+    buscar_cercanos(indice, caracteristicas_video, k=k, checks=checks, tamano_lote=tamano_lote)
+    tiempo_lotes = time.time() - t0
+
+    indice.cores = cores_originales
+
+    n = caracteristicas_video.shape[0]
+    print(f'frame a frame: {tiempo_frames:.2f} segundos ({n / tiempo_frames:.1f} frames/s)')
+    print(f'por lotes: {tiempo_lotes:.2f} segundos ({n / tiempo_lotes:.1f} frames/s)')
+    print(f'aceleración: {tiempo_frames / tiempo_lotes:.1f}x')
+    return
+
+
+def main(video: str, comparar: bool = False):
     fps = 6
     tamano = (10, 10)
 
-    t0 = time.time()
     etiquetas, caracteristicas = agrupar_caracteristicas(f'../videos/Shippuden_car_{tamano}_{fps}',
                                                          recargar=True, tamano=tamano)
-    print(f'la agrupación de datos tomó {int(time.time() - t0)} segundos')
 
-    indice = KDTree(datos=caracteristicas, etiquetas=etiquetas, trees=10)
-    print(f'la construcción del índice tomó {indice.build_time:.1f} segundos')
+    indice = KDTree(datos=caracteristicas, etiquetas=etiquetas, trees=10, cores=0,
+                    cache=f'../videos/Shippuden_car_{tamano}_{fps}/indices')
+    print(f'la {"carga" if indice.cargado else "construcción"} del índice tomó {indice.build_time:.1f} segundos')
+
+    if comparar:
+        comparar_busqueda(f'../videos/AMV_car_{tamano}_{fps}/{video}', indice=indice, checks=100, k=20)
 
-    frames_mas_cercanos_video(f'../videos/AMV_car_{tamano}_{fps}/{video}.txt',
+    frames_mas_cercanos_video(f'../videos/AMV_car_{tamano}_{fps}/{video}',
                               f'../videos/AMV_cerc_{tamano}_{fps}',
                               indice=indice, checks=100, k=20)
 
@@ -147,4 +323,4 @@ if __name__ == '__main__':
     else:
         nombre = sys.argv[1]
 
-    main(nombre)
+    main(nombre, comparar='--comparar' in sys.argv)
@@ -0,0 +1,201 @@
+import hashlib
+import json
+import os
+import shutil
+import sys
+import time
+from contextlib import contextmanager
+
+from Metricas import contar
+
+
+def huella_archivo(archivo: str) -> str:
+    """
+    :return: el hash sha1 en hexadecimal del contenido de un archivo.
+    """
+    h = hashlib.sha1()
+    with open(archivo, 'rb') as entrada:
+        for bloque in iter(lambda: entrada.read(1 << 20), b''):
+            h.update(bloque)
+
+    return h.hexdigest()
+
+
+class Cache:
+    """
+    Cache de artefactos direccionada por contenido. Cada artefacto es una carpeta {carpeta}/{clave}, donde la clave
+    es un hash de las entradas y los parámetros de la etapa que lo generó (ver clave), así una etapa con la misma
+    clave se puede saltar usando su artefacto.
+
+    Los artefactos se escriben en una carpeta temporal y se renombran al terminar, así un artefacto a medio escribir
+    nunca se usa. Al usar un artefacto se actualiza su fecha de modificación, y al guardar uno nuevo se eliminan los
+    usados hace más tiempo hasta que el total quede bajo max_bytes (LRU).
+
+    Un artefacto puede depender de otros (por ejemplo los frames cercanos de sus etiquetas): una dependencia cuenta
+    como usada cuando se usa un artefacto que depende de ella, y al eliminarla se eliminan también los artefactos
+    que dependen de ella, para no dejar artefactos inservibles.
+    """
+
+    ARCHIVO_DEPENDENCIAS = 'dependencias.txt'
+
+    def __init__(self, carpeta: str, max_bytes: int = 2 * 1024 ** 3):
+        """
+        :param carpeta: carpeta de los artefactos.
+        :param max_bytes: tamaño máximo de todos los artefactos juntos.
+        """
+        self.carpeta = carpeta
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def clave(etapa: str, **partes) -> str:
+        """
+        :param etapa: nombre de la etapa, que queda como prefijo de la clave.
+        :param partes: hashes de las entradas y parámetros de la etapa (valores serializables a JSON).
+
+        :return: la clave del artefacto.
+        """
+        contenido = json.dumps(partes, sort_keys=True, default=str)
+        return f'{etapa}_{hashlib.sha1(contenido.encode()).hexdigest()[:24]}'
+
+    def ruta(self, clave: str) -> str:
+        return f'{self.carpeta}/{clave}'
+
+    def obtener(self, clave: str) -> str:
+        """
+        Busca un artefacto y lo marca como usado.
+
+        :return: la carpeta del artefacto, o None si no está.
+        """
+        ruta = self.ruta(clave)
+        if not os.path.isdir(ruta):
+            contar('cache_fallos')
+            return None
+
+        os.utime(ruta)
+        contar('cache_aciertos')
+        return ruta
+
+    @contextmanager
+    def guardar(self, clave: str, dependencias: list = ()):
+        """
+        Crea un artefacto:
+
+            with cache.guardar(clave) as carpeta:
+                ... escribir archivos en carpeta ...
+
+        Si hay una excepción se descarta. Si otro proceso guardó la misma clave mientras tanto, se mantiene el suyo.
+
+        :param clave: clave del artefacto.
+        :param dependencias: claves de los artefactos de la cache que este artefacto necesita.
+        """
+        temporal = f'{self.carpeta}/.{clave}.{os.getpid()}'
+        if os.path.isdir(temporal):
+            shutil.rmtree(temporal)
+        os.makedirs(temporal)
+
+        try:
+            yield temporal
+        except BaseException:
+            shutil.rmtree(temporal, ignore_errors=True)
+            raise
+
+        if dependencias:
+            with open(f'{temporal}/{Cache.ARCHIVO_DEPENDENCIAS}', 'w') as archivo:
+                archivo.writelines(f'{dependencia}\n' for dependencia in dependencias)
+
+        try:
+            os.rename(temporal, self.ruta(clave))
+        except OSError:
+            shutil.rmtree(temporal, ignore_errors=True)
+
+        self.limpiar()
+
+    def artefactos(self) -> list:
+        """
+        :return: una lista (fecha de último uso, bytes, clave) por artefacto, del usado hace más tiempo al más
+        reciente.
+        """
+        if not os.path.isdir(self.carpeta):
+            return []
+
+        artefactos = []
+        for clave in os.listdir(self.carpeta):
+            ruta = self.ruta(clave)
+            if clave.startswith('.') or not os.path.isdir(ruta):
+                continue
+
+            tamano = sum(os.path.getsize(f'{carpeta}/{archivo}') for carpeta, _, archivos in os.walk(ruta)
+                         for archivo in archivos)
+            artefactos.append((os.path.getmtime(ruta), tamano, clave))
+
+        return sorted(artefactos)
+
+    def dependencias(self, clave: str) -> list:
+        """
+        :return: las claves de los artefactos de los que depende un artefacto.
+        """
+        ruta = f'{self.ruta(clave)}/{Cache.ARCHIVO_DEPENDENCIAS}'
+        if not os.path.isfile(ruta):
+            return []
+
+        with open(ruta, 'r') as archivo:
+            return archivo.read().split()
+
+    def limpiar(self):
+        """
+        Elimina los artefactos usados hace más tiempo hasta que el total quede bajo max_bytes. Una dependencia se
+        considera usada cuando se usó el último artefacto que depende de ella, y se elimina junto a ellos.
+        """
+        artefactos = self.artefactos()
+        total = sum(tamano for _, tamano, _ in artefactos)
+        if total <= self.max_bytes:
+            return
+
+        usos = {clave: uso for uso, _, clave in artefactos}
+        tamanos = {clave: tamano for _, tamano, clave in artefactos}
+        dependientes = {clave: [] for clave in usos}
+        for clave in usos:
+            for dependencia in self.dependencias(clave):
+                if dependencia in dependientes:
+                    dependientes[dependencia].append(clave)
+
+        # último uso de cada artefacto o de alguno de sus dependientes (directos o indirectos)
+        def ultimo_uso(clave, visitados):
+            visitados.add(clave)
+            return max([usos[clave]] + [ultimo_uso(dependiente, visitados) for dependiente in dependientes[clave]
+                                        if dependiente not in visitados])
+
+        eliminados = set()
+        for clave in sorted(usos, key=lambda clave: (ultimo_uso(clave, set()), clave)):
+            if total <= self.max_bytes:
+                break
+            if clave in eliminados:
+                continue
+
+            # eliminar el artefacto y los que dependen de él
+            pendientes = [clave]
+            while pendientes:
+                actual = pendientes.pop()
+                if actual in eliminados:
+                    continue
+
+                eliminados.add(actual)
+                shutil.rmtree(self.ruta(actual), ignore_errors=True)
+                total -= tamanos[actual]
+                print(f'artefacto {actual} eliminado de la cache ({tamanos[actual] / 1024 ** 2:.1f} MB)')
+                pendientes.extend(dependientes[actual])
+
+
+def main(carpeta: str):
+    """
+    Muestra los artefactos de una cache, del usado más recientemente al más antiguo.
+    """
+    artefactos = Cache(carpeta).artefactos()
+    for uso, tamano, clave in reversed(artefactos):
+        print(f'{clave:40s} {tamano / 1024 ** 2:9.1f} MB  {time.strftime("%Y-%m-%d %H:%M", time.localtime(uso))}')
+
+    print(f'{len(artefactos)} artefactos, {sum(tamano for _, tamano, _ in artefactos) / 1024 ** 2:.1f} MB')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1] if len(sys.argv) > 1 else '../videos/cache')
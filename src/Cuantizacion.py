@@ -0,0 +1,334 @@
+import sys
+import time
+
+import numpy
+
+from BusquedaKNN import agrupar_caracteristicas
+from Indices import Index, Exacto, KDTree, k_mejores, medir_recall, muestra_busquedas, pyflann
+
+
+def asignar(datos: numpy.ndarray, centroides: numpy.ndarray, memoria_max: int = 64 * 2 ** 20) -> numpy.ndarray:
+    """
+    Asigna cada fila de datos a su centroide más cercano (distancia L2), por bloques de filas.
+
+    :param datos: matriz con un vector por fila.
+    :param centroides: matriz (c, d) con un centroide por fila.
+    :param memoria_max: bytes máximos a usar por bloque en la matriz de distancias.
+
+    :return: arreglo con el índice del centroide más cercano de cada fila.
+    """
+    centroides = numpy.asarray(centroides, dtype=numpy.float32)
+    normas = numpy.einsum('ij,ij->i', centroides, centroides)
+
+    filas = max(memoria_max // (4 * centroides.shape[0]), 1)
+    asignacion = numpy.empty(datos.shape[0], dtype=numpy.int64)
+    for inicio in range(0, datos.shape[0], filas):
+        bloque = numpy.asarray(datos[inicio:inicio + filas], dtype=numpy.float32)
+
+        # ||x||² no cambia el centroide más cercano
+        dists = bloque @ centroides.T
+        dists *= -2
+        dists += normas[None, :]
+        asignacion[inicio:inicio + filas] = numpy.argmin(dists, axis=1)
+
+    return asignacion
+
+
+def kmeans(datos: numpy.ndarray, k: int, iteraciones: int = 20, semilla: int = 0) -> numpy.ndarray:
+    """
+    Entrena k centroides con el algoritmo de Lloyd. Los centroides que quedan vacíos se reinician en un punto al azar.
+
+    :param datos: matriz con un vector por fila.
+    :param k: número de centroides (si hay menos filas que k, se usan tantos centroides como filas).
+    :param iteraciones: número de iteraciones.
+    :param semilla: semilla para elegir los centroides iniciales.
+
+    :return: matriz (k, d) de tipo float32 con los centroides.
+    """
+    rng = numpy.random.RandomState(semilla)
+    datos = numpy.asarray(datos, dtype=numpy.float32)
+    k = min(k, datos.shape[0])
+
+    centroides = datos[rng.choice(datos.shape[0], k, replace=False)].copy()
+    for _ in range(iteraciones):
+        asignacion = asignar(datos, centroides)
+        cantidades = numpy.bincount(asignacion, minlength=k)
+
+        sumas = numpy.zeros_like(centroides)
+        numpy.add.at(sumas, asignacion, datos)
+
+        vacios = cantidades == 0
+        centroides[~vacios] = sumas[~vacios] / cantidades[~vacios, None]
+        centroides[vacios] = datos[rng.choice(datos.shape[0], int(vacios.sum()))]
+
+    return centroides
+
+
+class ProductoCuantizado(Index):
+    """
+    Índice comprimido por cuantización de producto, solo con numpy y sin pyflann. Cada vector se divide en
+    subespacios y cada parte se reemplaza por el índice (1 byte) de su centroide más cercano en el diccionario de ese
+    subespacio, así cada frame ocupa tantos bytes como subespacios. Los diccionarios se entrenan con k-means sobre una
+    muestra del corpus.
+
+    Las búsquedas calculan para cada subespacio una tabla con la distancia de la búsqueda a cada centroide, y la
+    distancia aproximada a un frame es la suma de las entradas de sus códigos (distancia asimétrica).
+
+    Opcionalmente los frames se reparten en listas según su centroide grueso más cercano, y cada búsqueda solo
+    recorre las listas más cercanas (índice invertido). También se pueden reordenar los mejores candidatos con la
+    distancia exacta a los vectores originales, que se leen solo para esos candidatos (por ejemplo desde el memmap).
+    """
+
+    CENTROIDES = 256
+
+    def __init__(self, datos, etiquetas, subespacios: int = 10, listas: int = 0, sondas: int = 8,
+                 reordenar: int = 0, muestra: int = 65536, iteraciones: int = 20,
+                 memoria_max: int = 256 * 2 ** 20, cores=1, semilla: int = 0):
+        """
+        :param datos: matriz con un vector de características por fila.
+        :param etiquetas: tabla con la etiqueta de cada fila de datos.
+        :param subespacios: número de subespacios (bytes por frame).
+        :param listas: número de listas del índice invertido, 0 para recorrer todos los frames.
+        :param sondas: número mínimo de listas a recorrer por búsqueda.
+        :param reordenar: número de candidatos a reordenar con la distancia exacta, 0 para no reordenar.
+        :param muestra: número de frames con los que entrenar los diccionarios.
+        :param iteraciones: iteraciones de k-means.
+        :param memoria_max: bytes máximos a usar por bloque de distancias al buscar.
+        :param cores: se ignora.
+        :param semilla: semilla para la muestra y k-means.
+        """
+        self.cores = cores
+        self.etiquetas = etiquetas
+        self.cargado = False
+        self.dimension = datos.shape[1]
+        self.listas = listas
+        self.sondas = sondas
+        self.reordenar = reordenar
+        self.memoria_max = memoria_max
+
+        # los vectores originales solo se guardan (sin copiarlos) si hay que reordenar
+        self.datos = datos if reordenar > 0 else None
+
+        t0 = time.time()
+        rng = numpy.random.RandomState(semilla)
+        seleccion = numpy.sort(rng.choice(datos.shape[0], min(muestra, datos.shape[0]), replace=False))
+        entrenamiento = numpy.asarray(datos[seleccion], dtype=numpy.float32)
+
+        # diccionario de cada subespacio
+        limites = numpy.linspace(0, self.dimension, subespacios + 1).astype(int)
+        self.cortes = list(zip(limites[:-1].tolist(), limites[1:].tolist()))
+        self.diccionarios = [kmeans(entrenamiento[:, inicio:fin], ProductoCuantizado.CENTROIDES,
+                                    iteraciones=iteraciones, semilla=semilla) for inicio, fin in self.cortes]
+
+        # listas del índice invertido
+        self.ids = None
+        self.limites = None
+        self.gruesos = None
+        if listas > 0:
+            self.gruesos = kmeans(entrenamiento, listas, iteraciones=iteraciones, semilla=semilla)
+            lista_frame = asignar(datos, self.gruesos)
+
+            self.ids = numpy.argsort(lista_frame, kind='stable').astype(numpy.int32)
+            self.limites = numpy.concatenate(([0], numpy.cumsum(numpy.bincount(lista_frame,
+                                                                               minlength=self.gruesos.shape[0]))))
+
+        self.codigos = self._codificar(datos)
+        t1 = time.time()
+
+        self.build_time = t1 - t0
+
+    def _codificar(self, datos) -> numpy.ndarray:
+        # códigos de todos los frames, en el orden de las listas si hay índice invertido
+        codigos = numpy.empty((datos.shape[0], len(self.cortes)), dtype=numpy.uint8)
+        filas = max(self.memoria_max // (4 * (self.dimension + ProductoCuantizado.CENTROIDES)), 1)
+
+        for inicio in range(0, datos.shape[0], filas):
+            fin = min(inicio + filas, datos.shape[0])
+            if self.ids is None:
+                bloque = numpy.asarray(datos[inicio:fin], dtype=numpy.float32)
+            else:
+                bloque = numpy.asarray(datos[numpy.sort(self.ids[inicio:fin])], dtype=numpy.float32)
+                bloque = bloque[numpy.argsort(numpy.argsort(self.ids[inicio:fin]))]
+
+            for j, (a, b) in enumerate(self.cortes):
+                codigos[inicio:fin, j] = asignar(bloque[:, a:b], self.diccionarios[j])
+
+        return codigos
+
+    def memoria(self) -> int:
+        """
+        :return: bytes ocupados por el índice (códigos, diccionarios y listas), sin contar los vectores originales.
+        """
+        total = self.codigos.nbytes + sum(diccionario.nbytes for diccionario in self.diccionarios)
+        if self.listas > 0:
+            total += self.ids.nbytes + self.limites.nbytes + self.gruesos.nbytes
+
+        return total
+
+    def _tablas(self, busquedas: numpy.ndarray) -> numpy.ndarray:
+        # tabla (n, subespacios, centroides) con la distancia de cada búsqueda a cada centroide de cada subespacio
+        tablas = numpy.full((busquedas.shape[0], len(self.cortes), ProductoCuantizado.CENTROIDES), numpy.inf,
+                            dtype=numpy.float32)
+
+        for j, (a, b) in enumerate(self.cortes):
+            diccionario = self.diccionarios[j]
+            parte = busquedas[:, a:b]
+
+            dists = parte @ diccionario.T
+            dists *= -2
+            dists += numpy.einsum('ij,ij->i', parte, parte)[:, None]
+            dists += numpy.einsum('ij,ij->i', diccionario, diccionario)[None, :]
+            tablas[:, j, :diccionario.shape[0]] = numpy.maximum(dists, 0)
+
+        return tablas
+
+    def _recorrer(self, tablas, mejores, mejores_distancias, consultas, inicio: int, fin: int, n: int):
+        # junta los frames [inicio, fin) de los códigos con los mejores candidatos de las consultas dadas
+        tablas = tablas[consultas]
+        filas = max(self.memoria_max // (8 * tablas.shape[0]), 1)
+
+        for a in range(inicio, fin, filas):
+            b = min(a + filas, fin)
+            codigos = self.codigos[a:b]
+
+            dists = numpy.zeros((tablas.shape[0], b - a), dtype=numpy.float32)
+            for j in range(codigos.shape[1]):
+                dists += numpy.take(tablas[:, j, :], codigos[:, j], axis=1)
+
+            ids = numpy.arange(a, b) if self.ids is None else self.ids[a:b]
+            candidatos = numpy.concatenate((mejores[consultas], numpy.broadcast_to(ids, dists.shape)), axis=1)
+            dists = numpy.concatenate((mejores_distancias[consultas], dists), axis=1)
+            mejores[consultas], mejores_distancias[consultas] = k_mejores(candidatos, dists, n, ordenar=False)
+
+    def _sondear(self, busquedas: numpy.ndarray, n: int) -> numpy.ndarray:
+        """
+        Elige las listas a recorrer por cada búsqueda: las sondas listas más cercanas, o más si hacen falta para
+        juntar al menos n frames.
+
+        :return: matriz booleana (busquedas, listas).
+        """
+        dists = busquedas @ self.gruesos.T
+        dists *= -2
+        dists += numpy.einsum('ij,ij->i', self.gruesos, self.gruesos)[None, :]
+        orden = numpy.argsort(dists, axis=1)
+
+        tamanos = numpy.diff(self.limites)[orden]
+        necesarias = (numpy.cumsum(tamanos, axis=1) < n).sum(axis=1) + 1
+        necesarias = numpy.minimum(numpy.maximum(necesarias, self.sondas), self.gruesos.shape[0])
+
+        mascara = numpy.zeros(dists.shape, dtype=bool)
+        filas = numpy.arange(dists.shape[0])
+        for posicion in range(int(necesarias.max())):
+            activas = filas[necesarias > posicion]
+            mascara[activas, orden[activas, posicion]] = True
+
+        return mascara
+
+    def search(self, busquedas, k=1, checks=10, distancias=False):
+        """
+        Busca los k vecinos más cercanos aproximados de una o varias búsquedas. checks se ignora, la precisión
+        depende de sondas y reordenar.
+
+        :return: una matriz (n, k) con los índices de los vecinos de cada búsqueda, y si se piden las distancias,
+        otra matriz (n, k) con la distancia (aproximada, o exacta si se reordena) a cada vecino.
+        """
+        busquedas = numpy.asarray(busquedas, dtype=numpy.float32).reshape(-1, self.dimension)
+        tablas = self._tablas(busquedas)
+        n = min(max(k, self.reordenar), self.codigos.shape[0])
+
+        mejores = numpy.full((busquedas.shape[0], n), -1, dtype=numpy.int64)
+        mejores_distancias = numpy.full((busquedas.shape[0], n), numpy.inf, dtype=numpy.float32)
+
+        if self.listas > 0:
+            mascara = self._sondear(busquedas, n)
+            for lista in numpy.flatnonzero(mascara.any(axis=0)).tolist():
+                self._recorrer(tablas, mejores, mejores_distancias, numpy.flatnonzero(mascara[:, lista]),
+                               self.limites[lista], self.limites[lista + 1], n)
+        else:
+            self._recorrer(tablas, mejores, mejores_distancias, slice(None), 0, self.codigos.shape[0], n)
+
+        if self.reordenar > 0:
+            mejores_distancias = self._distancias_exactas(busquedas, mejores)
+
+        results, dists = k_mejores(mejores, mejores_distancias, k)
+        results = results.astype(numpy.int32)
+
+        if distancias:
+            return results, dists
+
+        return results
+
+    def _distancias_exactas(self, busquedas: numpy.ndarray, candidatos: numpy.ndarray) -> numpy.ndarray:
+        # distancia exacta de cada búsqueda a sus candidatos, leyendo solo los vectores de los candidatos
+        dists = numpy.empty(candidatos.shape, dtype=numpy.float32)
+        filas = max(self.memoria_max // (4 * candidatos.shape[1] * self.dimension), 1)
+
+        for inicio in range(0, candidatos.shape[0], filas):
+            fin = min(inicio + filas, candidatos.shape[0])
+            ids = candidatos[inicio:fin].ravel()
+            unicos, posiciones = numpy.unique(ids, return_inverse=True)
+
+            vectores = numpy.asarray(self.datos[unicos], dtype=numpy.float32)[posiciones]
+            diferencias = vectores.reshape(fin - inicio, candidatos.shape[1], -1) - busquedas[inicio:fin, None, :]
+            dists[inicio:fin] = numpy.einsum('ijk,ijk->ij', diferencias, diferencias)
+
+        return dists
+
+
+def comparar_memoria(carpeta: str, tamano=(10, 10), k: int = 20, checks: int = 500, n_busquedas: int = 1000,
+                     ruido: float = 4.0):
+    """
+    Compara la memoria, el tiempo y el recall@k de varias configuraciones de ProductoCuantizado contra el KDTree
+    actual, con el índice Exacto como referencia. Las búsquedas son frames del corpus al azar con ruido gaussiano,
+    para simular frames reencodeados.
+
+    :param carpeta: la carpeta con las características del corpus.
+    :param tamano: el tamaño de las características.
+    :param k: el número de vecinos a buscar.
+    :param checks: el número de checks de la búsqueda del KDTree.
+    :param n_busquedas: número de búsquedas.
+    :param ruido: desviación estándar del ruido agregado a las búsquedas.
+    """
+    etiquetas, caracteristicas = agrupar_caracteristicas(carpeta, recargar=True, tamano=tamano)
+
+    busquedas = muestra_busquedas(caracteristicas, n_busquedas, ruido=ruido)
+
+    oraculo = Exacto(caracteristicas, etiquetas)
+    print(f'{caracteristicas.shape[0]} frames de dimensión {caracteristicas.shape[1]}: '
+          f'{caracteristicas.shape[0] * caracteristicas.shape[1] * 4 / 2 ** 20:.1f} MB como int32, '
+          f'{caracteristicas.nbytes / 2 ** 20:.1f} MB como uint8')
+
+    configuraciones = [
+        ('PQ m=10', dict(subespacios=10)),
+        ('PQ m=20', dict(subespacios=20)),
+        ('PQ m=20 reordenar=100', dict(subespacios=20, reordenar=100)),
+        ('IVF 256/16 PQ m=20 reordenar=100', dict(subespacios=20, listas=256, sondas=16, reordenar=100)),
+    ]
+
+    indices = [(nombre, lambda parametros=parametros: ProductoCuantizado(caracteristicas, etiquetas, **parametros))
+               for nombre, parametros in configuraciones]
+    if pyflann is not None:
+        indices.insert(0, ('KDTree trees=10', lambda: KDTree(caracteristicas, etiquetas, trees=10, cores=0)))
+    else:
+        print('pyflann no está instalado, no se compara con KDTree')
+
+    for nombre, construir in indices:
+        indice = construir()
+
+        t0 = time.time()
+        indice.search(busquedas, k=k, checks=checks)
+        t1 = time.time()
+        recall = medir_recall(indice, oraculo, busquedas, k=k, checks=checks)
+
+        if isinstance(indice, ProductoCuantizado):
+            memoria = f'{indice.memoria() / 2 ** 20:.1f} MB ({indice.memoria() / caracteristicas.shape[0]:.1f} ' \
+                      f'bytes por frame)'
+        else:
+            memoria = f'{caracteristicas.nbytes / 2 ** 20:.1f} MB de vectores + árboles'
+
+        print(f'{nombre}: memoria {memoria}, construcción {indice.build_time:.1f} s, '
+              f'{busquedas.shape[0] / (t1 - t0):.0f} búsquedas/s, recall@{k} {recall:.3f}')
+
+
+if __name__ == '__main__':
+    comparar_memoria(sys.argv[1] if len(sys.argv) > 1 else '../videos/Shippuden_car_(10, 10)_6')
@@ -1,61 +1,111 @@
+import bisect
+import copy
+import heapq
 import os
 import re
 import sys
 import time
 from typing import List
 
+import numpy
+
+from Metricas import contar, etapa
+from Resultados import ResultadosKNN
+
 
 class Frame:
-    def __init__(self, video, tiempo, indice):
+    __slots__ = ('video', 'indice', 'tiempo')
+
+    def __init__(self, video: int, tiempo, indice):
         self.video = video
         self.indice = indice
         self.tiempo = tiempo
 
 
 class Cercanos:
-    def __init__(self, tiempo: float, frames: List[Frame]):
+    """
+    Frames más cercanos a un frame del video, como columnas paralelas (ids de video, números de frame y tiempos)
+    en vez de un objeto por frame. Si el índice tiene tramos de frames colapsados, indices_fin tiene el número del
+    último frame del tramo de cada cercano (si no, es igual a indices).
+    """
+    __slots__ = ('tiempo', 'videos', 'indices', 'tiempos', 'indices_fin')
+
+    def __init__(self, tiempo: float, videos: List[int], indices: List[int], tiempos: List[float],
+                 indices_fin: List[int] = None):
         self.tiempo = tiempo
-        self.frames = frames
+        self.videos = videos
+        self.indices = indices
+        self.tiempos = tiempos
+        self.indices_fin = indices if indices_fin is None else indices_fin
 
+    @property
+    def frames(self) -> List[Frame]:
+        return [Frame(video=v, tiempo=t, indice=j) for v, t, j in zip(self.videos, self.tiempos, self.indices)]
 
-def leer_cercanos(video: str) -> List[Cercanos]:
-    """
-    Lee un archivo que contiene los frames más cercanos a cada frame de un video. Cada linea debe tener el siguiente
-    formato: 'tiempo $ comercial # tiempo # indice | comercial # tiempo # indice | ...'.
 
-    :param video: nombre del archivo que contiene la información
-
-    :return: una lista de Cercanos, objeto que almacena la información de una linea.
+class TablaCercanos:
+    """
+    Frames más cercanos a cada frame de un video, respaldados por las columnas de un ResultadosKNN. Los ids se
+    resuelven en la tabla de etiquetas una sola vez, y los Cercanos de cada frame se crean al recorrerla. Los ids -1
+    (posiciones sin vecino) quedan con video -1, que no se sigue en la búsqueda de secuencias.
     """
-    cercanos = []
 
-    with open(video, 'r') as log:
-        for linea in log:
-            # separar tiempo de los frames.
-            tiempo, datos = linea.split(' $ ')
+    def __init__(self, resultados: ResultadosKNN):
+        self.resultados = resultados
+        self.etiquetas = resultados.etiquetas
+
+        ids = numpy.asarray(resultados.ids, dtype=numpy.int64)
+        tabla = resultados.etiquetas[numpy.maximum(ids, 0)]
+        self.tiempos = numpy.asarray(resultados.tiempos)
+        self.videos = numpy.where(ids < 0, -1, tabla['video'])
+        self.indices = tabla['indice']
+        self.tiempos_frames = tabla['tiempo']
+
+        # fin de cada tramo, solo si el índice tiene tramos colapsados
+        self.tramos = self.etiquetas.tramos
+        self.indices_fin = tabla['indice_fin'] if self.tramos else self.indices
+        self.tiempos_fin = tabla['tiempo_fin'] if self.tramos else self.tiempos_frames
+
+    def __len__(self):
+        return self.tiempos.shape[0]
+
+    def __getitem__(self, i: int) -> Cercanos:
+        return Cercanos(float(self.tiempos[i]), self.videos[i].tolist(), self.indices[i].tolist(),
+                        self.tiempos_frames[i].tolist(), self.indices_fin[i].tolist() if self.tramos else None)
+
+    def __iter__(self):
+        columnas = (self.tiempos.tolist(), self.videos.tolist(), self.indices.tolist(), self.tiempos_frames.tolist())
+        if not self.tramos:
+            for tiempo, videos, indices, tiempos in zip(*columnas):
+                yield Cercanos(tiempo, videos, indices, tiempos)
+            return
+
+        for tiempo, videos, indices, tiempos, indices_fin in zip(*columnas, self.indices_fin.tolist()):
+            yield Cercanos(tiempo, videos, indices, tiempos, indices_fin)
 
-            # parsear tiempo y separar frames.
-            tiempo = float(tiempo)
-            datos = datos.split(' | ')
 
-            # parsear frames.
-            frames = []
-            for frame in datos:
-                video, tiempo_frame, indice = frame.split(' # ')
-                frames.append(Frame(video=video, tiempo=float(tiempo_frame), indice=int(indice)))
+def leer_cercanos(video: str) -> TablaCercanos:
+    """
+    Lee los frames más cercanos a cada frame de un video, guardados en formato binario (una carpeta) o de texto
+    (ver ResultadosKNN).
 
-            # agregar linea parseada a la lista
-            cercanos.append(Cercanos(frames=frames, tiempo=tiempo))
+    :param video: nombre de la carpeta o archivo que contiene la información
 
-    return cercanos
+    :return: una TablaCercanos, que entrega un Cercanos por frame del video.
+    """
+    return TablaCercanos(ResultadosKNN.cargar(video))
 
 
 class Candidato:
 
-    def __init__(self, video: str, indice: int, tiempo_inicio: float, tiempo_clip_inicio: float):
+    def __init__(self, video: int, indice: int, tiempo_inicio: float, tiempo_clip_inicio: float,
+                 fin_tramo: int = None):
         self.video = video
         self.indice = indice
 
+        # último frame del tramo colapsado del último acierto, None si no era un tramo
+        self.fin_tramo = fin_tramo
+
         self.tiempo_inicio = tiempo_inicio
         self.tiempo_clip_inicio = tiempo_clip_inicio
         self.duracion = 0
@@ -67,17 +117,30 @@ class Candidato:
     def buscar_siguiente(self, cercanos: Cercanos, rango: int = 0):
         self.indice += 1
 
-        for frame in cercanos.frames:
+        for j, (video, indice, indice_fin) in enumerate(zip(cercanos.videos, cercanos.indices, cercanos.indices_fin)):
+            if self.video != video:
+                continue
+
+            # buscar índice en el rando (o dentro del tramo)
+            if (indice - rango) <= self.indice <= (indice_fin + rango):
+                pass
+
+            # el frame siguiente a un tramo: el clip pudo empezar en medio del tramo, sincronizar con este frame
+            elif self.fin_tramo is not None and (indice - rango) <= self.fin_tramo + 1 <= (indice + rango):
+                self.indice = indice
+                self.tiempo_inicio = cercanos.tiempos[j] - (cercanos.tiempo - self.tiempo_clip_inicio)
 
-            # buscar índice en el rando
-            if self.video == frame.video and (frame.indice - rango) <= self.indice <= (frame.indice + rango):
-                self.duracion = cercanos.tiempo - self.tiempo_clip_inicio
-                self.errores_continuos = 0
-                self.aciertos += 1
+            else:
+                continue
 
-                # seguir buscando si no es mayor o igual al índice buscar
-                if frame.indice >= self.indice:
-                    return
+            self.duracion = cercanos.tiempo - self.tiempo_clip_inicio
+            self.errores_continuos = 0
+            self.aciertos += 1
+            self.fin_tramo = indice_fin if indice_fin > indice else None
+
+            # seguir buscando si no es mayor o igual al índice buscar
+            if indice_fin >= self.indice:
+                return
 
         self.errores_continuos += 1
         self.errores += 1
@@ -109,124 +172,670 @@ class Candidato:
         self.tiempo_inicio = min(self.tiempo_inicio, cand.tiempo_inicio)
         return
 
-    def __str__(self):
-        return f'{self.tiempo_clip_inicio:.2f} {self.duracion:.2f} {self.video} {self.tiempo_inicio:.2f}'
+    def texto(self, nombres: List[str]):
+        return f'{self.tiempo_clip_inicio:.2f} {self.duracion:.2f} {nombres[self.video]} {self.tiempo_inicio:.2f}'
 
 
-def buscar_secuencias(video: str, max_errores_continuos: int = 7, tiempo_minimo: float = 1, max_offset: float = 0.0):
+def secuencias_candidatos(lista_cercanos: TablaCercanos, max_errores_continuos: int = 7, tiempo_minimo: float = 1,
+                          rango: int = 1) -> List[Candidato]:
     """
-    Busca comerciales en un archivo que contiene los k frames más cercanos a cada frame de un video y los registra en
-    un archivo.
+    Busca secuencias siguiendo un Candidato por cada frame cercano, frame a frame.
 
-    :param video: la ubicación del archivo.
+    :param lista_cercanos: los frames más cercanos a cada frame del video.
     :param max_errores_continuos: máximos errores continuos para determinar que un clip terminó.
     :param tiempo_minimo: tiempo mínimo para afirmar que un clip es válido.
-    :param max_offset: máxima distancia entre clips al combinarlos
+    :param rango: diferencia máxima entre el índice esperado y el encontrado para considerarlo un acierto.
+
+    :return: la lista de clips válidos, en el orden en que terminaron.
     """
+    detector = DetectorIncremental(max_errores_continuos=max_errores_continuos, tiempo_minimo=tiempo_minimo,
+                                   rango=rango)
 
-    # nombre del video
-    nombre_video = re.split('[/.]', video)[-2]
-    print(f'buscando clips en {nombre_video}')
-    t0 = time.time()
+    clips = []
+    for cercanos in lista_cercanos:
+        clips.extend(detector.procesar(cercanos))
+
+    return clips
 
-    # leer cercanos del video.
-    lista_cercanos = leer_cercanos(video)
 
-    # lista de candidatos para buscar comerciales
-    candidatos = []
+def secuencias_votos(lista_cercanos: TablaCercanos, max_errores_continuos: int = 7, tiempo_minimo: float = 1,
+                     rango: int = 1) -> List[Candidato]:
+    """
+    Busca secuencias votando por diagonales: cada frame cercano vota por el par (video, offset entre el índice del
+    frame y el del frame del video), y una secuencia es una racha de votos en una misma diagonal.
+
+    Sin tramos colapsados entrega los mismos clips que secuencias_candidatos, en el mismo orden, reproduciendo su
+    contabilidad (ver Candidato.buscar_siguiente):
+
+    - una racha empieza en un voto exacto de su diagonal, y acepta votos a distancia rango de ella.
+    - en cada frame se cuenta un acierto por cada voto aceptado hasta el primero de una diagonal mayor o igual a la
+      de la racha (en el orden de los cercanos), o por todos si no hay uno así.
+    - un frame sin votos de una diagonal mayor o igual cuenta un error. Si tenía votos de una diagonal menor, los
+      errores continuos quedan en 1, si no, aumentan en 1.
+    - la racha termina cuando los errores continuos llegan a max_errores_continuos, y es válida si dura más de
+      tiempo_minimo, tiene al menos tantos aciertos como errores menos max_errores_continuos y terminó antes del
+      final del video.
+
+    Con tramos colapsados, un cercano vota una vez por cada frame de su tramo, con su tiempo interpolado, en vez de
+    aceptar cualquier índice dentro del tramo y sincronizarse con el frame siguiente al tramo como un Candidato, por
+    lo que los clips pueden diferir.
+
+    :param lista_cercanos: los frames más cercanos a cada frame del video.
+    :param max_errores_continuos: máximos errores continuos para determinar que un clip terminó.
+    :param tiempo_minimo: tiempo mínimo para afirmar que un clip es válido.
+    :param rango: diferencia máxima entre la diagonal de un voto y la de la racha para considerarlo un acierto.
+
+    :return: la lista de clips válidos, en el orden en que terminaron.
+    """
+    n, k = lista_cercanos.videos.shape
+    if n == 0 or k == 0:
+        return []
+
+    # un voto por frame cercano, con su posición entre los cercanos del frame, sin las posiciones sin vecino
+    vecinos = lista_cercanos.videos.ravel() >= 0
+    if not vecinos.any():
+        return []
+
+    frames = numpy.repeat(numpy.arange(n, dtype=numpy.int64), k)[vecinos]
+    posiciones = numpy.tile(numpy.arange(k, dtype=numpy.int64), n)[vecinos]
+    videos = lista_cercanos.videos.ravel()[vecinos].astype(numpy.int64)
+    indices = lista_cercanos.indices.ravel()[vecinos].astype(numpy.int64)
+    tiempos_frames = lista_cercanos.tiempos_frames.ravel()[vecinos]
+
+    if lista_cercanos.tramos:
+        largos = lista_cercanos.indices_fin.ravel()[vecinos].astype(numpy.int64) - indices + 1
+        duraciones_frame = (lista_cercanos.tiempos_fin.ravel()[vecinos] - tiempos_frames) / \
+            numpy.maximum(largos - 1, 1)
+        pasos = numpy.arange(largos.sum()) - numpy.repeat(numpy.cumsum(largos) - largos, largos)
+
+        frames = numpy.repeat(frames, largos)
+        posiciones = numpy.repeat(posiciones, largos)
+        videos = numpy.repeat(videos, largos)
+        indices = numpy.repeat(indices, largos) + pasos
+        tiempos_frames = numpy.repeat(tiempos_frames, largos) + pasos * numpy.repeat(duraciones_frame, largos)
+
+    # cada voto se repite en las diagonales a distancia rango: es exacto en la suya, y es de una diagonal mayor o
+    # igual en las diagonales menores
+    diagonales = indices - frames
+    votos = frames.shape[0]
+
+    desplazamientos = range(-rango, rango + 1)
+    frames = numpy.tile(frames, len(desplazamientos))
+    posiciones = numpy.tile(posiciones, len(desplazamientos))
+    videos = numpy.tile(videos, len(desplazamientos))
+    indices = numpy.tile(indices, len(desplazamientos))
+    tiempos_frames = numpy.tile(tiempos_frames, len(desplazamientos))
+    exactos = numpy.concatenate([numpy.full(votos, d == 0) for d in desplazamientos])
+    mayores = numpy.concatenate([numpy.full(votos, d <= 0) for d in desplazamientos])
+    diagonales = numpy.concatenate([diagonales + d for d in desplazamientos])
+
+    # una clave por diagonal de cada video
+    diagonales -= diagonales.min()
+    claves = videos * (diagonales.max() + 1) + diagonales
+
+    # ordenar por diagonal, frame y posición, y agrupar los votos de cada diagonal en cada frame
+    orden = numpy.lexsort((posiciones, frames, claves))
+    claves, frames, posiciones, exactos, mayores, indices, tiempos_frames = \
+        claves[orden], frames[orden], posiciones[orden], exactos[orden], mayores[orden], indices[orden], \
+        tiempos_frames[orden]
+
+    grupos = numpy.ones(claves.shape[0], dtype=bool)
+    grupos[1:] = (claves[1:] != claves[:-1]) | (frames[1:] != frames[:-1])
+    grupos = numpy.flatnonzero(grupos)
+    por_grupo = numpy.diff(numpy.append(grupos, claves.shape[0]))
+
+    # aciertos de cada grupo: los votos hasta el primero de una diagonal mayor o igual, o todos si no hay
+    sin_mayor = k + 1
+    primer_mayor = numpy.minimum.reduceat(numpy.where(mayores, posiciones, sin_mayor), grupos)
+    aciertos_grupo = numpy.add.reduceat(posiciones <= numpy.repeat(primer_mayor, por_grupo), grupos)
+    aciertos_grupo[primer_mayor == sin_mayor] = por_grupo[primer_mayor == sin_mayor]
+    con_mayor = primer_mayor < sin_mayor
+
+    # primer voto exacto de cada grupo, donde puede empezar una racha
+    votos_grupo = claves.shape[0]
+    primer_exacto = numpy.minimum.reduceat(numpy.where(exactos, numpy.arange(votos_grupo), votos_grupo), grupos)
+
+    claves, frames = claves[grupos], frames[grupos]
+    grupos_total = claves.shape[0]
+
+    # errores continuos tras cada grupo, y separar rachas: cambio de diagonal o errores continuos que llegan al máximo
+    continuos = numpy.where(con_mayor, 0, 1)
+    nueva = numpy.ones(grupos_total, dtype=bool)
+    nueva[1:] = (claves[1:] != claves[:-1]) | (frames[1:] - frames[:-1] > max_errores_continuos - continuos[:-1])
+    inicios_rachas = numpy.flatnonzero(nueva)
+    fines = numpy.append(inicios_rachas[1:], grupos_total) - 1
+
+    # cada racha empieza en su primer grupo con un voto exacto
+    con_exacto = numpy.where(primer_exacto < votos_grupo, numpy.arange(grupos_total), grupos_total)
+    inicios = numpy.minimum.reduceat(con_exacto, inicios_rachas)
+    con_inicio = inicios <= fines
+    inicios, fines = inicios[con_inicio], fines[con_inicio]
+    contar('candidatos', inicios.shape[0])
+
+    # aciertos y errores después del grupo de inicio (el Candidato se crea al final de su primer frame)
+    acumulados_aciertos = numpy.cumsum(aciertos_grupo)
+    acumulados_mayores = numpy.cumsum(con_mayor)
+    aciertos = acumulados_aciertos[fines] - acumulados_aciertos[inicios]
+    frame_inicio, frame_fin = frames[inicios], frames[fines]
+    frame_termino = frame_fin + max_errores_continuos - continuos[fines]
+    errores = frame_termino - frame_inicio - (acumulados_mayores[fines] - acumulados_mayores[inicios])
+
+    # reglas de validez (con tiempos en float64, igual que los Candidato)
+    tiempos = lista_cercanos.tiempos.astype(numpy.float64)
+    duraciones = tiempos[frame_fin] - tiempos[frame_inicio]
+    validos = (duraciones > tiempo_minimo) & (aciertos >= errores - max_errores_continuos) & (frame_termino <= n - 1)
+    validos = numpy.flatnonzero(validos)
+
+    # ordenar por el frame en que termina cada clip, y luego por el orden en que se creó
+    exacto_inicio = primer_exacto[inicios]
+    validos = validos[numpy.lexsort((posiciones[exacto_inicio[validos]], frame_inicio[validos],
+                                     frame_termino[validos]))]
+
     clips = []
+    for i in validos.tolist():
+        exacto = exacto_inicio[i]
+        clip = Candidato(video=int(videos[orden[exacto]]),
+                         indice=int(indices[exacto] + frame_termino[i] - frame_inicio[i]),
+                         tiempo_inicio=float(tiempos_frames[exacto]),
+                         tiempo_clip_inicio=float(tiempos[frame_inicio[i]]))
+        clip.duracion = float(duraciones[i])
+        clip.aciertos = int(aciertos[i])
+        clip.errores = int(errores[i])
+        clips.append(clip)
 
-    # abrir log
-    nombre = re.split('[/.]', video)[-2]
-    if not os.path.isdir('../videos/AMV_results'):
-        os.mkdir('../videos/AMV_results')
-    log = open(f'../videos/AMV_results/{nombre}.txt', 'w')
+    return clips
+
+
+class _ExtensionesClips:
+    """
+    Clips de un video ordenados por tiempo_clip_inicio y por fin, para buscar el primer clip de la lista que puede
+    extender a una extensión dada (ver Candidato.combinar). Un clip que la extiende empieza dentro de la extensión y
+    termina después, o empieza antes y termina dentro, así que solo se recorren los clips que empiezan o terminan
+    dentro de la extensión, encontrados por búsqueda binaria.
+    """
+
+    def __init__(self, clips: List[Candidato]):
+        self.clips = clips
+        self.fines = [clip.tiempo_clip_inicio + clip.duracion for clip in clips]
+
+        self.por_inicio = sorted(range(len(clips)), key=lambda j: clips[j].tiempo_clip_inicio)
+        self.inicios = [clips[j].tiempo_clip_inicio for j in self.por_inicio]
+
+        self.por_fin = sorted(range(len(clips)), key=lambda j: self.fines[j])
+        self.fines_ordenados = [self.fines[j] for j in self.por_fin]
+
+    def siguiente(self, pos_min: int, inicio: float, fin: float, offset: float, holgura: float) -> int:
+        """
+        :return: la posición en la lista del primer clip después de pos_min que puede extender la extensión
+        [inicio, fin) con el offset dado (a menos de holgura), o -1 si no hay.
+        """
+        mejor = len(self.clips)
+
+        # clips que empiezan dentro de la extensión y terminan después
+        desde = bisect.bisect_right(self.inicios, inicio)
+        hasta = bisect.bisect_left(self.inicios, fin)
+        for j in self.por_inicio[desde:hasta]:
+            if pos_min < j < mejor and self.fines[j] > fin and \
+                    abs(self.clips[j].tiempo_inicio - self.clips[j].tiempo_clip_inicio - offset) <= holgura:
+                mejor = j
+
+        # clips que empiezan antes de la extensión y terminan dentro
+        desde = bisect.bisect_right(self.fines_ordenados, inicio)
+        hasta = bisect.bisect_left(self.fines_ordenados, fin)
+        for j in self.por_fin[desde:hasta]:
+            if pos_min < j < mejor and self.clips[j].tiempo_clip_inicio < inicio and \
+                    abs(self.clips[j].tiempo_inicio - self.clips[j].tiempo_clip_inicio - offset) <= holgura:
+                mejor = j
+
+        return mejor if mejor < len(self.clips) else -1
+
+
+def combinar_clips(clips: List[Candidato], max_offset: float) -> List[Candidato]:
+    """
+    Combina los clips sobrepuestos del mismo video (ver Candidato.combinar). Cada clip absorbe, en el orden de la
+    lista, a los clips posteriores del mismo video sobrepuestos a su extensión actual, igual que comparar todos los
+    pares de la lista (ver comprobar_combinacion).
+
+    Combinar con un clip que contiene o está contenido en la extensión, o con otro offset, no cambia nada, así que
+    cada clip solo visita los clips que lo extienden: el siguiente se busca entre los clips ordenados por inicio y
+    por fin (ver _ExtensionesClips), recorriendo solo los que empiezan o terminan dentro de la extensión actual, en
+    vez de comparar todos los pares. Con m clips por video y pocos clips sobrepuestos entre sí queda en O(m log m).
+
+    :param clips: lista de clips, se modifican en el lugar.
+    :param max_offset: máxima distancia entre clips al combinarlos.
+
+    :return: la misma lista de clips.
+    """
+    por_video = {}
+    for clip in clips:
+        por_video.setdefault(clip.video, []).append(clip)
+
+    for grupo in por_video.values():
+        if len(grupo) < 2:
+            continue
+
+        # se guardan las extensiones originales, que son las que ve cada clip al absorber a los posteriores
+        extensiones = _ExtensionesClips(grupo)
+        for i, cand1 in enumerate(grupo):
+            j = i
+            while True:
+                inicio, fin = cand1.tiempo_clip_inicio, cand1.tiempo_clip_inicio + cand1.duracion
+                offset = cand1.tiempo_inicio - cand1.tiempo_clip_inicio
+                holgura = max_offset + 1e-6 * (1 + abs(offset))
+
+                j = extensiones.siguiente(j, inicio, fin, offset, holgura)
+                if j < 0:
+                    break
+
+                # se comparan offsets con holgura, combinar verifica el offset exacto
+                cand1.combinar(grupo[j], max_offset)
+
+    return clips
+
+
+def eliminar_sobrepuestos(clips: List[Candidato]) -> List[Candidato]:
+    """
+    Elimina los clips sobrepuestos a un clip más largo (sin importar el video), dejando solo el más largo. Entre
+    clips de igual duración se mantiene el que está después en la lista. Los clips deben tener duración positiva.
+
+    Recorre los clips ordenados por tiempo de inicio: los clips anteriores que siguen abiertos se mantienen en un heap
+    por prioridad, y los posteriores que empiezan antes de que termine el clip actual se consultan con una sparse table
+    de máximos por rango, en O(n log n).
+
+    :param clips: lista de clips.
+
+    :return: una nueva lista con los clips que no están sobrepuestos a uno más largo, en el orden original.
+    """
+    n = len(clips)
+    if n < 2:
+        return list(clips)
+
+    inicios = numpy.array([clip.tiempo_clip_inicio for clip in clips], dtype=numpy.float64)
+    duraciones = numpy.array([clip.duracion for clip in clips], dtype=numpy.float64)
+    fines = inicios + duraciones
+
+    # prioridad de cada clip: mayor duración, y en empate, posición posterior en la lista
+    prioridades = numpy.empty(n, dtype=numpy.int64)
+    prioridades[numpy.lexsort((numpy.arange(n), duraciones))] = numpy.arange(n)
+
+    orden = numpy.argsort(inicios, kind='stable')
+    inicios_orden, fines_orden, prioridades_orden = inicios[orden], fines[orden], prioridades[orden]
+
+    # máxima prioridad de los clips posteriores en el orden que empiezan antes del fin de cada clip
+    tabla = [prioridades_orden]
+    while 2 ** len(tabla) <= n:
+        anterior, salto = tabla[-1], 2 ** (len(tabla) - 1)
+        tabla.append(numpy.maximum(anterior[:-salto], anterior[salto:]))
+
+    bajos = numpy.arange(1, n + 1)
+    altos = numpy.maximum(numpy.searchsorted(inicios_orden, fines_orden, side='left'), bajos)
+    largos = altos - bajos
+
+    maximos_despues = numpy.full(n, -1, dtype=numpy.int64)
+    con_rango = largos > 0
+    niveles = numpy.zeros(n, dtype=numpy.int64)
+    niveles[con_rango] = numpy.floor(numpy.log2(largos[con_rango])).astype(numpy.int64)
+    for nivel in numpy.unique(niveles[con_rango]).tolist():
+        seleccion = con_rango & (niveles == nivel)
+        fila = tabla[nivel]
+        maximos_despues[seleccion] = numpy.maximum(fila[bajos[seleccion]], fila[altos[seleccion] - 2 ** nivel])
+
+    # máxima prioridad de los clips anteriores en el orden que siguen abiertos al inicio de cada clip
+    abiertos = []
+    eliminado = numpy.zeros(n, dtype=bool)
+    for posicion in range(n):
+        while abiertos and abiertos[0][1] <= inicios_orden[posicion]:
+            heapq.heappop(abiertos)
+
+        maximo = maximos_despues[posicion]
+        if abiertos:
+            maximo = max(maximo, -abiertos[0][0])
+
+        eliminado[orden[posicion]] = maximo > prioridades_orden[posicion]
+        heapq.heappush(abiertos, (-prioridades_orden[posicion], fines_orden[posicion]))
+
+    return [clip for clip, eliminar in zip(clips, eliminado.tolist()) if not eliminar]
+
+
+def comprobar_combinacion(pruebas: int = 3000, max_clips: int = 30, semilla: int = 0):
+    """
+    Compara combinar_clips y eliminar_sobrepuestos con la comparación de todos los pares de la lista en conjuntos de
+    clips aleatorios, y lanza una excepción si algún resultado es distinto.
+
+    :param pruebas: número de conjuntos de clips.
+    :param max_clips: máximo número de clips por conjunto.
+    :param semilla: semilla de los números aleatorios.
+    """
+    rng = numpy.random.default_rng(semilla)
+
+    def pares(clips: List[Candidato], max_offset: float) -> List[Candidato]:
+        for i in range(len(clips)):
+            for j in range(i + 1, len(clips)):
+                if clips[i].video == clips[j].video and clips[i].sobrepuesto(clips[j]):
+                    clips[i].combinar(clips[j], max_offset)
+
+        sobrepuestos = set()
+        for i in range(len(clips)):
+            for j in range(i + 1, len(clips)):
+                if clips[i].sobrepuesto(clips[j]):
+                    sobrepuestos.add(clips[j] if clips[i].duracion > clips[j].duracion else clips[i])
+
+        return [clip for clip in clips if clip not in sobrepuestos]
+
+    def texto(clips: List[Candidato]) -> list:
+        return [(c.video, c.tiempo_clip_inicio, c.duracion, c.tiempo_inicio) for c in clips]
+
+    for prueba in range(pruebas):
+        clips = []
+        for _ in range(int(rng.integers(1, max_clips + 1))):
+            # tiempos en centésimas, para tener empates y offsets cercanos
+            inicio = int(rng.integers(0, 6000)) / 100
+            clip = Candidato(video=int(rng.integers(0, 3)), indice=0,
+                             tiempo_inicio=inicio + int(rng.integers(0, 30)) / 100, tiempo_clip_inicio=inicio)
+            clip.duracion = int(rng.integers(1, 1000)) / 100
+            clips.append(clip)
+
+        esperado = pares([copy.copy(clip) for clip in clips], 0.15)
+        obtenido = eliminar_sobrepuestos(combinar_clips([copy.copy(clip) for clip in clips], 0.15))
+        if texto(esperado) != texto(obtenido):
+            raise Exception(f'la combinación difiere de la comparación por pares en la prueba {prueba}')
+
+    print(f'combinación igual a la comparación por pares en {pruebas} pruebas')
+    return
+
+
+class DetectorIncremental:
+    """
+    Búsqueda de secuencias con candidatos que recibe los frames cercanos de a poco, para procesar un video sin
+    tenerlo completo en memoria.
+
+    procesar entrega los clips válidos apenas terminan sus candidatos, sin combinar. agregar y terminar además los
+    combinan y eliminan los sobrepuestos, entregando cada clip en cuanto ningún clip futuro puede afectarlo.
+
+    Los clips pendientes se agrupan en componentes con extensiones disjuntas (sin importar el video), donde la
+    extensión de una componente cubre a sus clips antes y después de combinarlos: combinar y eliminar sobrepuestos
+    nunca relacionan clips de componentes distintas. Cada clip nuevo se junta solo con las componentes que toca, y
+    solo se vuelve a combinar esa componente. Una componente se entrega cuando termina antes del inicio del candidato
+    vivo más antiguo, que es donde empiezan todos los clips futuros. Así se entregan los mismos clips que combinando
+    la lista completa al final, y cada entrega queda en el orden en que terminaron sus clips.
+    """
+
+    def __init__(self, max_errores_continuos: int = 7, tiempo_minimo: float = 1, max_offset: float = 0.0,
+                 rango: int = 1):
+        self.max_errores_continuos = max_errores_continuos
+        self.tiempo_minimo = tiempo_minimo
+        self.max_offset = max_offset
+        self.rango = rango
+
+        # lista de candidatos para buscar comerciales
+        self.candidatos = []
+
+        # componentes de clips terminados que aún pueden combinarse o sobreponerse con clips futuros, ordenadas por
+        # inicio: la extensión de cada una, sus clips (con su orden de término) y sus clips combinados
+        self.inicios_pendientes = []
+        self.fines_pendientes = []
+        self.pendientes = []
+        self.terminados = 0
+        self.tiempo = 0
+
+    def procesar(self, cercanos: Cercanos) -> List[Candidato]:
+        """
+        Procesa los frames cercanos a un frame del video.
+
+        :return: los clips válidos que terminaron en este frame.
+        """
+        self.tiempo = cercanos.tiempo
+        clips = []
 
-    for cercanos in lista_cercanos:
         # se tiene una lista de comerciales para eliminar (especificos) y comerciales completados para eliminar todos
         # los que coincidan en el nombre (general)
         terminados = []
 
         # buscar secuencias
-        for cand in candidatos:
-            cand.buscar_siguiente(cercanos, rango=1)
+        for cand in self.candidatos:
+            cand.buscar_siguiente(cercanos, rango=self.rango)
 
             # determinar fin de clip.
-            if cand.errores_continuos >= max_errores_continuos:
+            if cand.errores_continuos >= self.max_errores_continuos:
                 terminados.append(cand)
 
         # eliminar comerciales
         for terminado in terminados:
-            candidatos.remove(terminado)
+            self.candidatos.remove(terminado)
 
             # determinar que el clip es valido
-            if terminado.duracion > tiempo_minimo and \
-                    terminado.aciertos >= terminado.errores - max_errores_continuos:
+            if terminado.duracion > self.tiempo_minimo and \
+                    terminado.aciertos >= terminado.errores - self.max_errores_continuos:
                 clips.append(terminado)
 
         # agregar candidatos. todos?
-        for frame in cercanos.frames:
+        nuevos = 0
+        for video, indice, tiempo, indice_fin in zip(cercanos.videos, cercanos.indices, cercanos.tiempos,
+                                                     cercanos.indices_fin):
+
+            # las posiciones sin vecino no empiezan candidatos
+            if video < 0:
+                continue
 
-            # chequear que no sea un frame actual en un candidato
+            # chequear que no sea un frame actual en un candidato (o dentro del tramo)
             agregar = True
-            for cand1 in candidatos:
-                if cand1.video == frame.video and cand1.indice == frame.indice:
+            for cand1 in self.candidatos:
+                if cand1.video == video and indice <= cand1.indice <= indice_fin:
                     agregar = False
                     break
 
             if agregar:
-                candidatos.append(Candidato(video=frame.video, indice=frame.indice, tiempo_inicio=frame.tiempo,
-                                            tiempo_clip_inicio=cercanos.tiempo))
-
-    # combinar clips cuando se pueda
-    for i in range(len(clips)):
-        cand1 = clips[i]
-        for j in range(i + 1, len(clips)):
-            cand2 = clips[j]
-
-            if cand1.video == cand2.video and cand1.sobrepuesto(cand2):
-                cand1.combinar(cand2, max_offset)
-
-    # eliminar clips sobrepuestos
-    sobrepuestos = set()
-    for i in range(len(clips)):
-        cand1 = clips[i]
-        for j in range(i + 1, len(clips)):
-            cand2 = clips[j]
-
-            # si hay superposición dejar solo el más largo
-            if cand1.sobrepuesto(cand2):
-                if cand1.duracion > cand2.duracion:
-                    sobrepuestos.add(cand2)
-                else:
-                    sobrepuestos.add(cand1)
-
-    # eliminar clips sobrepuestos
-    for clip in sobrepuestos:
-        clips.remove(clip)
+                self.candidatos.append(Candidato(video=video, indice=indice, tiempo_inicio=tiempo,
+                                                 tiempo_clip_inicio=cercanos.tiempo,
+                                                 fin_tramo=indice_fin if indice_fin > indice else None))
+                nuevos += 1
+
+        contar('candidatos', nuevos)
+        return clips
+
+    def agregar(self, lista_cercanos: TablaCercanos) -> List[Candidato]:
+        """
+        Procesa los frames cercanos de un lote de frames del video.
+
+        :return: los clips (combinados y sin sobreposiciones) que ya no pueden cambiar.
+        """
+        for cercanos in lista_cercanos:
+            for clip in self.procesar(cercanos):
+                self._pendiente(clip)
+
+        # ningún clip futuro puede empezar antes de la frontera
+        frontera = min((cand.tiempo_clip_inicio for cand in self.candidatos), default=self.tiempo)
+        return self._liberar(frontera)
+
+    def terminar(self) -> List[Candidato]:
+        """
+        Termina la búsqueda. Los candidatos que no alcanzaron a terminar se descartan, igual que en
+        secuencias_candidatos.
+
+        :return: los clips pendientes, combinados y sin sobreposiciones.
+        """
+        self.candidatos = []
+        return self._liberar(float('inf'))
+
+    def _pendiente(self, clip: Candidato):
+        clips = [(self.terminados, clip)]
+        self.terminados += 1
+        inicio, fin = clip.tiempo_clip_inicio, clip.tiempo_clip_inicio + clip.duracion
+
+        # juntar el clip con las componentes sobrepuestas a él (que son contiguas por ser disjuntas), hasta que la
+        # extensión de la componente combinada no toque a otras
+        desde = bisect.bisect_right(self.fines_pendientes, inicio)
+        hasta = bisect.bisect_left(self.inicios_pendientes, fin)
+        while True:
+            for componente in self.pendientes[desde:hasta]:
+                clips.extend(componente[0])
+            clips.sort(key=lambda par: par[0])
+            del self.inicios_pendientes[desde:hasta]
+            del self.fines_pendientes[desde:hasta]
+            del self.pendientes[desde:hasta]
+
+            # combinar sobre copias, para poder repetirlo si llegan más clips a la componente
+            combinados = combinar_clips([copy.copy(clip) for _, clip in clips], self.max_offset)
+            inicio = min(clip.tiempo_clip_inicio for clip in combinados)
+            fin = max(clip.tiempo_clip_inicio + clip.duracion for clip in combinados)
+
+            desde = bisect.bisect_right(self.fines_pendientes, inicio)
+            hasta = bisect.bisect_left(self.inicios_pendientes, fin)
+            if desde == hasta:
+                break
+
+        self.inicios_pendientes.insert(desde, inicio)
+        self.fines_pendientes.insert(desde, fin)
+        self.pendientes.insert(desde, (clips, combinados))
+
+    def _liberar(self, frontera: float) -> List[Candidato]:
+        # las componentes que terminan antes de la frontera ya no pueden cambiar
+        listas = bisect.bisect_right(self.fines_pendientes, frontera)
+        if listas == 0:
+            return []
+
+        liberados = []
+        for clips, combinados in self.pendientes[:listas]:
+            validos = {id(clip) for clip in eliminar_sobrepuestos(combinados)}
+            liberados.extend((orden, combinado) for (orden, _), combinado in zip(clips, combinados)
+                             if id(combinado) in validos)
+
+        del self.inicios_pendientes[:listas]
+        del self.fines_pendientes[:listas]
+        del self.pendientes[:listas]
+
+        liberados.sort(key=lambda par: par[0])
+        return [clip for _, clip in liberados]
+
+
+MOTORES = {
+    'candidatos': secuencias_candidatos,
+    'votos': secuencias_votos,
+}
+
+
+def buscar_secuencias(video: str, max_errores_continuos: int = 7, tiempo_minimo: float = 1, max_offset: float = 0.0,
+                      motor: str = 'candidatos', carpeta_resultados: str = '../videos/AMV_results'):
+    """
+    Busca comerciales en los k frames más cercanos a cada frame de un video y los registra en un archivo.
 
-    for clip in clips:
-        log.write(f'{clip}\n')
+    :param video: la ubicación de los frames más cercanos (carpeta binaria o archivo .txt).
+    :param max_errores_continuos: máximos errores continuos para determinar que un clip terminó.
+    :param tiempo_minimo: tiempo mínimo para afirmar que un clip es válido.
+    :param max_offset: máxima distancia entre clips al combinarlos
+    :param motor: 'candidatos' (secuencias_candidatos) o 'votos' (secuencias_votos).
+    :param carpeta_resultados: carpeta donde guardar los clips encontrados.
+    """
+
+    # nombre del video
+    nombre = os.path.basename(video.rstrip('/'))
+    if nombre.endswith('.txt'):
+        nombre = re.split('[/.]', video)[-2]
+    print(f'buscando clips en {nombre}')
+
+    with etapa('deteccion') as medida:
+        # leer cercanos del video.
+        lista_cercanos = leer_cercanos(video)
+        etiquetas = lista_cercanos.etiquetas
+
+        # abrir log
+        if not os.path.isdir(carpeta_resultados):
+            os.mkdir(carpeta_resultados)
+        log = open(f'{carpeta_resultados}/{nombre}.txt', 'w')
+
+        # buscar secuencias
+        clips = MOTORES[motor](lista_cercanos, max_errores_continuos=max_errores_continuos,
+                               tiempo_minimo=tiempo_minimo)
+        # combinar clips cuando se pueda y eliminar clips sobrepuestos
+        clips = eliminar_sobrepuestos(combinar_clips(clips, max_offset))
+        contar('clips', len(clips))
+
+        for clip in clips:
+            log.write(f'{clip.texto(etiquetas.nombres)}\n')
+
+        # cerrar log
+        log.close()
+
+    print(f'se encontraron {len(clips)} clips en {medida.duracion:.2f} segundos')
+    return
 
-    # cerrar log
-    log.close()
-    print(f'se encontraron {len(clips)} clips en {int(time.time() - t0)} segundos')
+
+def comparar_motores(video: str, max_errores_continuos: int = 7, tiempo_minimo: float = 1):
+    """
+    Ejecuta ambos motores de búsqueda de secuencias sobre los mismos frames cercanos, e imprime su tiempo y el número
+    de clips encontrados. Sin tramos colapsados ambos deben entregar los mismos clips, y si no es así lanza una
+    excepción. Con tramos imprime qué fracción del tiempo detectado por cada uno es cubierta por el otro (mismo video
+    y mismo offset).
+
+    :param video: la ubicación de los frames más cercanos (carpeta binaria o archivo .txt).
+    :param max_errores_continuos: máximos errores continuos para determinar que un clip terminó.
+    :param tiempo_minimo: tiempo mínimo para afirmar que un clip es válido.
+    """
+    lista_cercanos = leer_cercanos(video)
+
+    resultados = {}
+    for motor, funcion in MOTORES.items():
+        t0 = time.time()
+        resultados[motor] = funcion(lista_cercanos, max_errores_continuos=max_errores_continuos,
+                                    tiempo_minimo=tiempo_minimo)
+        print(f'{motor}: {len(resultados[motor])} clips en {time.time() - t0:.3f} segundos')
+
+    if not lista_cercanos.tramos:
+        def campos(clips: List[Candidato]) -> list:
+            return [(c.video, c.indice, c.tiempo_inicio, c.tiempo_clip_inicio, c.duracion, c.aciertos, c.errores)
+                    for c in clips]
+
+        candidatos, votos = campos(resultados['candidatos']), campos(resultados['votos'])
+        if candidatos != votos:
+            distinto = next((i for i, (c, v) in enumerate(zip(candidatos, votos)) if c != v),
+                            min(len(candidatos), len(votos)))
+            raise Exception(f'los motores entregan clips distintos desde el clip {distinto}')
+
+        print('ambos motores entregan los mismos clips')
+        return
+
+    def cubierto(clips1: List[Candidato], clips2: List[Candidato]) -> float:
+        total = sum(clip.duracion for clip in clips1)
+        cubierta = 0
+        for clip1 in clips1:
+            offset1 = clip1.tiempo_inicio - clip1.tiempo_clip_inicio
+            for clip2 in clips2:
+                offset2 = clip2.tiempo_inicio - clip2.tiempo_clip_inicio
+                if clip1.video != clip2.video or abs(offset1 - offset2) > 0.5:
+                    continue
+
+                inicio = max(clip1.tiempo_clip_inicio, clip2.tiempo_clip_inicio)
+                fin = min(clip1.tiempo_clip_inicio + clip1.duracion, clip2.tiempo_clip_inicio + clip2.duracion)
+                cubierta += max(fin - inicio, 0)
+
+        return min(cubierta / total, 1) if total > 0 else 1
+
+    print('con tramos colapsados los motores pueden diferir (ver secuencias_votos)')
+    print(f'tiempo de candidatos cubierto por votos: {cubierto(resultados["candidatos"], resultados["votos"]):.1%}')
+    print(f'tiempo de votos cubierto por candidatos: {cubierto(resultados["votos"], resultados["candidatos"]):.1%}')
     return
 
 
-def main(video: str):
+def main(video: str, motor: str = 'candidatos', comparar: bool = False):
     tamano = (10, 10)
     fps = 6
 
-    buscar_secuencias(f'../videos/AMV_cerc_{tamano}_{fps}/{video}.txt',
-                      max_errores_continuos=6, tiempo_minimo=1, max_offset=0.15)
+    if comparar:
+        comparar_motores(f'../videos/AMV_cerc_{tamano}_{fps}/{video}', max_errores_continuos=6, tiempo_minimo=1)
+
+    buscar_secuencias(f'../videos/AMV_cerc_{tamano}_{fps}/{video}',
+                      max_errores_continuos=6, tiempo_minimo=1, max_offset=0.15, motor=motor)
     return
 
 
 if __name__ == '__main__':
+    if '--comprobar' in sys.argv:
+        comprobar_combinacion()
+        sys.exit()
+
     if len(sys.argv) == 1:
         nombre = 'mushroom'
     else:
         nombre = sys.argv[1]
 
-    main(nombre)
+    main(nombre, motor='votos' if '--votos' in sys.argv else 'candidatos', comparar='--comparar' in sys.argv)
@@ -0,0 +1,134 @@
+import hashlib
+import os
+from typing import List
+
+import numpy
+
+# una fila por frame: id del video (índice en la lista de nombres), tiempo en segundos y número de frame en el video
+ETIQUETA = numpy.dtype([('video', numpy.int32), ('tiempo', numpy.float32), ('indice', numpy.int32)])
+
+# etiqueta de un tramo de frames consecutivos casi iguales representados por su primer frame (ver
+# BusquedaKNN.colapsar_tramos): además guarda el número y el tiempo del último frame del tramo
+ETIQUETA_TRAMO = numpy.dtype(ETIQUETA.descr + [('indice_fin', numpy.int32), ('tiempo_fin', numpy.float32)])
+
+
+class Etiquetas:
+    """
+    Tabla de etiquetas de frames, compartida por BusquedaKNN y Deteccion. Cada frame se representa con un id de
+    video, su tiempo y su número de frame, y los nombres de los videos se guardan una sola vez.
+    """
+
+    ARCHIVO_TABLA = 'etiquetas.npy'
+    ARCHIVO_NOMBRES = 'nombres.txt'
+
+    def __init__(self, tabla: numpy.ndarray, nombres: List[str], carpeta: str = None):
+        self.tabla = tabla
+        self.nombres = nombres
+
+        # carpeta donde está guardada la tabla, None si solo está en memoria
+        self.carpeta = carpeta
+
+    def __len__(self):
+        return self.tabla.shape[0]
+
+    def __getitem__(self, item) -> numpy.ndarray:
+        return self.tabla[item]
+
+    @property
+    def video(self) -> numpy.ndarray:
+        return self.tabla['video']
+
+    @property
+    def tiempo(self) -> numpy.ndarray:
+        return self.tabla['tiempo']
+
+    @property
+    def indice(self) -> numpy.ndarray:
+        return self.tabla['indice']
+
+    @property
+    def tramos(self) -> bool:
+        return 'indice_fin' in self.tabla.dtype.names
+
+    @property
+    def indice_fin(self) -> numpy.ndarray:
+        return self.tabla['indice_fin'] if self.tramos else self.tabla['indice']
+
+    @property
+    def tiempo_fin(self) -> numpy.ndarray:
+        return self.tabla['tiempo_fin'] if self.tramos else self.tabla['tiempo']
+
+    @staticmethod
+    def de_video(nombre: str, tiempos: numpy.ndarray) -> 'Etiquetas':
+        """
+        Genera las etiquetas de los frames de un solo video.
+
+        :param nombre: nombre del video.
+        :param tiempos: tiempo de cada frame del video.
+
+        :return: las etiquetas, con números de frame desde 1.
+        """
+        tabla = numpy.empty(tiempos.shape[0], dtype=ETIQUETA)
+        tabla['video'] = 0
+        tabla['tiempo'] = tiempos
+        tabla['indice'] = numpy.arange(1, tiempos.shape[0] + 1)
+
+        return Etiquetas(tabla, [nombre])
+
+    @staticmethod
+    def de_videos(nombres: List[str], cantidades: numpy.ndarray, tiempos: numpy.ndarray) -> 'Etiquetas':
+        """
+        Genera las etiquetas de varios videos cuyos frames están concatenados, sin recorrer los frames en python.
+
+        :param nombres: nombre de cada video.
+        :param cantidades: número de frames de cada video.
+        :param tiempos: tiempo de cada frame, de todos los videos concatenados.
+
+        :return: las etiquetas, con números de frame desde 1 en cada video.
+        """
+        cantidades = numpy.asarray(cantidades, dtype=numpy.int64)
+        inicios = numpy.cumsum(cantidades) - cantidades
+
+        tabla = numpy.empty(tiempos.shape[0], dtype=ETIQUETA)
+        tabla['video'] = numpy.repeat(numpy.arange(len(nombres)), cantidades)
+        tabla['tiempo'] = tiempos
+        tabla['indice'] = numpy.arange(tiempos.shape[0]) - numpy.repeat(inicios, cantidades) + 1
+
+        return Etiquetas(tabla, list(nombres))
+
+    @staticmethod
+    def existe(carpeta: str) -> bool:
+        return os.path.isfile(f'{carpeta}/{Etiquetas.ARCHIVO_TABLA}') and \
+            os.path.isfile(f'{carpeta}/{Etiquetas.ARCHIVO_NOMBRES}')
+
+    @staticmethod
+    def cargar(carpeta: str) -> 'Etiquetas':
+        tabla = numpy.load(f'{carpeta}/{Etiquetas.ARCHIVO_TABLA}', mmap_mode='r')
+        with open(f'{carpeta}/{Etiquetas.ARCHIVO_NOMBRES}', 'r') as archivo:
+            nombres = archivo.read().splitlines()
+
+        return Etiquetas(tabla, nombres, carpeta=carpeta)
+
+    def guardar(self, carpeta: str):
+        if not os.path.isdir(carpeta):
+            os.makedirs(carpeta, exist_ok=True)
+
+        numpy.save(f'{carpeta}/{Etiquetas.ARCHIVO_TABLA}', self.tabla)
+        with open(f'{carpeta}/{Etiquetas.ARCHIVO_NOMBRES}', 'w') as archivo:
+            archivo.writelines(f'{nombre}\n' for nombre in self.nombres)
+
+        self.carpeta = carpeta
+
+    def huella(self) -> str:
+        """
+        :return: un hash sha1 del contenido de la tabla y los nombres.
+        """
+        h = hashlib.sha1('\n'.join(self.nombres).encode())
+        h.update(numpy.ascontiguousarray(self.tabla).data)
+        return h.hexdigest()
+
+    def memoria(self) -> int:
+        """
+        :return: bytes ocupados por la tabla y los nombres.
+        """
+        return self.tabla.nbytes + sum(len(nombre) for nombre in self.nombres)
@@ -1,8 +1,16 @@
+import json
+import os
 import sys
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Tuple
 
 import cv2
+import numpy
 
 from Extraccion import abrir_video
+from Metricas import etapa
+
+ARCHIVO_COMPARACIONES = 'comparaciones.json'
 
 
 class Prediccion:
@@ -16,17 +24,27 @@ class Prediccion:
 
         self.correcta = False
 
+    def texto(self) -> str:
+        return f'{int(self.inicio_video / 60)}:{int(self.inicio_video) % 60} ({self.duracion:.1f}) ' + \
+               f'capitulo {self.capitulo} - {int(self.inicio_cap / 60)}:{int(self.inicio_cap) % 60}'
+
+    def clave(self) -> list:
+        return [self.video, round(self.inicio_video, 2), round(self.duracion, 2), self.capitulo,
+                round(self.inicio_cap, 2)]
 
-def comparar_videos(prediccion: Prediccion):
-    amv = abrir_video(f'../videos/AMV/{prediccion.video}.mp4')
-    cap = abrir_video(f'../videos/Shippuden/{prediccion.capitulo}.mp4')
 
-    text = f'{int(prediccion.inicio_video / 60)}:{int(prediccion.inicio_video) % 60} ({prediccion.duracion:.1f}) ' + \
-           f'capitulo {prediccion.capitulo} - {int(prediccion.inicio_cap / 60)}:{int(prediccion.inicio_cap) % 60}'
+def _poner_texto(img, text: str, scale: float = 1, thick: int = 3):
     font = cv2.FONT_HERSHEY_COMPLEX
-    scale = 1
-    thick = 3
     width, heigth = cv2.getTextSize(text, font, scale, thick)[0]
+    cv2.putText(img, text, (int(img.shape[1] / 2 - width / 2), heigth), font, scale, (255, 255, 255),
+                thickness=thick)
+
+
+def comparar_videos(prediccion: Prediccion, carpeta_videos: str = '../videos'):
+    amv = abrir_video(f'{carpeta_videos}/AMV/{prediccion.video}.mp4')
+    cap = abrir_video(f'{carpeta_videos}/Shippuden/{prediccion.capitulo}.mp4')
+
+    text = prediccion.texto()
 
     # mover videos a puntos de inicio
     amv.set(cv2.CAP_PROP_POS_MSEC, prediccion.inicio_video * 1000)
@@ -63,7 +81,7 @@ def comparar_videos(prediccion: Prediccion):
 
         # concatenar frames y agregar texto
         img = cv2.hconcat([frame1, frame2])
-        cv2.putText(img, text, (int(640 - width / 2), heigth), font, scale, (255, 255, 255), thickness=thick)
+        _poner_texto(img, text)
         cv2.imshow(f'resultados {prediccion.video}', img)
 
         # espera de tiempo
@@ -83,25 +101,320 @@ def comparar_videos(prediccion: Prediccion):
     return
 
 
-def evaluar_resultados(video: str):
-    carpeta = '../videos/AMV_results'
+def reproducir_comparacion(prediccion: Prediccion, archivo: str):
+    """
+    Igual que comparar_videos, pero reproduce la comparación ya renderizada (ver renderizar_comparaciones), sin
+    decodificar los videos originales. Una hoja de cuadros se muestra completa hasta que se responda.
+
+    :param prediccion: la predicción a evaluar.
+    :param archivo: el video (.mp4) o la hoja de cuadros (.jpg) de la comparación.
+    """
+    if archivo.endswith('.jpg'):
+        hoja = cv2.imread(archivo)
+        if hoja is None:
+            raise Exception(f'no se pudo leer la hoja {archivo}')
+
+        cv2.imshow(f'resultados {prediccion.video}', hoja)
+        res = cv2.waitKey(0)
+        prediccion.correcta = res & 0xff == ord('y')
+        return
+
+    tira = abrir_video(archivo)
+    espera = max(int(1000 / tira.get(cv2.CAP_PROP_FPS)), 1)
+
+    while True:
+        retval, img = tira.read()
+        if not retval:
+            break
+
+        cv2.imshow(f'resultados {prediccion.video}', img)
+        res = cv2.waitKey(espera)
+
+        # permitir terminar de manera temprana
+        if res & 0xff == ord('y'):
+            prediccion.correcta = True
+            return
+
+        elif res & 0xff == ord('n'):
+            return
+
+    res = cv2.waitKey(0)
+    prediccion.correcta = res & 0xff == ord('y')
+    return
+
+
+class LectorVideo:
+    """
+    Captura de un video que se lee solo hacia adelante, para leer muchos tramos pedidos en orden con la misma
+    captura: un tramo cercano al anterior se alcanza decodificando los frames intermedios (sin decodificar su
+    imagen), y uno lejano buscando por número de frame, que parte del keyframe anterior.
+    """
+
+    def __init__(self, archivo: str, max_salto: float = 2.0):
+        """
+        :param archivo: el video.
+        :param max_salto: segundos hasta los que se avanza decodificando en vez de buscar.
+        """
+        self.video = abrir_video(archivo)
+        self.fps = self.video.get(cv2.CAP_PROP_FPS)
+        self.max_salto = max_salto
+        self.posicion = 0  # número del siguiente frame a leer
+
+    def leer(self, inicio: float, duracion: float, fps: float, tamano: Tuple[int, int]) -> List[numpy.ndarray]:
+        """
+        :param inicio: segundo de inicio del tramo.
+        :param duracion: duración del tramo en segundos.
+        :param fps: frames por segundo a leer del tramo.
+        :param tamano: ancho y alto de los frames retornados.
+
+        :return: los frames del tramo, puede tener menos si el video termina antes.
+        """
+        primero = int(round(inicio * self.fps))
+        if primero < self.posicion or primero - self.posicion > self.max_salto * self.fps:
+            self.video.set(cv2.CAP_PROP_POS_FRAMES, primero)
+            self.posicion = primero
+
+        frames = []
+        for j in range(max(int(duracion * fps), 1)):
+            objetivo = primero + int(j * self.fps / fps)
+
+            # con más fps que el video se repite el frame anterior
+            if objetivo < self.posicion and frames:
+                frames.append(frames[-1])
+                continue
+
+            while self.posicion < objetivo and self.video.grab():
+                self.posicion += 1
+            if self.posicion < objetivo:
+                break
+
+            retval, frame = self.video.read()
+            if not retval:
+                break
+            self.posicion += 1
+            frames.append(cv2.resize(frame, tamano, interpolation=cv2.INTER_AREA))
+
+        return frames
+
+    def cerrar(self):
+        self.video.release()
+
+
+def _renderizar_bloque(predicciones: List[Tuple[int, Prediccion]], carpeta_videos: str, carpeta_salida: str,
+                       formato: str, fps: float, tamano: Tuple[int, int], cuadros: int) -> List[str]:
+    """
+    Renderiza las comparaciones de un bloque de predicciones en un proceso del pool. Cada video de origen se abre
+    una sola vez y sus tramos se leen ordenados por tiempo.
+
+    :return: el archivo de cada comparación, en el orden del bloque.
+    """
+    # tramos a leer de cada video: (inicio, índice en el bloque)
+    tramos: Dict[str, List[Tuple[float, int]]] = {}
+    for i, (_, prediccion) in enumerate(predicciones):
+        tramos.setdefault(f'{carpeta_videos}/AMV/{prediccion.video}.mp4', []).append((prediccion.inicio_video, i))
+        tramos.setdefault(f'{carpeta_videos}/Shippuden/{prediccion.capitulo}.mp4', []).append(
+            (prediccion.inicio_cap, i))
+
+    frames: Dict[Tuple[str, int], List[numpy.ndarray]] = {}
+    for archivo, pedidos in tramos.items():
+        lector = LectorVideo(archivo)
+        for inicio, i in sorted(pedidos):
+            duracion = predicciones[i][1].duracion
+            fps_tramo = fps if formato == 'video' else cuadros / max(duracion, 1e-3)
+            frames[archivo, i] = lector.leer(inicio, duracion, fps_tramo, tamano)
+        lector.cerrar()
 
+    archivos = []
+    negro = numpy.zeros((tamano[1], tamano[0], 3), dtype=numpy.uint8)
+    for i, (n, prediccion) in enumerate(predicciones):
+        frames_amv = frames[f'{carpeta_videos}/AMV/{prediccion.video}.mp4', i] or [negro]
+        frames_cap = frames[f'{carpeta_videos}/Shippuden/{prediccion.capitulo}.mp4', i] or [negro]
+
+        # concatenar frames lado a lado, repitiendo el último del tramo más corto
+        imagenes = []
+        for j in range(max(len(frames_amv), len(frames_cap))):
+            img = cv2.hconcat([frames_amv[min(j, len(frames_amv) - 1)], frames_cap[min(j, len(frames_cap) - 1)]])
+            _poner_texto(img, prediccion.texto(), scale=tamano[0] / 640, thick=max(int(3 * tamano[0] / 640), 1))
+            imagenes.append(img)
+
+        if formato == 'video':
+            archivos.append(f'{carpeta_salida}/{n:03d}.mp4')
+            escritor = cv2.VideoWriter(archivos[-1], cv2.VideoWriter_fourcc(*'mp4v'), fps,
+                                       (imagenes[0].shape[1], imagenes[0].shape[0]))
+            for img in imagenes:
+                escritor.write(img)
+            escritor.release()
+
+        else:
+            archivos.append(f'{carpeta_salida}/{n:03d}.jpg')
+            cv2.imwrite(archivos[-1], cv2.vconcat(imagenes))
+
+    return archivos
+
+
+def renderizar_comparaciones(video: str, carpeta_videos: str = '../videos', carpeta_salida: str = None,
+                             formato: str = 'video', fps: float = 10, tamano: Tuple[int, int] = (320, 180),
+                             cuadros: int = 6, procesos: int = 0, tamano_bloque: int = 16) -> List[str]:
+    """
+    Renderiza sin ventanas la comparación lado a lado de cada clip encontrado en un video (el tramo del AMV junto
+    al tramo del capítulo), para revisarlas después sin decodificar los videos originales.
+
+    Las predicciones se agrupan por capítulo y se reparten en bloques entre procesos, con capítulos completos en
+    cada bloque (un capítulo solo se divide si tiene más de tamano_bloque predicciones). En cada bloque se abre una
+    sola captura por video de origen, y sus tramos se leen en orden (ver LectorVideo).
+
+    :param video: nombre del AMV.
+    :param carpeta_videos: carpeta con los videos (AMV y Shippuden) y los resultados (AMV_results).
+    :param carpeta_salida: carpeta donde guardar las comparaciones, por defecto AMV_comparaciones/{video}.
+    :param formato: 'video' para un video por comparación, más uno con todas seguidas (todas.mp4), u 'hojas' para
+    una imagen por comparación con algunos cuadros del tramo, uno debajo del otro.
+    :param fps: frames por segundo de los videos de las comparaciones.
+    :param tamano: ancho y alto de cada lado de la comparación.
+    :param cuadros: número de cuadros de cada hoja.
+    :param procesos: número de procesos a usar (0 usa todos los núcleos).
+    :param tamano_bloque: número de predicciones por bloque, limita la memoria de cada proceso.
+
+    :return: el archivo de cada comparación, en el orden de las predicciones.
+    """
+    if formato not in ('video', 'hojas'):
+        raise Exception(f'formato {formato} no soportado, use video u hojas')
+
+    if carpeta_salida is None:
+        carpeta_salida = f'{carpeta_videos}/AMV_comparaciones/{video}'
+    os.makedirs(carpeta_salida, exist_ok=True)
+    if procesos <= 0:
+        procesos = os.cpu_count()
+
+    predicciones = leer_predicciones(video, f'{carpeta_videos}/AMV_results')
+
+    # predicciones de cada capítulo, ordenadas por tiempo en el capítulo
+    capitulos: Dict[str, List[int]] = {}
+    for n in sorted(range(len(predicciones)), key=lambda n: predicciones[n].inicio_cap):
+        capitulos.setdefault(predicciones[n].capitulo, []).append(n)
+
+    # juntar capítulos completos en cada bloque, para no abrir un capítulo en varios procesos
+    bloques = [[]]
+    for capitulo in sorted(capitulos):
+        grupo = capitulos[capitulo]
+        if bloques[-1] and len(bloques[-1]) + len(grupo) > tamano_bloque:
+            bloques.append([])
+        for i in range(0, len(grupo), tamano_bloque):
+            if len(bloques[-1]) >= tamano_bloque:
+                bloques.append([])
+            bloques[-1].extend((n, predicciones[n]) for n in grupo[i:i + tamano_bloque])
+    bloques = [bloque for bloque in bloques if bloque]
+
+    archivos = [None] * len(predicciones)
+    with etapa('renderizado') as medida:
+        argumentos = (carpeta_videos, carpeta_salida, formato, fps, tamano, cuadros)
+        if procesos == 1 or len(bloques) <= 1:
+            resultados = [_renderizar_bloque(bloque, *argumentos) for bloque in bloques]
+        else:
+            with ProcessPoolExecutor(max_workers=min(procesos, len(bloques))) as pool:
+                resultados = list(pool.map(_renderizar_bloque, bloques, *[[a] * len(bloques) for a in argumentos]))
+
+        for bloque, archivos_bloque in zip(bloques, resultados):
+            for (n, _), archivo in zip(bloque, archivos_bloque):
+                archivos[n] = archivo
+
+        if formato == 'video' and archivos:
+            _concatenar(archivos, f'{carpeta_salida}/todas.mp4', fps)
+
+    # índice de las comparaciones, para reproducirlas solo si corresponden a los resultados actuales
+    with open(f'{carpeta_salida}/{ARCHIVO_COMPARACIONES}', 'w') as salida:
+        json.dump([{'prediccion': prediccion.clave(), 'archivo': os.path.basename(archivo)}
+                   for prediccion, archivo in zip(predicciones, archivos)], salida, indent=2)
+
+    print(f'{len(archivos)} comparaciones de {video} renderizadas en {medida.duracion:.2f} segundos')
+    return archivos
+
+
+def _concatenar(archivos: List[str], archivo_salida: str, fps: float):
+    # junta los videos de las comparaciones, todos del mismo tamaño, en uno solo
+    escritor = None
+    for archivo in archivos:
+        tira = abrir_video(archivo)
+        while True:
+            retval, img = tira.read()
+            if not retval:
+                break
+            if escritor is None:
+                escritor = cv2.VideoWriter(archivo_salida, cv2.VideoWriter_fourcc(*'mp4v'), fps,
+                                           (img.shape[1], img.shape[0]))
+            escritor.write(img)
+        tira.release()
+
+    if escritor is not None:
+        escritor.release()
+
+
+def comparaciones_renderizadas(video: str, predicciones: List[Prediccion], carpeta_videos: str = '../videos',
+                               carpeta_salida: str = None) -> List[str]:
+    """
+    :return: el video o la hoja de cuadros renderizada de la comparación de cada predicción (ver
+    renderizar_comparaciones), o None en las predicciones que no tienen una vigente.
+    """
+    if carpeta_salida is None:
+        carpeta_salida = f'{carpeta_videos}/AMV_comparaciones/{video}'
+    if not os.path.isfile(f'{carpeta_salida}/{ARCHIVO_COMPARACIONES}'):
+        return [None] * len(predicciones)
+
+    with open(f'{carpeta_salida}/{ARCHIVO_COMPARACIONES}', 'r') as entrada:
+        renderizadas = {tuple(comparacion['prediccion']): comparacion['archivo'] for comparacion in json.load(entrada)}
+
+    archivos = []
+    for prediccion in predicciones:
+        archivo = renderizadas.get(tuple(prediccion.clave()))
+        vigente = archivo is not None and archivo.endswith(('.mp4', '.jpg')) and \
+            os.path.isfile(f'{carpeta_salida}/{archivo}')
+        archivos.append(f'{carpeta_salida}/{archivo}' if vigente else None)
+
+    return archivos
+
+
+def leer_predicciones(video: str, carpeta_resultados: str = '../videos/AMV_results') -> List[Prediccion]:
+    """
+    Lee los clips encontrados en un video (ver Deteccion.buscar_secuencias).
+
+    :param video: nombre del video.
+    :param carpeta_resultados: carpeta donde se guardaron los clips encontrados.
+
+    :return: una predicción por clip.
+    """
     predicciones = []
-    with open(f'{carpeta}/{video}.txt') as resultados:
+    with open(f'{carpeta_resultados}/{video}.txt') as resultados:
         for linea in resultados:
             tiempo_video_inicio, duracion, capitulo, tiempo_cap_inicio = linea.split(' ')
             predicciones.append(
                 Prediccion(video, float(tiempo_video_inicio), capitulo, float(tiempo_cap_inicio), float(duracion)))
 
+    return predicciones
+
+
+def evaluar_resultados(video: str, carpeta_videos: str = '../videos'):
+    predicciones = leer_predicciones(video, f'{carpeta_videos}/AMV_results')
+    if not predicciones:
+        print(f'no se encontraron clips en {video}, no hay nada que evaluar')
+        return
+
     correctas = 0
     total = len(predicciones)
 
     tiempo_detectado = 0
-    amv = abrir_video(f'../videos/AMV/{video}.mp4')
+    amv = abrir_video(f'{carpeta_videos}/AMV/{video}.mp4')
     tiempo_total = amv.get(cv2.CAP_PROP_FRAME_COUNT) / amv.get(cv2.CAP_PROP_FPS)
 
-    for prediccion in predicciones:
-        comparar_videos(prediccion)
+    # si las comparaciones ya se renderizaron (videos u hojas) se reproducen, si no se decodifican los videos
+    renderizadas = comparaciones_renderizadas(video, predicciones, carpeta_videos=carpeta_videos)
+    faltantes = sum(renderizada is None for renderizada in renderizadas)
+    if 0 < faltantes < len(predicciones):
+        print(f'{faltantes} de {len(predicciones)} comparaciones no están renderizadas, se decodifican los videos')
+
+    for prediccion, renderizada in zip(predicciones, renderizadas):
+        if renderizada is not None:
+            reproducir_comparacion(prediccion, renderizada)
+        else:
+            comparar_videos(prediccion, carpeta_videos=carpeta_videos)
 
         if prediccion.correcta:
             correctas += 1
@@ -113,9 +426,15 @@ def evaluar_resultados(video: str):
 
 
 if __name__ == '__main__':
-    if len(sys.argv) == 1:
-        nombre = 'mushroom'
-    else:
-        nombre = sys.argv[1]
+    # python Evaluacion.py nombre [--renderizar] [--renderizar=hojas] [--procesos=N]: renderiza las comparaciones
+    # sin evaluarlas, luego la evaluación interactiva las reproduce
+    opciones = dict(argumento[2:].split('=', 1) for argumento in sys.argv if argumento.startswith('--') and
+                    '=' in argumento)
+    argumentos = [argumento for argumento in sys.argv[1:] if not argumento.startswith('--')]
+    nombre = argumentos[0] if argumentos else 'mushroom'
 
-    evaluar_resultados(nombre)
+    if '--renderizar' in sys.argv or 'renderizar' in opciones:
+        renderizar_comparaciones(nombre, formato=opciones.get('renderizar', 'video'),
+                                 procesos=int(opciones.get('procesos', 0)))
+    else:
+        evaluar_resultados(nombre)
@@ -1,11 +1,18 @@
 import os
+import queue
 import re
-import time
-from typing import Tuple
+import sys
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Iterator, List, Tuple
 
 import cv2
 import numpy
 
+from Almacen import Almacen, dimension_caracteristicas
+from Metricas import contar, etapa
+
 
 def abrir_video(archivo: str) -> cv2.VideoCapture:
     """
@@ -24,15 +31,18 @@ def abrir_video(archivo: str) -> cv2.VideoCapture:
     return capture
 
 
-def extraer_caracteristicas(imagen, tamano: Tuple[int, int] = (10, 10)) -> numpy.matrix:
+def extraer_caracteristicas(imagen, tamano: Tuple[int, int] = (10, 10), tipo: str = 'gris') -> numpy.matrix:
     """
     Extrae caracteristicas de una imagen, reduciendo la dimensión de la imagen al tamaño especificado.
 
     :param imagen: la imagen de la cuál extraer características, en el formato de cv2 (una matriz)
     :param tamano: el tamaño al cual reducir la dimension de la imagen.
+    :param tipo: 'gris' para la imagen reducida, 'mediana' o 'dct' para un hash binario (ver extraer_hash).
 
     :return: un vector de caracteristicas correspondiente a la matriz "aplanada".
     """
+    if tipo != 'gris':
+        return extraer_hash(imagen, tamano=tamano, metodo=tipo)
 
     # vector de caracteristicas
     imagen_gris = cv2.cvtColor(imagen, cv2.COLOR_BGR2GRAY)
@@ -41,97 +51,424 @@ def extraer_caracteristicas(imagen, tamano: Tuple[int, int] = (10, 10)) -> numpy
     return caracteristicas.flatten()
 
 
+def extraer_hash(imagen, tamano: Tuple[int, int] = (8, 8), metodo: str = 'mediana') -> numpy.ndarray:
+    """
+    Extrae un hash perceptual binario de una imagen, con un bit por celda de una grilla del tamaño dado, empaquetados
+    en bytes (8x8 da 64 bits, 16x8 da 128 bits). Se compara con distancia de Hamming (ver Indices.Hamming).
+
+    :param imagen: la imagen de la cuál extraer el hash, en el formato de cv2 (una matriz)
+    :param tamano: el tamaño de la grilla de bits.
+    :param metodo: 'mediana' compara cada pixel de la imagen reducida con la mediana, 'dct' compara los
+    coeficientes de frecuencias bajas de la DCT de la imagen reducida a 4 veces el tamaño con su mediana.
+
+    :return: un vector de uint8 con los bits empaquetados.
+    """
+    imagen_gris = cv2.cvtColor(imagen, cv2.COLOR_BGR2GRAY)
+
+    if metodo == 'dct':
+        reducida = cv2.resize(imagen_gris, dsize=(4 * tamano[1], 4 * tamano[0]), interpolation=cv2.INTER_AREA)
+        valores = cv2.dct(reducida.astype(numpy.float32))[:tamano[0], :tamano[1]]
+    elif metodo == 'mediana':
+        valores = cv2.resize(imagen_gris, dsize=(tamano[1], tamano[0]), interpolation=cv2.INTER_AREA)
+    else:
+        raise Exception(f'tipo de hash {metodo} desconocido')
+
+    valores = valores.flatten()
+    return numpy.packbits(valores > numpy.median(valores))
+
+
+def extraer_caracteristicas_lote(frames: List[numpy.ndarray], tamano: Tuple[int, int] = (10, 10),
+                                 tipo: str = 'gris') -> numpy.ndarray:
+    """
+    Extrae las características de un lote de frames, con el mismo resultado que extraer_caracteristicas en cada uno.
+    La conversión a gris, la reducción y la DCT se hacen frame a frame con cv2, que ya recorre cada imagen en C
+    (convertir y reducir el lote juntado en una sola imagen no es más rápido), y el umbral con la mediana y el
+    empaquetado de bits de los hashes se hacen para todo el lote con numpy.
+
+    :param frames: lista de imágenes en el formato de cv2, todas del mismo tamaño.
+    :param tamano: el tamaño al cual reducir la dimension de las imágenes.
+    :param tipo: tipo de características (ver extraer_caracteristicas).
+
+    :return: una matriz (n, dimension) de uint8 con las características de cada frame.
+    """
+    if tipo not in ('gris', 'mediana', 'dct'):
+        raise Exception(f'tipo de hash {tipo} desconocido')
+    if not frames:
+        return numpy.empty((0, dimension_caracteristicas(tamano, tipo)), dtype=numpy.uint8)
+
+    escala = 4 if tipo == 'dct' else 1
+    valores = numpy.empty((len(frames), tamano[0], tamano[1]), dtype=numpy.float32 if tipo == 'dct' else numpy.uint8)
+    for i, frame in enumerate(frames):
+        imagen_gris = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        reducida = cv2.resize(imagen_gris, dsize=(escala * tamano[1], escala * tamano[0]),
+                              interpolation=cv2.INTER_AREA)
+        valores[i] = cv2.dct(reducida.astype(numpy.float32))[:tamano[0], :tamano[1]] if tipo == 'dct' else reducida
+
+    valores = valores.reshape(len(frames), -1)
+    if tipo == 'gris':
+        return valores
+
+    return numpy.packbits(valores > numpy.median(valores, axis=1, keepdims=True), axis=1)
+
+
+class ReporteExtraccion:
+    """
+    Resultado de extraer las características de un video: cuántos frames se extrajeron y cuánto tomó, o el error que
+    impidió extraerlas.
+    """
+
+    def __init__(self, archivo: str, nombre: str, frames: int = 0, segundos_video: float = 0, tiempo: float = 0,
+                 error: str = None):
+        self.archivo = archivo
+        self.nombre = nombre
+        self.frames = frames
+        self.segundos_video = segundos_video
+        self.tiempo = tiempo
+        self.error = error
+
+    @property
+    def exito(self) -> bool:
+        return self.error is None
+
+    def __str__(self):
+        if not self.exito:
+            return f'{self.nombre}: error ({self.error})'
+
+        return f'{self.nombre}: {self.frames} frames de {self.segundos_video:.0f} segundos ' \
+               f'en {self.tiempo:.1f} segundos'
+
+
 def caracteristicas_video(archivo: str, carpeta_log: str, fps_extraccion: int = 6,
-                          tamano: Tuple[int, int] = (10, 10)):
+                          tamano: Tuple[int, int] = (10, 10), tipo: str = 'gris') -> ReporteExtraccion:
+    """
+    Extrae la caracteristicas de un video y las guarda con el mismo nombre del video en el almacén binario
+    de la carpeta log. Mide la extracción como la etapa 'extraccion' de las métricas activas (ver Metricas).
+
+    :param archivo: archivo del video.
+    :param carpeta_log: carpeta del almacén donde guardar las características.
+    :param fps_extraccion: número de frames por segundo a extraer.
+    :param tamano: el tamaño del mapa al cual reducir la dimension de la imagen.
+    :param tipo: tipo de características (ver extraer_caracteristicas).
+
+    :return: un reporte de la extracción, con el error si no se pudo abrir el video.
+    """
+    nombre = re.split('[/.]', archivo)[-2]
+
+    with etapa('extraccion') as medida:
+        # abrir video
+        try:
+            video = abrir_video(archivo)
+        except Exception as e:
+            return ReporteExtraccion(archivo, nombre, error=str(e))
+
+        # tiempos y vectores extraídos, se escriben juntos al final
+        tiempos = []
+        vectores = []
+
+        frame_n = 0  # número de frames
+        fps = video.get(cv2.CAP_PROP_FPS)  # frames por segundo (para calcular tiempo)
+        salto_frames = round(fps / fps_extraccion)  # frames a saltar
+
+        print(f'extrayendo caracteristicas de video {nombre} ({fps:.2f} FPS)')
+
+        while video.grab():
+
+            # obtener solo 1 de cada n frames
+            frame_n += 1
+            if frame_n % salto_frames != 0:
+                continue
+
+            # sacar frame y asegurarse de que no hay errores
+            retval, frame = video.retrieve()
+            if not retval:
+                continue
+
+            # extraer caracteristicas
+            tiempos.append(frame_n / fps)
+            vectores.append(extraer_caracteristicas(frame, tamano=tamano, tipo=tipo))
+
+        video.release()
+        contar('frames_decodificados', frame_n)
+        contar('frames_extraidos', len(vectores))
+
+        # guardar en el almacén
+        dimension = dimension_caracteristicas(tamano, tipo)
+        caracteristicas = numpy.array(vectores, dtype=numpy.uint8).reshape(len(vectores), dimension)
+        Almacen(carpeta_log, dimension=dimension).agregar_video(nombre, numpy.array(tiempos), caracteristicas)
+
+    print(f'la extracción de {frame_n / fps:.0f} segundos de video tomó {medida.duracion:.2f} segundos')
+
+    return ReporteExtraccion(archivo, nombre, frames=len(vectores), segundos_video=frame_n / fps,
+                             tiempo=medida.duracion)
+
+
+def _decodificar(video: cv2.VideoCapture, salto_frames: int, fps: float, buscar: bool, tamano_lote: int,
+                 cola: queue.Queue, detener: threading.Event):
+    """
+    Etapa de decodificación: lee 1 de cada salto_frames frames del video y los pone en la cola en lotes de
+    (tiempos, frames, frames decodificados). Al terminar pone None, o la excepción si hubo un error.
+
+    :param buscar: si es True, salta directamente al siguiente frame a extraer buscando por tiempo, en vez de
+    decodificar todos los frames intermedios.
     """
-    Extrae la caracteristicas de un video y las guarda en un archivo con el mismo nombre del video,
-    dentro de la carpeta log. Mide el tiempo que tomó la extracción y la imprime.
+
+    def poner(elemento) -> bool:
+        while not detener.is_set():
+            try:
+                cola.put(elemento, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    try:
+        frame_n = 0  # número de frames
+        decodificados = 0
+        tiempos, frames = [], []
+
+        while not detener.is_set():
+            if buscar:
+                # ir directamente al siguiente frame a extraer
+                frame_n += salto_frames
+                video.set(cv2.CAP_PROP_POS_MSEC, (frame_n - 1) / fps * 1000)
+                retval, frame = video.read()
+                if not retval:
+                    break
+                decodificados += 1
+
+            else:
+                if not video.grab():
+                    break
+                decodificados += 1
+
+                # obtener solo 1 de cada n frames
+                frame_n += 1
+                if frame_n % salto_frames != 0:
+                    continue
+
+                # sacar frame y asegurarse de que no hay errores
+                retval, frame = video.retrieve()
+                if not retval:
+                    continue
+
+            tiempos.append(frame_n / fps)
+            frames.append(frame)
+
+            if len(frames) == tamano_lote:
+                if not poner((tiempos, frames, decodificados)):
+                    return
+                tiempos, frames = [], []
+
+        if frames:
+            poner((tiempos, frames, decodificados))
+        poner(None)
+
+    except Exception as e:
+        poner(e)
+
+
+def generar_caracteristicas(archivo: str, fps_extraccion: int = 6, tamano: Tuple[int, int] = (10, 10),
+                            tamano_lote: int = 64, tamano_cola: int = 4, salto_busqueda: int = 0,
+                            tipo: str = 'gris') -> Iterator[Tuple[numpy.ndarray, numpy.ndarray, int]]:
+    """
+    Extrae las características de un video por etapas: un thread decodifica los frames y los pone en una cola
+    acotada, mientras que el thread que llama calcula las características de cada lote de frames (ver
+    extraer_caracteristicas_lote).
 
     :param archivo: archivo del video.
-    :param carpeta_log: carpeta donde guardar las características.
     :param fps_extraccion: número de frames por segundo a extraer.
     :param tamano: el tamaño del mapa al cual reducir la dimension de la imagen.
+    :param tamano_lote: número de frames por lote.
+    :param tamano_cola: máximo número de lotes decodificados esperando en la cola.
+    :param salto_busqueda: si es mayor a 0 y se saltan al menos esta cantidad de frames entre frames extraídos,
+    se busca por tiempo el siguiente frame en vez de decodificar los intermedios.
+    :param tipo: tipo de características (ver extraer_caracteristicas).
+
+    :return: un generador de lotes (tiempos, características, frames decodificados hasta el momento).
     """
-    # medir tiempo
-    t0 = time.time()
+    video = abrir_video(archivo)
 
-    # abrir video
+    fps = video.get(cv2.CAP_PROP_FPS)  # frames por segundo (para calcular tiempo)
+    salto_frames = max(round(fps / fps_extraccion), 1)  # frames a saltar
+    buscar = 0 < salto_busqueda <= salto_frames
+
+    cola = queue.Queue(maxsize=tamano_cola)
+    detener = threading.Event()
+    decodificador = threading.Thread(target=_decodificar, daemon=True,
+                                     args=(video, salto_frames, fps, buscar, tamano_lote, cola, detener))
+    decodificador.start()
+
+    decodificados_previos = 0
     try:
-        video = abrir_video(archivo)
-    except:
-        return
+        while True:
+            lote = cola.get()
+            if lote is None:
+                break
+            if isinstance(lote, Exception):
+                raise lote
+
+            # extraer las características de todo el lote
+            tiempos, frames, decodificados = lote
+            contar('frames_decodificados', decodificados - decodificados_previos)
+            contar('frames_extraidos', len(frames))
+            decodificados_previos = decodificados
+
+            caracteristicas = extraer_caracteristicas_lote(frames, tamano=tamano, tipo=tipo)
+
+            yield numpy.array(tiempos, dtype=numpy.float32), caracteristicas, decodificados
 
-    # abrir log
+    finally:
+        detener.set()
+        decodificador.join()
+        video.release()
+
+
+def caracteristicas_video_etapas(archivo: str, carpeta_log: str, fps_extraccion: int = 6,
+                                 tamano: Tuple[int, int] = (10, 10), tamano_lote: int = 64,
+                                 salto_busqueda: int = 0, tipo: str = 'gris') -> ReporteExtraccion:
+    """
+    Igual que caracteristicas_video, pero extrae por etapas (ver generar_caracteristicas) y escribe el resultado
+    al almacén una sola vez.
+
+    :param archivo: archivo del video.
+    :param carpeta_log: carpeta del almacén donde guardar las características.
+    :param fps_extraccion: número de frames por segundo a extraer.
+    :param tamano: el tamaño del mapa al cual reducir la dimension de la imagen.
+    :param tamano_lote: número de frames por lote.
+    :param salto_busqueda: salto mínimo entre frames para buscar por tiempo en vez de decodificar.
+    :param tipo: tipo de características (ver extraer_caracteristicas).
+
+    :return: un reporte de la extracción, con el error si no se pudo abrir el video.
+    """
     nombre = re.split('[/.]', archivo)[-2]
 
-    if not os.path.isdir(carpeta_log):
-        os.mkdir(carpeta_log)
-    log = open(f'{carpeta_log}/{nombre}.txt', 'w')
+    print(f'extrayendo caracteristicas de video {nombre} por etapas')
 
-    frame_n = 0  # número de frames
-    fps = video.get(cv2.CAP_PROP_FPS)  # frames por segundo (para calcular tiempo)
-    salto_frames = round(fps / fps_extraccion)  # frames a saltar
+    with etapa('extraccion') as medida:
+        try:
+            lotes = list(generar_caracteristicas(archivo, fps_extraccion=fps_extraccion, tamano=tamano,
+                                                 tamano_lote=tamano_lote, salto_busqueda=salto_busqueda, tipo=tipo))
+        except Exception as e:
+            return ReporteExtraccion(archivo, nombre, error=str(e))
 
-    print(f'extrayendo caracteristicas de video {nombre} ({fps:.2f} FPS)')
+        # guardar en el almacén
+        tiempos = numpy.concatenate([lote[0] for lote in lotes]) if lotes else numpy.empty(0, dtype=numpy.float32)
+        dimension = dimension_caracteristicas(tamano, tipo)
+        caracteristicas = numpy.concatenate([lote[1] for lote in lotes]) if lotes else \
+            numpy.empty((0, dimension), dtype=numpy.uint8)
+        Almacen(carpeta_log, dimension=dimension).agregar_video(nombre, tiempos, caracteristicas)
 
-    while video.grab():
+    segundos_video = float(tiempos[-1]) if tiempos.shape[0] > 0 else 0
+    print(f'la extracción de {segundos_video:.0f} segundos de video tomó {medida.duracion:.2f} segundos')
 
-        # obtener solo 1 de cada n frames
-        frame_n += 1
-        if frame_n % salto_frames != 0:
-            continue
+    return ReporteExtraccion(archivo, nombre, frames=tiempos.shape[0], segundos_video=segundos_video,
+                             tiempo=medida.duracion)
 
-        # sacar frame y asegurarse de que no hay errores
-        retval, frame = video.retrieve()
-        if not retval:
-            continue
 
-        # extraer caracteristicas y guardar en el archivo
-        vector = extraer_caracteristicas(frame, tamano=tamano)
-        log.write('{} {}\n'.format('%.3f' % (frame_n / fps), ' '.join(vector.astype(str))))
+def comparar_extraccion(archivo: str, fps_extraccion: int = 6, tamano: Tuple[int, int] = (10, 10),
+                        salto_busqueda: int = 0):
+    """
+    Compara la velocidad de extraer un video con el ciclo original (caracteristicas_video) y por etapas
+    (caracteristicas_video_etapas), en frames extraídos por segundo.
 
-    log.close()
-    video.release()
-    print(f'la extracción de {int(frame_n / fps)} segundos de video tomo {int(time.time() - t0)} segundos')
+    :param archivo: archivo del video.
+    :param fps_extraccion: número de frames por segundo a extraer.
+    :param tamano: el tamaño del mapa al cual reducir la dimension de la imagen.
+    :param salto_busqueda: salto mínimo entre frames para buscar por tiempo en la extracción por etapas.
+    """
+    with tempfile.TemporaryDirectory() as carpeta:
+        original = caracteristicas_video(archivo, f'{carpeta}/original', fps_extraccion=fps_extraccion,
+                                         tamano=tamano)
+        etapas = caracteristicas_video_etapas(archivo, f'{carpeta}/etapas', fps_extraccion=fps_extraccion,
+                                              tamano=tamano, salto_busqueda=salto_busqueda)
+
+    if not original.exito or not etapas.exito:
+        print(original.error or etapas.error)
+        return
 
+    print(f'ciclo original: {original.frames / original.tiempo:.1f} frames/s')
+    print(f'por etapas: {etapas.frames / etapas.tiempo:.1f} frames/s')
+    print(f'aceleración: {original.tiempo / etapas.tiempo:.2f}x')
     return
 
 
+def _extraer_video(archivo: str, carpeta_log: str, fps_extraccion: int, tamano: Tuple[int, int],
+                   tipo: str = 'gris') -> ReporteExtraccion:
+    """
+    Extrae un video dentro de un proceso del pool, convirtiendo cualquier excepción en un reporte de error.
+    """
+    try:
+        return caracteristicas_video(archivo, carpeta_log, fps_extraccion=fps_extraccion, tamano=tamano, tipo=tipo)
+    except Exception as e:
+        return ReporteExtraccion(archivo, re.split('[/.]', archivo)[-2], error=f'{type(e).__name__}: {e}')
+
+
 def caracteristicas_videos(carpeta: str, fps_extraccion: int = 6,
-                           tamano: Tuple[int, int] = (10, 10)):
+                           tamano: Tuple[int, int] = (10, 10), procesos: int = 1,
+                           tipo: str = 'gris') -> List[ReporteExtraccion]:
     """
     Extrae las caracteristicas de todos los archivos dentro de la carpeta especificada
-    y los guarda en una nueva carpeta.
+    y los guarda en una nueva carpeta. Con más de un proceso, cada video se extrae en un proceso del pool, que
+    escribe su propio resultado en el almacén, y se reporta el progreso a medida que terminan.
 
     :param carpeta: la carpeta desde la cuál obtener todos los videos.
     :param fps_extraccion: número de frames por segundo a extraer.
     :param tamano: el tamaño del mapa al cual reducir la dimension de cada frame.
+    :param procesos: número de procesos a usar (0 usa todos los núcleos).
+    :param tipo: tipo de características (ver extraer_caracteristicas), los hashes se guardan en la carpeta
+    {carpeta}_{tipo}_{tamano}_{fps} en vez de {carpeta}_car_{tamano}_{fps}.
+
+    :return: un reporte por video, en el orden en que terminaron.
     """
+    if procesos <= 0:
+        procesos = os.cpu_count()
 
     # obtener todos los archivos en la carpeta
-    videos = os.listdir(carpeta)
+    videos = [f'{carpeta}/{video}' for video in sorted(os.listdir(carpeta)) if video.endswith('.mp4')]
+    carpeta_log = f'{carpeta}_{"car" if tipo == "gris" else tipo}_{tamano}_{fps_extraccion}'
 
     # extraer la caracteristicas de cada comercial
-    for video in videos:
-        if video.endswith('.mp4'):
-            caracteristicas_video(f'{carpeta}/{video}', f'{carpeta}_car_{tamano}_{fps_extraccion}',
-                                  fps_extraccion=fps_extraccion, tamano=tamano)
+    reportes = []
+    if procesos == 1:
+        for video in videos:
+            reportes.append(_extraer_video(video, carpeta_log, fps_extraccion, tamano, tipo))
+            print(f'[{len(reportes)}/{len(videos)}] {reportes[-1]}')
 
-    return
+    else:
+        with ProcessPoolExecutor(max_workers=procesos) as pool:
+            futuros = [pool.submit(_extraer_video, video, carpeta_log, fps_extraccion, tamano, tipo)
+                       for video in videos]
+
+            for futuro in as_completed(futuros):
+                reportes.append(futuro.result())
+
+                # las métricas de los procesos del pool no llegan a este proceso, se cuentan desde los reportes
+                contar('frames_extraidos', reportes[-1].frames)
+                print(f'[{len(reportes)}/{len(videos)}] {reportes[-1]}')
+
+    # resumen de errores
+    fallidos = [reporte for reporte in reportes if not reporte.exito]
+    if fallidos:
+        print(f'{len(fallidos)} de {len(videos)} videos no se pudieron extraer:')
+        for reporte in fallidos:
+            print(f'  {reporte.archivo}: {reporte.error}')
+
+    return reportes
 
 
-def main(fps_extraccion, tamano):
+def main(fps_extraccion, tamano, procesos=1):
     """
     Extrae las caracteristicas de todos los capítulos de Naruto Shippuden.
 
     :param fps_extraccion: número de frames por segundo a extraer.
     :param tamano: el tamaño del mapa al cual reducir la dimension de cada frame.
+    :param procesos: número de procesos a usar (0 usa todos los núcleos).
     """
 
-    caracteristicas_videos('../videos/AMV', fps_extraccion, tamano)
-    # caracteristicas_videos('../videos/Shippuden', fps_extraccion, tamano)
+    caracteristicas_videos('../videos/AMV', fps_extraccion, tamano, procesos=procesos)
+    # caracteristicas_videos('../videos/Shippuden', fps_extraccion, tamano, procesos=procesos)
     return
 
 
 if __name__ == '__main__':
-    main(fps_extraccion=6, tamano=(10, 10))
+    main(fps_extraccion=6, tamano=(10, 10), procesos=int(sys.argv[1]) if len(sys.argv) > 1 else 1)
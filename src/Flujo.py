@@ -0,0 +1,108 @@
+import os
+import re
+from typing import Iterator, Tuple
+
+import numpy
+
+from Almacen import Almacen
+from Deteccion import DetectorIncremental, TablaCercanos
+from Extraccion import generar_caracteristicas
+from Indices import Index
+from Metricas import contar, etapa
+from Resultados import ResultadosKNN
+
+
+def buscar_lotes(lotes: Iterator[Tuple[numpy.ndarray, numpy.ndarray, int]], indice: Index, k: int = 5,
+                 checks=100) -> Iterator[Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray, numpy.ndarray]]:
+    """
+    Busca los k frames más cercanos de cada lote de características, con una llamada al índice por lote.
+
+    :param lotes: generador de lotes (tiempos, características, frames decodificados).
+    :param indice: el índice de busqueda a usar.
+    :param k: el número de frames cercanos a buscar.
+    :param checks: el número de checks a realizar en la búsqueda.
+
+    :return: un generador de lotes (tiempos, características, ids de los cercanos, distancias).
+    """
+    for tiempos, caracteristicas, _ in lotes:
+        with etapa('busqueda'):
+            cercanos, distancias = indice.search(caracteristicas, k=k, checks=checks, distancias=True)
+        contar('busquedas', caracteristicas.shape[0])
+        yield tiempos, caracteristicas, cercanos, distancias
+
+
+def buscar_clips_flujo(archivo: str, indice: Index, carpeta_resultados: str = '../videos/AMV_results',
+                       fps_extraccion: int = 6, tamano: Tuple[int, int] = (10, 10), k: int = 20, checks=500,
+                       max_errores_continuos: int = 7, tiempo_minimo: float = 1, max_offset: float = 0.0,
+                       tamano_lote: int = 64, carpeta_caracteristicas: str = None, carpeta_cercanos: str = None,
+                       tipo: str = 'gris'):
+    """
+    Busca los clips de un video en un solo flujo, sin pasar por archivos intermedios: los lotes de características
+    extraídas van directo al índice, y los frames cercanos de cada lote van directo a un DetectorIncremental. Cada
+    clip se escribe apenas ningún clip futuro puede afectarlo, y la memoria usada no depende del largo del video.
+
+    :param archivo: archivo del video.
+    :param indice: el índice de busqueda a usar.
+    :param carpeta_resultados: carpeta donde guardar los clips encontrados.
+    :param fps_extraccion: número de frames por segundo a extraer.
+    :param tamano: el tamaño del mapa al cual reducir la dimension de la imagen.
+    :param k: el número de frames cercanos a buscar.
+    :param checks: el número de checks a realizar en la búsqueda.
+    :param max_errores_continuos: máximos errores continuos para determinar que un clip terminó.
+    :param tiempo_minimo: tiempo mínimo para afirmar que un clip es válido.
+    :param max_offset: máxima distancia entre clips al combinarlos.
+    :param tamano_lote: número de frames por lote.
+    :param carpeta_caracteristicas: si se da, también guarda las características en el almacén de esta carpeta.
+    :param carpeta_cercanos: si se da, también guarda los frames cercanos en formato binario en esta carpeta.
+    :param tipo: tipo de características (ver Extraccion.extraer_caracteristicas), debe ser el mismo del índice.
+    """
+    nombre = re.split('[/.]', archivo)[-2]
+    print(f'buscando clips en {nombre} en flujo')
+
+    with etapa('flujo') as medida:
+        detector = DetectorIncremental(max_errores_continuos=max_errores_continuos, tiempo_minimo=tiempo_minimo,
+                                       max_offset=max_offset)
+
+        # intermedios, solo si se pidieron
+        intermedios = []
+
+        if not os.path.isdir(carpeta_resultados):
+            os.mkdir(carpeta_resultados)
+
+        n_clips = 0
+        with open(f'{carpeta_resultados}/{nombre}.txt', 'w') as log:
+            lotes = generar_caracteristicas(archivo, fps_extraccion=fps_extraccion, tamano=tamano,
+                                            tamano_lote=tamano_lote, tipo=tipo)
+
+            for tiempos, caracteristicas, cercanos, distancias in buscar_lotes(lotes, indice, k=k, checks=checks):
+                if carpeta_caracteristicas is not None or carpeta_cercanos is not None:
+                    intermedios.append((tiempos, caracteristicas, cercanos, distancias))
+
+                with etapa('deteccion'):
+                    resultados = ResultadosKNN(tiempos, cercanos, distancias, indice.etiquetas)
+                    clips = detector.agregar(TablaCercanos(resultados))
+
+                for clip in clips:
+                    log.write(f'{clip.texto(indice.etiquetas.nombres)}\n')
+                log.flush()
+                n_clips += len(clips)
+
+            for clip in detector.terminar():
+                log.write(f'{clip.texto(indice.etiquetas.nombres)}\n')
+                n_clips += 1
+
+        # guardar intermedios
+        if intermedios:
+            tiempos, caracteristicas, cercanos, distancias = (numpy.concatenate(columna)
+                                                              for columna in zip(*intermedios))
+
+            if carpeta_caracteristicas is not None:
+                Almacen(carpeta_caracteristicas, dimension=caracteristicas.shape[1]).agregar_video(
+                    nombre, tiempos, caracteristicas)
+            if carpeta_cercanos is not None:
+                ResultadosKNN(tiempos, cercanos, distancias, indice.etiquetas).guardar_bin(
+                    f'{carpeta_cercanos}/{nombre}')
+
+    contar('clips', n_clips)
+    print(f'se encontraron {n_clips} clips en {medida.duracion:.2f} segundos')
+    return
@@ -0,0 +1,164 @@
+import multiprocessing
+import time
+from typing import List
+
+import numpy
+
+from Etiquetas import Etiquetas
+from Indices import Index, KDTree, k_mejores
+
+
+def _trabajador(conexion, clase, datos: numpy.ndarray, etiquetas: Etiquetas, kwargs: dict):
+    """
+    Proceso de un fragmento: construye su índice y responde búsquedas (busquedas, k, checks) hasta recibir None.
+    """
+    try:
+        indice = clase(datos, etiquetas, **kwargs)
+        conexion.send(indice.build_time)
+    except Exception as e:
+        conexion.send(e)
+        return
+
+    del datos
+    while True:
+        mensaje = conexion.recv()
+        if mensaje is None:
+            break
+
+        busquedas, k, checks = mensaje
+        try:
+            conexion.send(indice.search(busquedas, k=k, checks=checks, distancias=True))
+        except Exception as e:
+            conexion.send(e)
+
+    conexion.close()
+
+
+def repartir_videos(etiquetas: Etiquetas, fragmentos: int) -> List[numpy.ndarray]:
+    """
+    Reparte los videos de la tabla de etiquetas en fragmentos con un número similar de frames, asignando cada video
+    (de mayor a menor) al fragmento con menos frames.
+
+    :param etiquetas: la tabla de etiquetas.
+    :param fragmentos: número de fragmentos.
+
+    :return: por cada fragmento, los ids globales (ordenados) de sus frames.
+    """
+    cantidades = numpy.bincount(etiquetas.video, minlength=len(etiquetas.nombres))
+
+    asignacion = numpy.zeros(cantidades.shape[0], dtype=numpy.int64)
+    totales = numpy.zeros(fragmentos, dtype=numpy.int64)
+    for video in numpy.argsort(-cantidades, kind='stable').tolist():
+        fragmento = int(numpy.argmin(totales))
+        asignacion[video] = fragmento
+        totales[fragmento] += cantidades[video]
+
+    fragmento_frame = asignacion[etiquetas.video]
+    return [numpy.flatnonzero(fragmento_frame == fragmento) for fragmento in range(fragmentos)
+            if totales[fragmento] > 0]
+
+
+class Fragmentado(Index):
+    """
+    Índice dividido en fragmentos por grupos de videos. Cada fragmento es un índice independiente (por defecto un
+    KDTree) que se construye y consulta en su propio proceso; las búsquedas se envían a todos los fragmentos en
+    paralelo, y sus k mejores resultados se juntan por distancia en los k mejores globales, con ids de la tabla
+    de etiquetas completa.
+    """
+
+    def __init__(self, datos: numpy.ndarray, etiquetas: Etiquetas, fragmentos: int, clase=KDTree, cores=1,
+                 **kwargs):
+        """
+        :param datos: matriz con un vector de características por fila.
+        :param etiquetas: tabla con la etiqueta de cada fila de datos.
+        :param fragmentos: número de fragmentos (y de procesos).
+        :param clase: clase del índice de cada fragmento.
+        :param cores: núcleos a usar en las búsquedas de cada fragmento.
+        :param kwargs: parámetros del índice de cada fragmento (por ejemplo trees).
+        """
+        self.cores = cores
+        self.etiquetas = etiquetas
+        self.cargado = False
+
+        t0 = time.time()
+        self.ids = repartir_videos(etiquetas, fragmentos)
+        self.conexiones = []
+        self.procesos = []
+
+        for ids in self.ids:
+            conexion, conexion_trabajador = multiprocessing.Pipe()
+            etiquetas_fragmento = Etiquetas(etiquetas[ids], etiquetas.nombres)
+
+            proceso = multiprocessing.Process(target=_trabajador, daemon=True,
+                                              args=(conexion_trabajador, clase, numpy.asarray(datos[ids]),
+                                                    etiquetas_fragmento, dict(kwargs, cores=cores)))
+            proceso.start()
+            conexion_trabajador.close()
+
+            self.conexiones.append(conexion)
+            self.procesos.append(proceso)
+
+        # esperar que todos los fragmentos terminen de construirse
+        for conexion in self.conexiones:
+            respuesta = conexion.recv()
+            if isinstance(respuesta, Exception):
+                self.cerrar()
+                raise respuesta
+        t1 = time.time()
+
+        self.build_time = t1 - t0
+
+    def search(self, busquedas, k=1, checks=10, distancias=False):
+        """
+        Busca los k vecinos más cercanos en todos los fragmentos en paralelo y junta los resultados.
+
+        :return: una matriz (n, k) con los índices globales de los vecinos de cada búsqueda, y si se piden las
+        distancias, otra matriz (n, k) con la distancia a cada vecino.
+        """
+        for conexion in self.conexiones:
+            conexion.send((busquedas, k, checks))
+
+        # recibir de todos los fragmentos antes de fallar, para no dejar respuestas sin leer en las conexiones
+        respuestas = [conexion.recv() for conexion in self.conexiones]
+        for respuesta in respuestas:
+            if isinstance(respuesta, Exception):
+                raise respuesta
+
+        resultados, dists = [], []
+        for (locales, dists_fragmento), ids in zip(respuestas, self.ids):
+            # pasar de ids del fragmento a ids globales, los vecinos faltantes (-1) siguen en -1 y quedan al final
+            faltantes = locales < 0
+            resultados.append(numpy.where(faltantes, -1, ids[numpy.where(faltantes, 0, locales)]))
+            dists.append(numpy.where(faltantes, numpy.inf, dists_fragmento))
+
+        resultados = numpy.concatenate(resultados, axis=1)
+        dists = numpy.concatenate(dists, axis=1)
+
+        # juntar los k mejores de todos los fragmentos
+        resultados, dists = k_mejores(resultados, dists, k)
+        resultados = resultados.astype(numpy.int32)
+
+        if distancias:
+            return resultados, dists
+
+        return resultados
+
+    def cerrar(self):
+        """
+        Termina los procesos de los fragmentos.
+        """
+        for conexion in self.conexiones:
+            try:
+                conexion.send(None)
+                conexion.close()
+            except (OSError, BrokenPipeError):
+                pass
+
+        for proceso in self.procesos:
+            proceso.join(timeout=5)
+
+        self.conexiones = []
+        self.procesos = []
+
+    def __del__(self):
+        self.cerrar()
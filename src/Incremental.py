@@ -0,0 +1,272 @@
+import os
+import sys
+import threading
+import time
+
+import numpy
+
+from Almacen import Almacen, sincronizar_carpeta
+from Etiquetas import Etiquetas
+from Indices import Exacto, Index, KDTree, k_mejores
+
+
+class _Estado:
+    """
+    Estado inmutable del índice incremental, para que las búsquedas vean siempre un estado consistente aunque otro
+    thread lo actualice: los datos y etiquetas del almacén leídos, y los índices sobre ellos.
+    """
+    __slots__ = ('datos', 'etiquetas', 'principal', 'ids_principal', 'delta', 'ids_delta', 'vivas', 'enmascaradas')
+
+    def __init__(self, datos: numpy.ndarray, etiquetas: Etiquetas, principal: Index, ids_principal: numpy.ndarray,
+                 delta: Index, ids_delta: numpy.ndarray, vivas: numpy.ndarray):
+        self.datos = datos
+        self.etiquetas = etiquetas
+        self.principal = principal
+        self.ids_principal = ids_principal
+        self.delta = delta
+        self.ids_delta = ids_delta
+        self.vivas = vivas
+        self.enmascaradas = int(ids_principal.shape[0] - vivas[ids_principal].sum())
+
+
+class Incremental(Index):
+    """
+    Índice sobre un almacén que va cambiando. Un índice principal (por defecto un KDTree) cubre las filas del almacén
+    que existían al construirlo, y un índice delta exacto (ver Exacto) cubre las filas agregadas después; cada
+    búsqueda consulta ambos y junta los k mejores. Las filas de videos eliminados o reemplazados se enmascaran en
+    los resultados del principal.
+
+    Los ids retornados son filas del almacén completo (incluidas las filas sin referencia), y la tabla de etiquetas
+    cubre todas esas filas. Si hay menos de k filas vigentes, las posiciones sin vecino tienen id -1. Cuando el
+    delta más las filas enmascaradas pasan una fracción del principal, este se reconstruye con las filas vigentes
+    en un thread de fondo, y se reemplaza al terminar.
+    """
+
+    def __init__(self, almacen: Almacen, clase=KDTree, umbral: float = 0.1, fondo: bool = True, cores: int = 1,
+                 **kwargs):
+        """
+        :param almacen: el almacén de características del corpus.
+        :param clase: clase del índice principal.
+        :param umbral: fracción del tamaño del principal que pueden alcanzar el delta y las filas enmascaradas
+        antes de reconstruirlo.
+        :param fondo: si es True, el principal se reconstruye en un thread de fondo, si no, al actualizar.
+        :param cores: núcleos a usar en las búsquedas.
+        :param kwargs: parámetros del índice principal (por ejemplo trees y cache). El principal se guarda en la
+        subcarpeta incremental de cache, y cada reconstrucción borra los archivos del principal anterior.
+        """
+        self.almacen = almacen
+        self.clase = clase
+        self.umbral = umbral
+        self.fondo = fondo
+        self.kwargs = kwargs
+        if kwargs.get('cache') is not None:
+            self.kwargs['cache'] = f'{kwargs["cache"]}/incremental'
+        self._cores = cores
+        self.cargado = False
+
+        self.lock = threading.Lock()
+        self.fusion = None
+
+        t0 = time.time()
+        with self.lock:
+            datos, etiquetas, vivas = self._leer_almacen()
+            principal, ids_principal = self._construir_principal(datos, etiquetas, vivas)
+            self.cargado = principal.cargado
+            self._cambiar_estado(datos, etiquetas, principal, ids_principal, vivas)
+        t1 = time.time()
+
+        self.build_time = t1 - t0
+
+    @property
+    def cores(self) -> int:
+        return self._cores
+
+    @cores.setter
+    def cores(self, cores: int):
+        self._cores = cores
+        self.estado.principal.cores = cores
+
+    @property
+    def etiquetas(self) -> Etiquetas:
+        # la tabla de etiquetas del estado vigente, que cubre todas las filas del almacén leídas
+        return self.estado.etiquetas
+
+    def _leer_almacen(self):
+        """
+        Abre el almacén y genera la tabla de etiquetas de todas sus filas.
+
+        :return: la matriz de características, la tabla de etiquetas de todas sus filas, y la máscara con las filas
+        vigentes (de los videos no eliminados ni reemplazados).
+        """
+        # la tabla se lee antes de abrir los datos, que solo crecen, para que cubran todas sus entradas
+        todas = self.almacen.entradas()
+        tiempos, datos = self.almacen.abrir()
+
+        # cada entrada del almacén cubre filas contiguas, en orden
+        entradas = [(nombre, inicio, cantidad) for nombre, inicio, cantidad in todas if inicio >= 0]
+        nombres = list(dict.fromkeys(nombre for nombre, _, _ in entradas))
+        indice_nombre = {nombre: i for i, nombre in enumerate(nombres)}
+
+        tabla = Etiquetas.de_videos([nombre for nombre, _, _ in entradas],
+                                    [cantidad for _, _, cantidad in entradas], tiempos).tabla
+        if entradas:
+            # las entradas reemplazadas de un video comparten su nombre
+            video_entrada = numpy.array([indice_nombre[nombre] for nombre, _, _ in entradas])
+            tabla['video'] = video_entrada[tabla['video']]
+        etiquetas = Etiquetas(tabla, nombres)
+
+        # la última entrada de cada video es la vigente (ver Almacen.videos)
+        vigentes = {}
+        for nombre, inicio, cantidad in todas:
+            vigentes[nombre] = (inicio, cantidad)
+
+        vivas = numpy.zeros(datos.shape[0], dtype=bool)
+        for inicio, cantidad in vigentes.values():
+            if inicio >= 0:
+                vivas[inicio:inicio + cantidad] = True
+
+        return datos, etiquetas, vivas
+
+    def _construir_principal(self, datos: numpy.ndarray, etiquetas: Etiquetas, vivas: numpy.ndarray):
+        ids = numpy.flatnonzero(vivas)
+        if ids.shape[0] == 0:
+            raise Exception(f'el almacén {self.almacen.carpeta} no tiene videos')
+
+        etiquetas = Etiquetas(etiquetas.tabla[ids], etiquetas.nombres)
+        principal = self.clase(numpy.asarray(datos[ids]), etiquetas, cores=self._cores, **self.kwargs)
+        return principal, ids
+
+    def _cambiar_estado(self, datos: numpy.ndarray, etiquetas: Etiquetas, principal: Index,
+                        ids_principal: numpy.ndarray, vivas: numpy.ndarray):
+        # el delta son las filas vigentes que el principal no cubre
+        en_principal = numpy.zeros(vivas.shape[0], dtype=bool)
+        en_principal[ids_principal] = True
+        ids_delta = numpy.flatnonzero(vivas & ~en_principal)
+
+        delta = Exacto(numpy.asarray(datos[ids_delta]), etiquetas) if ids_delta.shape[0] > 0 else None
+        self.estado = _Estado(datos, etiquetas, principal, ids_principal, delta, ids_delta, vivas)
+
+    def actualizar(self):
+        """
+        Relee el almacén: las filas nuevas pasan al delta y las de videos eliminados o reemplazados se enmascaran.
+        Si se pasa el umbral, reconstruye el principal.
+        """
+        with self.lock:
+            datos, etiquetas, vivas = self._leer_almacen()
+            self._cambiar_estado(datos, etiquetas, self.estado.principal, self.estado.ids_principal, vivas)
+
+            estado = self.estado
+            print(f'índice incremental: {estado.ids_delta.shape[0]:,d} filas en el delta, '
+                  f'{estado.enmascaradas:,d} filas enmascaradas')
+
+            pendientes = estado.ids_delta.shape[0] + estado.enmascaradas
+            if pendientes <= self.umbral * estado.ids_principal.shape[0] or self.fusion is not None:
+                return
+
+            self.fusion = threading.Thread(target=self._fusionar, daemon=True)
+
+        if self.fondo:
+            self.fusion.start()
+        else:
+            self._fusionar()
+
+    def _fusionar(self):
+        """
+        Reconstruye el principal con las filas vigentes y lo reemplaza. Las filas agregadas mientras tanto quedan
+        en el delta.
+        """
+        try:
+            t0 = time.time()
+            # los datos, etiquetas y filas vigentes se toman del mismo estado, aunque se actualice durante la
+            # reconstrucción
+            estado = self.estado
+            principal, ids_principal = self._construir_principal(estado.datos, estado.etiquetas, estado.vivas)
+
+            with self.lock:
+                anterior = self.estado.principal
+                estado = self.estado
+                self._cambiar_estado(estado.datos, estado.etiquetas, principal, ids_principal, estado.vivas)
+            print(f'índice principal reconstruido con {ids_principal.shape[0]:,d} filas en '
+                  f'{time.time() - t0:.1f} segundos')
+
+            # el principal anterior ya no se puede recargar, sus filas cambiaron
+            ruta = getattr(anterior, 'ruta_cache', None)
+            if ruta is not None and ruta != getattr(principal, 'ruta_cache', None):
+                for extension in ('flann', 'json'):
+                    if os.path.isfile(f'{ruta}.{extension}'):
+                        os.remove(f'{ruta}.{extension}')
+        finally:
+            self.fusion = None
+
+    def esperar(self):
+        """
+        Espera que termine la reconstrucción del principal, si hay una en curso.
+        """
+        fusion = self.fusion
+        if fusion is not None and fusion.is_alive():
+            fusion.join()
+
+    def search(self, busquedas, k=1, checks=10, distancias=False):
+        """
+        Busca los k vecinos más cercanos vigentes en el principal y el delta, y junta los resultados.
+
+        :return: una matriz (n, k) con las filas del almacén de los vecinos de cada búsqueda (-1 en las posiciones
+        sin vecino vigente), y si se piden las distancias, otra matriz (n, k) con la distancia a cada vecino
+        (infinita en las posiciones sin vecino).
+        """
+        estado = self.estado
+        busquedas = numpy.atleast_2d(numpy.asarray(busquedas))
+
+        ids, dists = self._buscar_principal(estado, busquedas, k, checks)
+
+        if estado.delta is not None:
+            ids_delta, dists_delta = estado.delta.search(busquedas, k=min(k, estado.ids_delta.shape[0]),
+                                                         distancias=True)
+            ids = numpy.concatenate((ids, estado.ids_delta[ids_delta]), axis=1)
+            dists = numpy.concatenate((dists, dists_delta), axis=1)
+
+        ids, dists = k_mejores(ids, dists, k)
+
+        # las filas enmascaradas quedan con distancia infinita, y siempre se entregan k columnas
+        ids = numpy.where(numpy.isfinite(dists), ids, -1).astype(numpy.int32)
+        if ids.shape[1] < k:
+            faltan = ((0, 0), (0, k - ids.shape[1]))
+            ids = numpy.pad(ids, faltan, constant_values=-1)
+            dists = numpy.pad(dists, faltan, constant_values=numpy.inf)
+
+        if distancias:
+            return ids, dists
+        return ids
+
+    def _buscar_principal(self, estado: _Estado, busquedas: numpy.ndarray, k: int, checks: int):
+        # se piden más vecinos si hay filas enmascaradas, hasta tener k vigentes por búsqueda
+        total = estado.ids_principal.shape[0]
+        vigentes = total - estado.enmascaradas
+        pedidos = min(k + min(estado.enmascaradas, k), total)
+
+        while True:
+            ids, dists = estado.principal.search(busquedas, k=pedidos, checks=checks, distancias=True)
+            filas = estado.ids_principal[ids]
+            validas = estado.vivas[filas]
+
+            if estado.enmascaradas == 0 or pedidos >= total or validas.sum(axis=1).min() >= min(k, vigentes):
+                break
+            pedidos = min(pedidos * 2, total)
+
+        dists = numpy.where(validas, dists, numpy.inf).astype(numpy.float32)
+        return filas, dists
+
+
+def main(carpeta: str):
+    """
+    Muestra el estado del índice incremental de un almacén, después de sincronizar sus archivos .txt.
+    """
+    sincronizar_carpeta(carpeta)
+    indice = Incremental(Almacen(carpeta), trees=10, cores=0, cache=f'{carpeta}/indices')
+    estado = indice.estado
+    print(f'{estado.ids_principal.shape[0]:,d} filas en el principal, {estado.ids_delta.shape[0]:,d} en el delta, '
+          f'{estado.enmascaradas:,d} enmascaradas')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1] if len(sys.argv) > 1 else '../videos/Shippuden_car_(10, 10)_6')
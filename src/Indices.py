@@ -1,36 +1,420 @@
+import hashlib
+import json
+import os
 import time
 
-import pyflann
 import numpy
 
+try:
+    import pyflann
+except ImportError:
+    pyflann = None
+
+from Etiquetas import Etiquetas
+
+
+def huella(arreglo: numpy.ndarray) -> str:
+    """
+    Calcula un hash del contenido de un arreglo, para identificar un corpus.
+
+    :param arreglo: el arreglo de numpy (o memmap).
+
+    :return: el hash sha1 en hexadecimal del contenido, forma y tipo del arreglo.
+    """
+    arreglo = numpy.ascontiguousarray(arreglo)
+
+    h = hashlib.sha1(f'{arreglo.shape} {arreglo.dtype.str}'.encode())
+    h.update(arreglo.data)
+    return h.hexdigest()
+
+
+def k_mejores(ids: numpy.ndarray, dists: numpy.ndarray, k: int, ordenar: bool = True):
+    """
+    Deja solo los k vecinos más cercanos de cada fila.
+
+    :param ids: matriz (n, c) con los ids de los candidatos de cada búsqueda.
+    :param dists: matriz (n, c) con la distancia a cada candidato.
+    :param k: número de vecinos a dejar.
+    :param ordenar: si es True, los vecinos quedan ordenados por distancia.
+
+    :return: 2 matrices (n, min(k, c)), una de ids y otra de distancias, en ese orden.
+    """
+    if dists.shape[1] > k:
+        seleccion = numpy.argpartition(dists, k - 1, axis=1)[:, :k]
+        ids = numpy.take_along_axis(ids, seleccion, axis=1)
+        dists = numpy.take_along_axis(dists, seleccion, axis=1)
+
+    if ordenar:
+        orden = numpy.argsort(dists, axis=1, kind='stable')
+        ids = numpy.take_along_axis(ids, orden, axis=1)
+        dists = numpy.take_along_axis(dists, orden, axis=1)
+
+    return ids, dists
+
+
+def completar(ids: numpy.ndarray, dists: numpy.ndarray, k: int):
+    """
+    Completa hasta k columnas los resultados de una búsqueda con menos candidatos que k, con id -1 y distancia
+    infinita.
+
+    :return: 2 matrices (n, k), una de ids y otra de distancias, en ese orden.
+    """
+    if ids.shape[1] < k:
+        faltan = ((0, 0), (0, k - ids.shape[1]))
+        ids = numpy.pad(ids, faltan, constant_values=-1)
+        dists = numpy.pad(dists, faltan, constant_values=numpy.inf)
+
+    return ids, dists
+
 
 class Index:
 
-    def __init__(self, datos: numpy.ndarray, etiquetas: numpy.ndarray, **kwargs):
+    def __init__(self, datos: numpy.ndarray, etiquetas: Etiquetas, cores: int = 1, cache: str = None,
+                 **kwargs):
+        """
+        Construye el índice sobre los datos, o lo recarga desde la carpeta cache si ya se había construido con los
+        mismos datos, etiquetas, algoritmo y parámetros.
+
+        :param datos: matriz con un vector de características por fila.
+        :param etiquetas: tabla con la etiqueta de cada fila de datos.
+        :param cores: núcleos a usar en las búsquedas (0 usa todos los disponibles).
+        :param cache: carpeta donde guardar y recargar el índice construido, None para no usar cache.
+        :param kwargs: parámetros del índice de pyflann.
+        """
+        if pyflann is None:
+            raise Exception('pyflann no está instalado, use un índice Exacto')
+
         self.flann = pyflann.FLANN()
+        self.cores = cores
+        self.etiquetas = etiquetas
+        self.cargado = False
 
         t0 = time.time()
-        self.flann.build_index(datos, **kwargs)
+        metadatos = self._metadatos(datos, kwargs) if cache is not None else None
+        # ruta (sin extensión) de los archivos del índice en la carpeta cache
+        self.ruta_cache = self._ruta_cache(cache, metadatos) if cache is not None else None
+        if cache is None or not self._cargar(cache, datos, metadatos):
+            self.flann.build_index(datos, **kwargs)
+
+            if cache is not None:
+                self._guardar(cache, metadatos)
         t1 = time.time()
 
         self.build_time = t1 - t0
-        self.etiquetas = etiquetas
 
-    def search(self, busquedas, k=1, checks=10) -> numpy.ndarray:
-        results, _ = self.flann.nn_index(busquedas, num_neighbors=k, checks=checks, cores=1)
-        return results
+    @staticmethod
+    def _ruta_cache(cache: str, metadatos: dict) -> str:
+        # el nombre depende de los parámetros, los datos y las etiquetas, para que índices con los mismos parámetros
+        # sobre distintos datos (p.ej. el KDTree de Main y el de Proyectado) no se sobrescriban en la misma carpeta
+        clave = json.dumps(metadatos, sort_keys=True)
+        return f'{cache}/{metadatos["clase"]}_{hashlib.sha1(clave.encode()).hexdigest()[:16]}'
+
+    def _metadatos(self, datos: numpy.ndarray, parametros: dict) -> dict:
+        return {
+            'clase': type(self).__name__,
+            'parametros': parametros,
+            'datos': huella(datos),
+            'etiquetas': self.etiquetas.huella(),
+        }
+
+    def _cargar(self, cache: str, datos: numpy.ndarray, metadatos: dict) -> bool:
+        """
+        Recarga el índice guardado en la carpeta cache, solo si fue construido con los mismos datos y etiquetas.
+
+        :return: True si se pudo recargar, False si no existe o está obsoleto y hay que reconstruirlo.
+        """
+        ruta = self._ruta_cache(cache, metadatos)
+        if not os.path.isfile(f'{ruta}.flann') or not os.path.isfile(f'{ruta}.json'):
+            return False
+
+        with open(f'{ruta}.json', 'r') as archivo:
+            guardados = json.load(archivo)
+
+        if guardados != metadatos:
+            print(f'el índice guardado en {ruta}.flann está obsoleto, se reconstruirá')
+            return False
+
+        try:
+            self.flann.load_index(f'{ruta}.flann', datos)
+        except Exception as e:
+            print(f'no se pudo recargar el índice {ruta}.flann ({e}), se reconstruirá')
+            self.flann = pyflann.FLANN()
+            return False
+
+        self.cargado = True
+        return True
+
+    def _guardar(self, cache: str, metadatos: dict):
+        if not os.path.isdir(cache):
+            os.makedirs(cache, exist_ok=True)
+
+        ruta = self._ruta_cache(cache, metadatos)
+        self.flann.save_index(f'{ruta}.flann')
+        with open(f'{ruta}.json', 'w') as archivo:
+            json.dump(metadatos, archivo)
+
+    def search(self, busquedas, k=1, checks=10, distancias=False):
+        """
+        Busca los k vecinos más cercanos de una o varias búsquedas en una sola llamada, usando self.cores núcleos
+        (0 usa todos los disponibles).
+
+        :return: una matriz (n, k) con los índices de los vecinos de cada búsqueda, y si se piden las distancias,
+        otra matriz (n, k) con la distancia a cada vecino.
+        """
+        results, dists = self.flann.nn_index(busquedas, num_neighbors=k, checks=checks, cores=self.cores)
+        if distancias:
+            return results.reshape(-1, k), dists.reshape(-1, k)
+
+        return results.reshape(-1, k)
 
 
 class Linear(Index):
-    def __init__(self, datos, etiquetas):
-        super().__init__(datos, etiquetas, algorithm="linear")
+    def __init__(self, datos, etiquetas, cores=1, cache=None):
+        super().__init__(datos, etiquetas, cores=cores, cache=cache, algorithm="linear")
 
 
 class KDTree(Index):
-    def __init__(self, datos, etiquetas, trees):
-        super().__init__(datos, etiquetas, algorithm="kdtree", trees=trees)
+    def __init__(self, datos, etiquetas, trees, cores=1, cache=None):
+        super().__init__(datos, etiquetas, cores=cores, cache=cache, algorithm="kdtree", trees=trees)
 
 
 class KMeansTree(Index):
-    def __init__(self, datos, etiquetas, branching):
-        super().__init__(datos, etiquetas, algorithm='kmeans', branching=branching, iterations=-1)
+    def __init__(self, datos, etiquetas, branching, cores=1, cache=None):
+        super().__init__(datos, etiquetas, cores=cores, cache=cache, algorithm='kmeans', branching=branching,
+                         iterations=-1)
+
+
+class Exacto(Index):
+    """
+    Búsqueda exacta de los k vecinos más cercanos (distancia L2 al cuadrado, como FLANN) solo con numpy, sin pyflann.
+    Expande ||q - x||² = ||q||² - 2 q·x + ||x||² para calcular las distancias de todo un lote de búsquedas contra un
+    bloque de datos con una multiplicación de matrices, y mantiene los k mejores con argpartition. Sirve como
+    referencia exacta para medir el recall de los otros índices (ver medir_recall).
+    """
+
+    def __init__(self, datos, etiquetas, memoria_max: int = 256 * 2 ** 20, cores=1, tipo=numpy.float32):
+        """
+        :param datos: matriz con un vector de características por fila.
+        :param etiquetas: tabla con la etiqueta de cada fila de datos.
+        :param memoria_max: bytes máximos a usar por bloque de datos al buscar.
+        :param cores: se ignora, la multiplicación de matrices usa los núcleos que tenga configurados numpy.
+        :param tipo: tipo de punto flotante con el que calcular las distancias.
+        """
+        self.cores = cores
+        self.etiquetas = etiquetas
+        self.cargado = False
+        self.datos = datos
+        self.memoria_max = memoria_max
+        self.tipo = tipo
+
+        t0 = time.time()
+        self.normas = numpy.empty(datos.shape[0], dtype=tipo)
+        for inicio, fin in self._bloques(1):
+            bloque = numpy.asarray(datos[inicio:fin], dtype=tipo)
+            self.normas[inicio:fin] = numpy.einsum('ij,ij->i', bloque, bloque)
+        t1 = time.time()
+
+        self.build_time = t1 - t0
+
+    def _bloques(self, n_busquedas: int):
+        # filas de datos por bloque, para que quepan en memoria_max el bloque, la matriz de distancias y su copia al
+        # juntarla con los mejores, y los candidatos y el resultado de argpartition (int64) de cada búsqueda
+        tamano = numpy.dtype(self.tipo).itemsize
+        por_fila = tamano * (self.datos.shape[1] + 2 * n_busquedas) + 2 * 8 * n_busquedas
+        filas = max(self.memoria_max // por_fila, 1)
+
+        for inicio in range(0, self.datos.shape[0], filas):
+            yield inicio, min(inicio + filas, self.datos.shape[0])
+
+    def search(self, busquedas, k=1, checks=10, distancias=False):
+        """
+        Busca los k vecinos más cercanos exactos de una o varias búsquedas. checks se ignora.
+
+        :return: una matriz (n, k) con los índices de los vecinos de cada búsqueda (-1 en las posiciones sin vecino
+        si hay menos de k filas), y si se piden las distancias, otra matriz (n, k) con la distancia a cada vecino
+        (infinita en las posiciones sin vecino).
+        """
+        busquedas = numpy.asarray(busquedas, dtype=self.tipo).reshape(-1, self.datos.shape[1])
+        normas_busquedas = numpy.einsum('ij,ij->i', busquedas, busquedas)
+
+        mejores = numpy.empty((busquedas.shape[0], 0), dtype=numpy.int64)
+        mejores_distancias = numpy.empty((busquedas.shape[0], 0), dtype=self.tipo)
+
+        for inicio, fin in self._bloques(busquedas.shape[0]):
+            bloque = numpy.asarray(self.datos[inicio:fin], dtype=self.tipo)
+            dists = busquedas @ bloque.T
+            dists *= -2
+            dists += normas_busquedas[:, None]
+            dists += self.normas[None, inicio:fin]
+
+            # juntar con los mejores hasta ahora y dejar solo los k mejores
+            candidatos = numpy.concatenate((mejores, numpy.arange(inicio, fin)[None, :].repeat(dists.shape[0], 0)),
+                                           axis=1)
+            dists = numpy.concatenate((mejores_distancias, dists), axis=1)
+            mejores, mejores_distancias = k_mejores(candidatos, dists, k, ordenar=False)
+
+        # ordenar por distancia
+        results, dists = k_mejores(mejores, mejores_distancias, k)
+        results, dists = completar(results.astype(numpy.int32), numpy.maximum(dists, 0).astype(numpy.float32), k)
+
+        if distancias:
+            return results, dists
+
+        return results
+
+
+if hasattr(numpy, 'bitwise_count'):
+    def popcount(palabras: numpy.ndarray) -> numpy.ndarray:
+        """
+        :return: el número de bits en 1 de cada palabra de un arreglo de uint64.
+        """
+        return numpy.bitwise_count(palabras)
+else:
+    # tabla con el número de bits en 1 de cada número de 16 bits
+    _BITS = numpy.array([bin(i).count('1') for i in range(2 ** 16)], dtype=numpy.uint8)
+
+    def popcount(palabras: numpy.ndarray) -> numpy.ndarray:
+        """
+        :return: el número de bits en 1 de cada palabra de un arreglo de uint64.
+        """
+        palabras = numpy.ascontiguousarray(palabras)
+        return _BITS[palabras.view(numpy.uint16)].reshape(palabras.shape + (4,)).sum(axis=-1, dtype=numpy.uint8)
+
+
+def empaquetar(datos: numpy.ndarray) -> numpy.ndarray:
+    """
+    Convierte una matriz de bytes (hashes binarios empaquetados) en una matriz de palabras uint64, rellenando con
+    ceros cada fila hasta un múltiplo de 8 bytes.
+    """
+    datos = numpy.asarray(datos, dtype=numpy.uint8)
+    if datos.ndim == 1:
+        datos = datos.reshape(1, -1)
+
+    relleno = -datos.shape[1] % 8
+    if relleno:
+        datos = numpy.pad(datos, ((0, 0), (0, relleno)))
+
+    return numpy.ascontiguousarray(datos).view(numpy.uint64)
+
+
+class Hamming(Index):
+    """
+    Búsqueda exacta de los k vecinos más cercanos por distancia de Hamming sobre hashes binarios (ver
+    Extraccion.extraer_hash), sin pyflann. Los hashes se guardan como palabras uint64, y la distancia a cada frame
+    es la suma del número de bits en 1 (popcount) del XOR de sus palabras, calculada por bloques de datos para todo un
+    lote de búsquedas a la vez.
+    """
+
+    def __init__(self, datos, etiquetas, memoria_max: int = 256 * 2 ** 20, cores=1):
+        """
+        :param datos: matriz (n, bytes) de uint8 con un hash empaquetado por fila.
+        :param etiquetas: tabla con la etiqueta de cada fila de datos.
+        :param memoria_max: bytes máximos a usar por bloque de datos al buscar.
+        :param cores: se ignora.
+        """
+        self.cores = cores
+        self.etiquetas = etiquetas
+        self.cargado = False
+        self.memoria_max = memoria_max
+
+        t0 = time.time()
+        self.palabras = empaquetar(datos)
+        t1 = time.time()
+
+        self.build_time = t1 - t0
+
+    def search(self, busquedas, k=1, checks=10, distancias=False):
+        """
+        Busca los k vecinos más cercanos por distancia de Hamming de uno o varios hashes. checks se ignora.
+
+        :return: una matriz (n, k) con los índices de los vecinos de cada búsqueda (-1 en las posiciones sin vecino
+        si hay menos de k filas), y si se piden las distancias, otra matriz (n, k) con el número de bits distintos
+        con cada vecino (infinito en las posiciones sin vecino).
+        """
+        busquedas = empaquetar(busquedas)
+        n, palabras = self.palabras.shape
+
+        # filas de datos por bloque, para que el XOR de todo el bloque con todas las búsquedas quepa en memoria_max
+        filas = max(self.memoria_max // (8 * palabras * busquedas.shape[0]), 1)
+
+        mejores = numpy.empty((busquedas.shape[0], 0), dtype=numpy.int64)
+        mejores_distancias = numpy.empty((busquedas.shape[0], 0), dtype=numpy.uint16)
+
+        for inicio in range(0, n, filas):
+            fin = min(inicio + filas, n)
+            diferencias = numpy.bitwise_xor(busquedas[:, None, :], self.palabras[None, inicio:fin, :])
+            dists = popcount(diferencias).sum(axis=2, dtype=numpy.uint16)
+
+            candidatos = numpy.concatenate((mejores, numpy.arange(inicio, fin)[None, :].repeat(dists.shape[0], 0)),
+                                           axis=1)
+            dists = numpy.concatenate((mejores_distancias, dists), axis=1)
+            mejores, mejores_distancias = k_mejores(candidatos, dists, k, ordenar=False)
+
+        results, dists = k_mejores(mejores, mejores_distancias, k)
+        results, dists = completar(results.astype(numpy.int32), dists.astype(numpy.float32), k)
+
+        if distancias:
+            return results, dists
+
+        return results
+
+
+def muestra_busquedas(datos: numpy.ndarray, n: int = 1000, ruido: float = 4.0, semilla: int = 0,
+                      devolver_filas: bool = False):
+    """
+    Elige frames del corpus al azar como búsquedas, con ruido gaussiano para simular frames reencodeados. Las
+    búsquedas tienen el mismo tipo que los datos, como exige FLANN.
+
+    :param datos: matriz con un vector de características por fila.
+    :param n: número de búsquedas.
+    :param ruido: desviación estándar del ruido.
+    :param semilla: semilla de la muestra y del ruido.
+    :param devolver_filas: si es True, también entrega las filas de datos elegidas.
+
+    :return: matriz (n, d) con una búsqueda por fila, y si se piden, las filas elegidas en orden.
+    """
+    rng = numpy.random.RandomState(semilla)
+    seleccion = numpy.sort(rng.choice(datos.shape[0], min(n, datos.shape[0]), replace=False))
+    busquedas = numpy.asarray(datos[seleccion], dtype=numpy.float32)
+    busquedas += rng.normal(0, ruido, busquedas.shape).astype(numpy.float32)
+
+    if numpy.issubdtype(datos.dtype, numpy.integer):
+        limites = numpy.iinfo(datos.dtype)
+        busquedas = numpy.clip(numpy.round(busquedas), limites.min, limites.max)
+
+    if devolver_filas:
+        return busquedas.astype(datos.dtype), seleccion
+
+    return busquedas.astype(datos.dtype)
+
+
+def recall(encontrados: numpy.ndarray, exactos: numpy.ndarray) -> float:
+    """
+    :param encontrados: matriz (n, k) con los ids encontrados por un índice para cada búsqueda.
+    :param exactos: matriz (n, k) con los ids de los k vecinos exactos de cada búsqueda.
+
+    :return: la fracción de los vecinos exactos que están entre los encontrados, entre 0 y 1 (las posiciones sin
+    vecino exacto, con id -1, no cuentan).
+    """
+    existentes = exactos >= 0
+    aciertos = ((encontrados[:, None, :] == exactos[:, :, None]).any(axis=2) & existentes).sum()
+    return float(aciertos) / max(int(existentes.sum()), 1)
+
+
+def medir_recall(indice: Index, oraculo: Index, busquedas: numpy.ndarray, k: int = 1, checks=10) -> float:
+    """
+    Mide el recall@k de un índice aproximado: la fracción de los k vecinos exactos (según el oráculo) que también
+    están entre los k vecinos encontrados por el índice.
+
+    :param indice: el índice a medir.
+    :param oraculo: un índice exacto sobre los mismos datos, como Exacto.
+    :param busquedas: matriz con una búsqueda por fila.
+    :param k: el número de vecinos a buscar.
+    :param checks: el número de checks a realizar en la búsqueda del índice.
+
+    :return: el recall@k, entre 0 y 1.
+    """
+    encontrados = indice.search(busquedas, k=k, checks=checks)
+    exactos = oraculo.search(busquedas, k=k)
+
+    return recall(encontrados, exactos)
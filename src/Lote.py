@@ -0,0 +1,196 @@
+import json
+import multiprocessing
+import os
+import re
+import sys
+import time
+from typing import List
+
+from Flujo import buscar_clips_flujo
+from Indices import Index
+from Main import parametros, preparar_indice
+from Metricas import Metricas, activar
+
+# índice y opciones compartidos con los procesos del pool (se heredan con fork, sin copiarlos)
+_indice: Index = None
+_opciones: dict = {}
+
+
+class ReporteVideo:
+    """
+    Resultado de buscar los clips de un video del lote: frames y segundos de video procesados, cuánto tomó, cuántos
+    clips se encontraron y el tiempo de cada etapa, o el error si falló.
+    """
+
+    def __init__(self, archivo: str, nombre: str, frames: int = 0, segundos_video: float = 0, tiempo: float = 0,
+                 clips: int = 0, etapas: dict = None, error: str = None):
+        self.archivo = archivo
+        self.nombre = nombre
+        self.frames = frames
+        self.segundos_video = segundos_video
+        self.tiempo = tiempo
+        self.clips = clips
+        self.etapas = etapas or {}
+        self.error = error
+
+    @property
+    def exito(self) -> bool:
+        return self.error is None
+
+    def __str__(self):
+        if not self.exito:
+            return f'{self.nombre}: error ({self.error})'
+
+        return f'{self.nombre}: {self.clips} clips, {self.frames} frames de {self.segundos_video:.0f} segundos ' \
+               f'en {self.tiempo:.1f} segundos ({self.frames / max(self.tiempo, 1e-9):.1f} frames/s, ' \
+               f'{self.segundos_video / max(self.tiempo, 1e-9):.1f}x tiempo real)'
+
+
+def listar_videos(entradas: List[str]) -> List[str]:
+    """
+    :param entradas: archivos de video o carpetas con videos .mp4.
+
+    :return: los archivos de video, con los de cada carpeta en orden alfabético.
+    """
+    videos = []
+    for entrada in entradas:
+        if os.path.isdir(entrada):
+            videos.extend(f'{entrada}/{video}' for video in sorted(os.listdir(entrada)) if video.endswith('.mp4'))
+        else:
+            videos.append(entrada)
+
+    return videos
+
+
+def _procesar(archivo: str) -> ReporteVideo:
+    """
+    Busca los clips de un video en flujo con el índice compartido, midiendo sus etapas con métricas propias.
+    """
+    nombre = re.split('[/.]', archivo)[-2]
+    metricas = activar(Metricas())
+
+    t0 = time.perf_counter()
+    try:
+        buscar_clips_flujo(archivo, _indice, **_opciones)
+    except Exception as e:
+        return ReporteVideo(archivo, nombre, error=f'{type(e).__name__}: {e}')
+    tiempo = time.perf_counter() - t0
+
+    frames = metricas.contadores.get('frames_extraidos', 0)
+    return ReporteVideo(archivo, nombre, frames=frames, segundos_video=frames / _opciones['fps_extraccion'],
+                        tiempo=tiempo, clips=metricas.contadores.get('clips', 0),
+                        etapas={etapa.nombre: etapa.segundos for etapa in metricas.etapas.values()})
+
+
+def buscar_clips_lote(videos: List[str], procesos: int = 0, carpeta_resultados: str = '../videos/AMV_results',
+                      dimension: int = 0, blanquear: bool = False, tipo: str = 'gris', umbral_tramos: float = 0,
+                      recall_objetivo: float = 0) -> List[ReporteVideo]:
+    """
+    Busca los clips de muchos AMVs: agrupa el corpus y construye (o recarga) el índice una sola vez, y luego procesa
+    los videos en paralelo, cada uno en flujo (ver Flujo.buscar_clips_flujo) en un proceso del pool. Los procesos se
+    crean con fork después de construir el índice, así lo comparten sin copiarlo ni reconstruirlo. No se evalúan
+    los resultados.
+
+    :param videos: archivos de video o carpetas con videos .mp4.
+    :param procesos: número de procesos a usar (0 usa todos los núcleos).
+    :param carpeta_resultados: carpeta donde guardar los clips encontrados de cada video.
+    :param dimension: ver Main.buscar_clips_amv.
+    :param blanquear: ver Main.buscar_clips_amv.
+    :param tipo: ver Main.buscar_clips_amv.
+    :param umbral_tramos: ver Main.buscar_clips_amv.
+    :param recall_objetivo: ver Main.buscar_clips_amv.
+
+    :return: un reporte por video, en el orden en que terminaron.
+    """
+    global _indice, _opciones
+
+    videos = listar_videos(videos)
+    if procesos <= 0:
+        procesos = os.cpu_count()
+
+    if procesos > 1 and 'fork' not in multiprocessing.get_all_start_methods():
+        print('este sistema no permite fork, los videos se procesarán en un solo proceso')
+        procesos = 1
+
+    tamano, fps, _ = parametros(tipo)
+    _indice, checks = preparar_indice(dimension=dimension, blanquear=blanquear, tipo=tipo,
+                                      umbral_tramos=umbral_tramos, recall_objetivo=recall_objetivo)
+    _opciones = dict(carpeta_resultados=carpeta_resultados, fps_extraccion=fps, tamano=tamano, k=20, checks=checks,
+                     max_errores_continuos=12, tiempo_minimo=1, max_offset=0.15, tipo=tipo)
+
+    # cada proceso busca con un solo núcleo, el paralelismo es entre videos
+    if procesos > 1:
+        _indice.cores = 1
+
+    t0 = time.perf_counter()
+    reportes = []
+    if procesos == 1:
+        for video in videos:
+            reportes.append(_procesar(video))
+            print(f'[{len(reportes)}/{len(videos)}] {reportes[-1]}')
+
+    else:
+        with multiprocessing.get_context('fork').Pool(processes=min(procesos, max(len(videos), 1))) as pool:
+            for reporte in pool.imap_unordered(_procesar, videos):
+                reportes.append(reporte)
+                print(f'[{len(reportes)}/{len(videos)}] {reporte}')
+    tiempo = time.perf_counter() - t0
+
+    resumir(reportes, tiempo)
+    return reportes
+
+
+def resumir(reportes: List[ReporteVideo], tiempo: float):
+    """
+    Imprime el rendimiento de cada video y del lote completo.
+
+    :param reportes: los reportes de cada video.
+    :param tiempo: segundos que tomó procesar todo el lote.
+    """
+    exitosos = [reporte for reporte in reportes if reporte.exito]
+
+    print(f'\n{"video":30s} {"clips":>6s} {"segundos":>9s} {"tiempo":>8s} {"frames/s":>9s} {"x real":>7s}')
+    for reporte in sorted(exitosos, key=lambda r: r.nombre):
+        print(f'{reporte.nombre[:30]:30s} {reporte.clips:6d} {reporte.segundos_video:9.0f} {reporte.tiempo:8.1f} '
+              f'{reporte.frames / max(reporte.tiempo, 1e-9):9.1f} '
+              f'{reporte.segundos_video / max(reporte.tiempo, 1e-9):7.1f}')
+
+    frames = sum(reporte.frames for reporte in exitosos)
+    segundos_video = sum(reporte.segundos_video for reporte in exitosos)
+    print(f'\n{len(exitosos)} videos ({segundos_video / 60:.0f} minutos) en {tiempo:.1f} segundos: '
+          f'{frames / max(tiempo, 1e-9):.1f} frames/s, {segundos_video / max(tiempo, 1e-9):.1f}x tiempo real, '
+          f'{len(exitosos) / max(tiempo, 1e-9) * 3600:.0f} videos/hora')
+
+    fallidos = [reporte for reporte in reportes if not reporte.exito]
+    if fallidos:
+        print(f'{len(fallidos)} de {len(reportes)} videos fallaron:')
+        for reporte in fallidos:
+            print(f'  {reporte.archivo}: {reporte.error}')
+
+
+def guardar_reportes(archivo: str, reportes: List[ReporteVideo]):
+    """
+    Guarda los reportes de cada video en un archivo JSON.
+    """
+    carpeta = os.path.dirname(archivo)
+    if carpeta and not os.path.isdir(carpeta):
+        os.makedirs(carpeta, exist_ok=True)
+
+    with open(archivo, 'w') as salida:
+        json.dump([vars(reporte) for reporte in reportes], salida, indent=2)
+
+
+if __name__ == '__main__':
+    # python Lote.py video.mp4|carpeta [...] [--procesos=N] [--reporte=lote.json] y las opciones de Main
+    opciones = dict(argumento[2:].split('=', 1) for argumento in sys.argv[1:] if argumento.startswith('--') and
+                    '=' in argumento)
+    entradas = [argumento for argumento in sys.argv[1:] if not argumento.startswith('--')] or ['../videos/AMV']
+
+    resultado = buscar_clips_lote(entradas, procesos=int(opciones.get('procesos', 0)),
+                                  dimension=int(opciones.get('pca', opciones.get('blanqueo', 0))),
+                                  blanquear='blanqueo' in opciones, tipo=opciones.get('hash', 'gris'),
+                                  umbral_tramos=float(opciones.get('tramos', 0)),
+                                  recall_objetivo=float(opciones.get('recall', 0)))
+
+    if 'reporte' in opciones:
+        guardar_reportes(opciones['reporte'], resultado)
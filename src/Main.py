@@ -1,42 +1,376 @@
-import time
+import json
+import os
+import shutil
 import sys
+from typing import Tuple
 
-from BusquedaKNN import frames_mas_cercanos_video, agrupar_caracteristicas
+import numpy
+
+from Ajuste import ARCHIVO_PERFIL, Perfil, ajustar_indice
+from Almacen import Almacen, dimension_caracteristicas, sincronizar_carpeta
+from BusquedaKNN import frames_mas_cercanos_video, agrupar_caracteristicas, colapsar_tramos
+from Cache import Cache, huella_archivo
 from Deteccion import buscar_secuencias
+from Etiquetas import Etiquetas
 from Evaluacion import evaluar_resultados
-from Extraccion import caracteristicas_video
-from Indices import KDTree
+from Extraccion import caracteristicas_video_etapas
+from Flujo import buscar_clips_flujo
+from Incremental import Incremental
+from Indices import Hamming, Index, KDTree
+from Metricas import Metricas, activar, etapa
+from Proyeccion import Proyeccion, Proyectado
+from Resultados import ResultadosKNN
+from Servicio import Cliente
 
 
-def buscar_clips_amv(video: str):
-    carpeta = '../videos/AMV'
+def parametros(tipo: str = 'gris') -> Tuple[Tuple[int, int], int, str]:
+    """
+    :param tipo: tipo de características, 'gris' o un hash binario ('mediana' o 'dct').
 
-    tamano = (10, 10)
+    :return: el tamaño de las características, los fps de extracción y el sufijo de sus carpetas, en ese orden.
+    """
+    tamano = (10, 10) if tipo == 'gris' else (16, 8)
     fps = 6
+    return tamano, fps, f'{"car" if tipo == "gris" else tipo}_{tamano}_{fps}'
+
+
+def preparar_indice(dimension: int = 0, blanquear: bool = False, tipo: str = 'gris', umbral_tramos: float = 0,
+                    recall_objetivo: float = 0, incremental: bool = False, carpeta_videos: str = '../videos',
+                    cache: Cache = None) -> Tuple[Index, int]:
+    """
+    Agrupa las características del corpus y construye (o recarga) su índice. Los parámetros son los de
+    buscar_clips_amv.
+
+    :param incremental: si es True, usa un índice Incremental sobre el almacén del corpus, que se puede actualizar
+    con los episodios agregados o eliminados sin reconstruirlo (solo con características 'gris', sin proyección ni
+    tramos).
+    :param cache: si se da, las etiquetas del corpus se guardan como un artefacto de esta cache (ver
+    BusquedaKNN.agrupar_caracteristicas). El índice tiene su propia cache, con la huella de los datos como clave.
+
+    :return: el índice y el número de checks a usar en las búsquedas, en ese orden.
+    """
+    tamano, fps, sufijo = parametros(tipo)
+    carpeta = f'{carpeta_videos}/Shippuden_{sufijo}'
+
+    if incremental:
+        if tipo != 'gris' or dimension > 0 or umbral_tramos > 0:
+            raise Exception('el índice incremental solo se puede usar con características gris, sin proyección ni '
+                            'tramos')
+
+        sincronizar_carpeta(carpeta)
+        with etapa('indice'):
+            indice = Incremental(Almacen(carpeta), trees=10, cores=0, cache=f'{carpeta}/indices')
+        print(f'la {"carga" if indice.cargado else "construcción"} del índice tomó {indice.build_time:.1f} segundos')
+        return indice, 500
+
+    etiquetas, caracteristicas = agrupar_caracteristicas(carpeta, recargar=True, tamano=tamano, tipo=tipo,
+                                                         cache=cache)
+
+    if umbral_tramos > 0 and tipo == 'gris':
+        with etapa('tramos'):
+            etiquetas, caracteristicas = colapsar_tramos(etiquetas, caracteristicas, umbral=umbral_tramos)
+        print(f'{len(etiquetas):,d} tramos después de colapsar frames casi iguales')
+
+    checks = 500
+    with etapa('indice'):
+        if tipo != 'gris':
+            indice = Hamming(caracteristicas, etiquetas)
+        elif dimension > 0:
+            proyeccion = Proyeccion.obtener(carpeta, caracteristicas, etiquetas, dimension=dimension,
+                                            blanquear=blanquear)
+            indice = Proyectado(caracteristicas, etiquetas, proyeccion, trees=10, cores=0,
+                                cache=f'{carpeta}/indices')
+        else:
+            perfil = Perfil.cargar(carpeta, etiquetas)
+            if perfil is None and recall_objetivo > 0:
+                perfil = ajustar_indice(caracteristicas, etiquetas, recall_objetivo=recall_objetivo, k=20)
+                perfil.guardar(carpeta)
+
+            if perfil is not None:
+                print(f'usando el perfil de índice {perfil}')
+                indice = perfil.construir(caracteristicas, etiquetas, cores=0,
+                                          cache=f'{carpeta}/indices')
+                checks = perfil.checks
+            else:
+                indice = KDTree(datos=caracteristicas, etiquetas=etiquetas, trees=10, cores=0,
+                                cache=f'{carpeta}/indices')
+    print(f'la {"carga" if indice.cargado else "construcción"} del índice tomó {indice.build_time:.1f} segundos')
+
+    return indice, checks
+
+
+def _huella_corpus(carpeta: str, tamano: Tuple[int, int], tipo: str, **opciones) -> dict:
+    """
+    Identifica el corpus y las opciones de su índice sin cargarlo: la huella del almacén (ver Almacen.huella),
+    después de sincronizar sus archivos .txt, y el perfil de índice guardado.
+    """
+    if os.path.isdir(carpeta):
+        sincronizar_carpeta(carpeta)
+
+    perfil = None
+    if os.path.isfile(f'{carpeta}/{ARCHIVO_PERFIL}'):
+        with open(f'{carpeta}/{ARCHIVO_PERFIL}', 'r') as archivo:
+            perfil = archivo.read()
+
+    almacen = Almacen(carpeta, dimension=dimension_caracteristicas(tamano, tipo))
+    return {'almacen': almacen.huella(), 'perfil': perfil, 'tipo': tipo, **opciones}
+
 
-    # extracción de caracteísticas
-    caracteristicas_video(f'{carpeta}/{video}.mp4', f'{carpeta}_car_{tamano}_{fps}',
-                          fps_extraccion=fps, tamano=tamano)
+# extracción de cada video del almacén de los AMV: clave de la extracción y su entrada en el almacén
+ARCHIVO_EXTRACCIONES = 'extracciones.json'
 
-    # busqueda de vecinos mas cercanos
-    t0 = time.time()
-    etiquetas, caracteristicas = agrupar_caracteristicas(f'../videos/Shippuden_car_{tamano}_{fps}',
-                                                         recargar=True, tamano=tamano)
-    print(f'la agrupación de datos tomó {int(time.time() - t0)} segundos')
 
-    indice = KDTree(datos=caracteristicas, etiquetas=etiquetas, trees=10)
-    print(f'la construcción del índice tomó {indice.build_time:.1f} segundos')
+def _extracciones(carpeta_log: str) -> dict:
+    ruta = f'{carpeta_log}/{ARCHIVO_EXTRACCIONES}'
+    if not os.path.isfile(ruta):
+        return {}
+
+    with open(ruta, 'r') as entrada:
+        return json.load(entrada)
+
+
+def _registrar_extraccion(almacen: Almacen, nombre: str, clave: str):
+    extracciones = _extracciones(almacen.carpeta)
+    extracciones[nombre] = [clave, *almacen.videos()[nombre]]
+
+    # escribir y renombrar, para que otro proceso nunca lea el archivo a medio escribir
+    temporal = f'{almacen.carpeta}/.{ARCHIVO_EXTRACCIONES}.{os.getpid()}'
+    with open(temporal, 'w') as salida:
+        json.dump(extracciones, salida, indent=2)
+    os.replace(temporal, f'{almacen.carpeta}/{ARCHIVO_EXTRACCIONES}')
+
+
+def _guardar_extraccion(cache: Cache, clave: str, almacen: Almacen, nombre: str):
+    tiempos, caracteristicas = almacen.leer_video(nombre)
+    with cache.guardar(clave) as temporal:
+        numpy.save(f'{temporal}/tiempos.npy', tiempos)
+        numpy.save(f'{temporal}/caracteristicas.npy', caracteristicas)
+
+
+def _extraer(cache: Cache, archivo: str, carpeta_log: str, fps: int, tamano: Tuple[int, int], tipo: str) -> str:
+    """
+    Extrae las características de un video al almacén de la carpeta log. Si el almacén ya tiene una extracción
+    vigente con el mismo contenido y parámetros (registrada en extracciones.json) se usa tal cual, y si no, pero la
+    cache la tiene, se copia desde la cache.
+
+    :return: la clave de la extracción.
+    """
+    nombre = os.path.splitext(os.path.basename(archivo))[0]
+    clave = Cache.clave('extraccion', video=huella_archivo(archivo), fps=fps, tamano=tamano, tipo=tipo)
+    almacen = Almacen(carpeta_log, dimension=dimension_caracteristicas(tamano, tipo))
+
+    # la entrada del almacén es vigente si nadie la reemplazó después de registrarla
+    registro = _extracciones(carpeta_log).get(nombre)
+    if registro is not None and registro[0] == clave and list(almacen.videos().get(nombre, ())) == registro[1:]:
+        if cache is not None and cache.obtener(clave) is None:
+            _guardar_extraccion(cache, clave, almacen, nombre)
+
+        print(f'características de {nombre} ya extraídas en el almacén')
+        return clave
+
+    ruta = cache.obtener(clave) if cache is not None else None
+    if ruta is None:
+        reporte = caracteristicas_video_etapas(archivo, carpeta_log, fps_extraccion=fps, tamano=tamano, tipo=tipo)
+        if not reporte.exito:
+            raise Exception(f'no se pudo extraer {archivo}: {reporte.error}')
+
+        if cache is not None:
+            _guardar_extraccion(cache, clave, almacen, nombre)
+
+    else:
+        # el almacén puede tener otra versión del video
+        tiempos, caracteristicas = numpy.load(f'{ruta}/tiempos.npy'), numpy.load(f'{ruta}/caracteristicas.npy')
+        if nombre not in almacen.videos() or not all(numpy.array_equal(a, b) for a, b in
+                                                     zip(almacen.leer_video(nombre), (tiempos, caracteristicas))):
+            almacen.agregar_video(nombre, tiempos, caracteristicas)
+        print(f'características de {nombre} recuperadas de la cache')
+
+    _registrar_extraccion(almacen, nombre, clave)
+    return clave
 
-    frames_mas_cercanos_video(f'../videos/AMV_car_{tamano}_{fps}/{video}.txt',
-                              f'../videos/AMV_cerc_{tamano}_{fps}',
-                              indice=indice, checks=500, k=20)
 
-    # detección de secuencias
-    buscar_secuencias(f'../videos/AMV_cerc_{tamano}_{fps}/{video}.txt',
-                      max_errores_continuos=12, tiempo_minimo=1, max_offset=0.15)
+def _recuperar_cercanos(cache: Cache, clave: str, carpeta_cercanos: str) -> bool:
+    """
+    Copia los frames cercanos de la cache a la carpeta dada, si están y sus etiquetas siguen existiendo.
+    """
+    ruta = cache.obtener(clave)
+    if ruta is None:
+        return False
+
+    with open(f'{ruta}/{ResultadosKNN.ARCHIVO_ETIQUETAS}', 'r') as archivo:
+        carpeta_etiquetas = archivo.readline().rstrip('\n')
+
+    # las etiquetas pueden ser otro artefacto de la cache, que también se marca como usado
+    if os.path.dirname(carpeta_etiquetas) == os.path.abspath(cache.carpeta) and \
+            cache.obtener(os.path.basename(carpeta_etiquetas)) is None:
+        return False
+    if not Etiquetas.existe(carpeta_etiquetas):
+        return False
+
+    shutil.rmtree(carpeta_cercanos, ignore_errors=True)
+    shutil.copytree(ruta, carpeta_cercanos)
+    print(f'frames cercanos de {os.path.basename(carpeta_cercanos)} recuperados de la cache')
+    return True
+
+
+def _guardar_cercanos(cache: Cache, clave: str, carpeta_cercanos: str):
+    """
+    Guarda los frames cercanos en la cache. Si sus etiquetas no están en la cache, se guarda una copia con ellos, y
+    si están, el artefacto depende del de las etiquetas (ver Cache.limpiar).
+    """
+    with open(f'{carpeta_cercanos}/{ResultadosKNN.ARCHIVO_ETIQUETAS}', 'r') as archivo:
+        carpeta_etiquetas, huella = archivo.read().splitlines()[:2]
+
+    # si las etiquetas son otro artefacto de la cache, no se pueden eliminar mientras se usen estos frames cercanos
+    en_cache = os.path.dirname(carpeta_etiquetas) == os.path.abspath(cache.carpeta)
+    dependencias = [os.path.basename(carpeta_etiquetas)] if en_cache else []
+
+    with cache.guardar(clave, dependencias=dependencias) as temporal:
+        for archivo in os.listdir(carpeta_cercanos):
+            shutil.copy(f'{carpeta_cercanos}/{archivo}', temporal)
+
+        if not en_cache:
+            Etiquetas.cargar(carpeta_etiquetas).guardar(temporal)
+            with open(f'{temporal}/{ResultadosKNN.ARCHIVO_ETIQUETAS}', 'w') as archivo:
+                archivo.write(f'{os.path.abspath(cache.ruta(clave))}\n{huella}\n')
+
+
+def _recuperar_resultados(cache: Cache, clave: str, carpeta_resultados: str, video: str) -> bool:
+    """
+    Copia los clips encontrados de la cache a la carpeta de resultados, si están.
+    """
+    ruta = cache.obtener(clave)
+    if ruta is None:
+        return False
+
+    os.makedirs(carpeta_resultados, exist_ok=True)
+    shutil.copy(f'{ruta}/{video}.txt', f'{carpeta_resultados}/{video}.txt')
+    print(f'clips de {video} recuperados de la cache')
+    return True
+
+
+def _guardar_resultados(cache: Cache, clave: str, carpeta_resultados: str, video: str):
+    with cache.guardar(clave) as temporal:
+        shutil.copy(f'{carpeta_resultados}/{video}.txt', temporal)
+
+
+def buscar_clips_amv(video: str, flujo: bool = False, intermedios: bool = False, dimension: int = 0,
+                     blanquear: bool = False, tipo: str = 'gris', umbral_tramos: float = 0,
+                     recall_objetivo: float = 0, reporte: str = None, perfilador: str = None,
+                     servicio: int = 0, carpeta_videos: str = '../videos', evaluar: bool = True,
+                     max_errores_continuos: int = 12, tiempo_minimo: float = 1, max_offset: float = 0.15,
+                     tamano_cache: int = 2 * 1024 ** 3):
+    """
+    Busca los clips de un AMV y evalúa los resultados.
+
+    Cada etapa (extracción, agrupación, búsqueda y detección) guarda su resultado en una cache direccionada por
+    contenido (ver Cache), con una clave que depende de sus entradas y parámetros, y se salta si ya está. Así, al
+    cambiar solo los parámetros de la detección no se vuelve a extraer, cargar el índice ni buscar.
+
+    :param video: nombre del AMV.
+    :param flujo: si es True, extrae, busca y detecta en un solo flujo en memoria (ver Flujo.buscar_clips_flujo).
+    :param intermedios: en modo flujo, si es True también guarda las características y los frames cercanos.
+    :param dimension: si es mayor a 0, proyecta las características a esta dimensión con PCA antes de indexarlas
+    (ver Proyeccion).
+    :param blanquear: si se proyecta, blanquea las componentes.
+    :param tipo: tipo de características, 'gris' o un hash binario ('mediana' o 'dct') que se busca con un índice
+    Hamming (ver Extraccion.extraer_caracteristicas).
+    :param umbral_tramos: si es mayor a 0, colapsa los tramos de frames casi iguales del corpus antes de indexarlo
+    (ver BusquedaKNN.colapsar_tramos).
+    :param recall_objetivo: si es mayor a 0 y el corpus no tiene un perfil de índice guardado, ajusta el índice para
+    alcanzar este recall@k y guarda el perfil (ver Ajuste). Si hay un perfil guardado, siempre se usa.
+    :param reporte: si se da, guarda las métricas de la corrida (tiempo y memoria de cada etapa y contadores) en este
+    archivo JSON (ver Metricas).
+    :param perfilador: perfilador de las etapas, None, 'cprofile' o 'muestreo'.
+    :param servicio: si es mayor a 0, busca con el índice del servicio que escucha en este puerto (ver Servicio) en
+    vez de cargar el corpus y el índice.
+    :param carpeta_videos: carpeta con los videos (AMV y Shippuden) y donde se guardan las características y los
+    resultados (AMV_results).
+    :param evaluar: si es False, no se evalúan los resultados (la evaluación es interactiva, ver Evaluacion).
+    :param max_errores_continuos: ver Deteccion.buscar_secuencias.
+    :param tiempo_minimo: ver Deteccion.buscar_secuencias.
+    :param max_offset: ver Deteccion.buscar_secuencias.
+    :param tamano_cache: tamaño máximo en bytes de la cache en carpeta_videos/cache, 0 para no usarla.
+    """
+    metricas = activar(Metricas(perfil=perfilador))
+
+    carpeta = f'{carpeta_videos}/AMV'
+    carpeta_resultados = f'{carpeta_videos}/AMV_results'
+    cache = Cache(f'{carpeta_videos}/cache', max_bytes=tamano_cache) if tamano_cache > 0 else None
+    deteccion = dict(max_errores_continuos=max_errores_continuos, tiempo_minimo=tiempo_minimo, max_offset=max_offset)
+
+    tamano, fps, sufijo = parametros(tipo)
+
+    # carpeta de frames cercanos de este tipo
+    carpeta_cercanos = f'{carpeta}_cerc_{tamano}_{fps}' if tipo == 'gris' else f'{carpeta}_cerc_{sufijo}'
+
+    # índice del servicio, el del corpus se prepara solo si alguna etapa no está en la cache
+    indice, checks, corpus = None, 0, None
+    if servicio > 0:
+        indice = Cliente(puerto=servicio)
+        checks = indice.checks
+        if indice.tipo != tipo:
+            raise Exception(f'el servicio usa características {indice.tipo}, no {tipo}')
+        corpus = {'servicio': indice.etiquetas.huella(), 'checks': checks}
+    elif cache is not None:
+        corpus = _huella_corpus(f'{carpeta_videos}/Shippuden_{sufijo}', tamano=tamano, tipo=tipo, dimension=dimension,
+                                blanquear=blanquear, umbral_tramos=umbral_tramos, recall_objetivo=recall_objetivo)
+
+    if flujo:
+        clave = None
+        if cache is not None and not intermedios:
+            clave = Cache.clave('flujo', video=huella_archivo(f'{carpeta}/{video}.mp4'), fps=fps, tamano=tamano,
+                                tipo=tipo, corpus=corpus, k=20, **deteccion)
+
+        if clave is None or not _recuperar_resultados(cache, clave, carpeta_resultados, video):
+            if indice is None:
+                indice, checks = preparar_indice(dimension=dimension, blanquear=blanquear, tipo=tipo,
+                                                 umbral_tramos=umbral_tramos, recall_objetivo=recall_objetivo,
+                                                 carpeta_videos=carpeta_videos, cache=cache)
+
+            buscar_clips_flujo(f'{carpeta}/{video}.mp4', indice, carpeta_resultados=carpeta_resultados,
+                               fps_extraccion=fps, tamano=tamano, checks=checks, k=20, tipo=tipo,
+                               carpeta_caracteristicas=f'{carpeta}_{sufijo}' if intermedios else None,
+                               carpeta_cercanos=carpeta_cercanos if intermedios else None, **deteccion)
+            if clave is not None:
+                _guardar_resultados(cache, clave, carpeta_resultados, video)
+
+    else:
+        # extracción de caracteísticas
+        clave = _extraer(cache, f'{carpeta}/{video}.mp4', f'{carpeta}_{sufijo}', fps=fps, tamano=tamano, tipo=tipo)
+
+        # busqueda de vecinos mas cercanos
+        if cache is not None:
+            clave = Cache.clave('busqueda', caracteristicas=clave, corpus=corpus, k=20)
+
+        if cache is None or not _recuperar_cercanos(cache, clave, f'{carpeta_cercanos}/{video}'):
+            if indice is None:
+                indice, checks = preparar_indice(dimension=dimension, blanquear=blanquear, tipo=tipo,
+                                                 umbral_tramos=umbral_tramos, recall_objetivo=recall_objetivo,
+                                                 carpeta_videos=carpeta_videos, cache=cache)
+
+            frames_mas_cercanos_video(f'{carpeta}_{sufijo}/{video}', carpeta_cercanos,
+                                      indice=indice, checks=checks, k=20)
+            if cache is not None:
+                _guardar_cercanos(cache, clave, f'{carpeta_cercanos}/{video}')
+
+        # detección de secuencias
+        if cache is not None:
+            clave = Cache.clave('deteccion', cercanos=clave, motor='candidatos', **deteccion)
+
+        if cache is None or not _recuperar_resultados(cache, clave, carpeta_resultados, video):
+            buscar_secuencias(f'{carpeta_cercanos}/{video}', carpeta_resultados=carpeta_resultados, **deteccion)
+            if cache is not None:
+                _guardar_resultados(cache, clave, carpeta_resultados, video)
 
     # evaluación
-    evaluar_resultados(video)
+    if evaluar:
+        with etapa('evaluacion'):
+            evaluar_resultados(video, carpeta_videos=carpeta_videos)
+
+    if reporte is not None:
+        metricas.guardar(reporte)
+        print(f'métricas guardadas en {reporte}')
     return
 
 
@@ -46,4 +380,19 @@ if __name__ == '__main__':
     else:
         nombre = sys.argv[1]
 
-    buscar_clips_amv(nombre)
+    # --pca=N proyecta a N dimensiones, --blanqueo=N además blanquea, --hash=mediana o --hash=dct usa hashes,
+    # --tramos=U colapsa los frames casi iguales con umbral U, --recall=R ajusta el índice para recall@20 R,
+    # --reporte=archivo.json guarda las métricas, --perfilador=cprofile o --perfilador=muestreo perfila las etapas,
+    # --servicio=PUERTO busca con el índice de un servicio (ver Servicio), --errores=N, --minimo=T y --offset=O son
+    # los parámetros de la detección, --cache=MB limita la cache de las etapas (--cache=0 no la usa)
+    opciones = dict(argumento[2:].split('=', 1) for argumento in sys.argv if argumento.startswith('--') and
+                    '=' in argumento)
+    buscar_clips_amv(nombre, flujo='--flujo' in sys.argv, intermedios='--intermedios' in sys.argv,
+                     dimension=int(opciones.get('pca', opciones.get('blanqueo', 0))),
+                     blanquear='blanqueo' in opciones, tipo=opciones.get('hash', 'gris'),
+                     umbral_tramos=float(opciones.get('tramos', 0)),
+                     recall_objetivo=float(opciones.get('recall', 0)), reporte=opciones.get('reporte'),
+                     perfilador=opciones.get('perfilador'), servicio=int(opciones.get('servicio', 0)),
+                     max_errores_continuos=int(opciones.get('errores', 12)),
+                     tiempo_minimo=float(opciones.get('minimo', 1)), max_offset=float(opciones.get('offset', 0.15)),
+                     tamano_cache=int(float(opciones.get('cache', 2048)) * 1024 ** 2))
@@ -0,0 +1,269 @@
+import cProfile
+import io
+import json
+import os
+import platform
+import pstats
+import signal
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def memoria_pico() -> int:
+    """
+    :return: la memoria residente máxima del proceso desde que empezó, en bytes (0 si no se puede medir).
+    """
+    if resource is None:
+        return 0
+
+    # ru_maxrss está en KB en linux y en bytes en macOS
+    pico = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return pico if sys.platform == 'darwin' else pico * 1024
+
+
+def memoria_residente() -> int:
+    """
+    :return: la memoria residente actual del proceso, en bytes (0 si no se puede medir, fuera de linux).
+    """
+    try:
+        with open('/proc/self/statm', 'r') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return 0
+
+
+class Etapa:
+    """
+    Tiempo acumulado de una etapa (extracción, agrupación, búsqueda, detección, etc.), que puede ejecutarse varias
+    veces en una corrida, y su memoria:
+        - memoria_residente: el mayor aumento de la memoria residente del proceso en una llamada (lo que la etapa
+          deja en memoria al terminar, medido por diferencia).
+        - memoria_agregada: el mayor aumento de la memoria residente máxima del proceso en una llamada (cuánto subió
+          la etapa el pico, 0 si no pasó el pico de etapas anteriores).
+        - memoria_pico_proceso: la memoria residente máxima del proceso al terminar la última llamada, que incluye
+          a todas las etapas anteriores.
+
+    Las etapas que corren en paralelo en varios threads comparten la memoria del proceso, así que sus medidas se
+    mezclan.
+    """
+    __slots__ = ('nombre', 'llamadas', 'segundos', 'duracion', 'memoria_residente', 'memoria_agregada',
+                 'memoria_pico_proceso')
+
+    def __init__(self, nombre: str):
+        self.nombre = nombre
+        self.llamadas = 0
+        self.segundos = 0.0
+        self.duracion = 0.0  # duración de la última llamada
+        self.memoria_residente = 0
+        self.memoria_agregada = 0
+        self.memoria_pico_proceso = 0
+
+    def reporte(self) -> dict:
+        return {
+            'llamadas': self.llamadas,
+            'segundos': self.segundos,
+            'memoria_residente_bytes': self.memoria_residente,
+            'memoria_agregada_bytes': self.memoria_agregada,
+            'memoria_pico_proceso_bytes': self.memoria_pico_proceso,
+        }
+
+
+class Metricas:
+    """
+    Registro de las métricas de una corrida: el tiempo de cada etapa (con time.perf_counter), contadores (frames
+    decodificados, búsquedas, candidatos, clips) y la memoria de cada etapa (ver Etapa). Opcionalmente perfila las
+    etapas con cProfile o con un muestreo periódico de la pila. El reporte se exporta como JSON para juntar muchas
+    corridas.
+
+    Las funciones de cada etapa registran en las métricas activas (ver activar, etapa y contar), así no hay que
+    pasarlas como parámetro. Se pueden registrar desde varios threads a la vez, como en Servicio.
+    """
+
+    def __init__(self, perfil: str = None, intervalo: float = 0.005):
+        """
+        :param perfil: None para no perfilar, 'cprofile' para perfilar con cProfile o 'muestreo' para muestrear la
+        pila cada intervalo segundos de CPU (solo en unix y en el hilo principal).
+        :param intervalo: segundos de CPU entre muestras.
+        """
+        if perfil not in (None, 'cprofile', 'muestreo'):
+            raise Exception(f'perfil {perfil} no soportado, use cprofile o muestreo')
+
+        self.perfil = perfil
+        self.intervalo = intervalo
+        self.etapas: Dict[str, Etapa] = {}
+        self.contadores: Dict[str, int] = {}
+        self.inicio = time.time()
+        self.t0 = time.perf_counter()
+
+        self.perfilador = cProfile.Profile() if perfil == 'cprofile' else None
+        self.muestras: Dict[str, int] = {}
+        self._activas = 0
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def etapa(self, nombre: str):
+        """
+        Mide el tiempo y la memoria de una etapa:
+
+            with metricas.etapa('busqueda') as etapa:
+                ...
+            print(etapa.duracion)
+
+        Las etapas se pueden anidar; el perfilador corre mientras haya alguna etapa activa.
+        """
+        with self.lock:
+            etapa = self.etapas.get(nombre)
+            if etapa is None:
+                etapa = self.etapas[nombre] = Etapa(nombre)
+            self._iniciar_perfil()
+
+        residente_inicial, pico_inicial = memoria_residente(), memoria_pico()
+        t0 = time.perf_counter()
+        try:
+            yield etapa
+        finally:
+            duracion = time.perf_counter() - t0
+            residente, pico = memoria_residente(), memoria_pico()
+
+            with self.lock:
+                etapa.duracion = duracion
+                etapa.segundos += duracion
+                etapa.llamadas += 1
+                etapa.memoria_residente = max(etapa.memoria_residente, residente - residente_inicial)
+                etapa.memoria_agregada = max(etapa.memoria_agregada, pico - pico_inicial)
+                etapa.memoria_pico_proceso = pico
+                self._detener_perfil()
+
+    def contar(self, nombre: str, cantidad: int = 1):
+        """
+        Suma la cantidad al contador dado.
+        """
+        with self.lock:
+            self.contadores[nombre] = self.contadores.get(nombre, 0) + int(cantidad)
+
+    def _iniciar_perfil(self):
+        self._activas += 1
+        if self._activas > 1:
+            return
+
+        if self.perfil == 'cprofile':
+            self.perfilador.enable()
+        elif self.perfil == 'muestreo' and hasattr(signal, 'setitimer') and \
+                threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGPROF, self._muestrear)
+            signal.setitimer(signal.ITIMER_PROF, self.intervalo, self.intervalo)
+
+    def _detener_perfil(self):
+        self._activas -= 1
+        if self._activas > 0:
+            return
+
+        if self.perfil == 'cprofile':
+            self.perfilador.disable()
+        elif self.perfil == 'muestreo' and hasattr(signal, 'setitimer') and \
+                threading.current_thread() is threading.main_thread():
+            signal.setitimer(signal.ITIMER_PROF, 0, 0)
+            signal.signal(signal.SIGPROF, signal.SIG_DFL)
+
+    def _muestrear(self, _, frame):
+        # pila en formato "colapsado" (funciones de afuera hacia adentro separadas por ;), como usa flamegraph
+        pila = []
+        while frame is not None:
+            codigo = frame.f_code
+            pila.append(f'{os.path.basename(codigo.co_filename)}:{codigo.co_name}')
+            frame = frame.f_back
+
+        clave = ';'.join(reversed(pila))
+        self.muestras[clave] = self.muestras.get(clave, 0) + 1
+
+    def reporte(self, funciones: int = 30) -> dict:
+        """
+        :param funciones: número de funciones (por tiempo acumulado) a incluir del perfil de cProfile.
+
+        :return: un diccionario con todas las métricas de la corrida.
+        """
+        with self.lock:
+            reporte = {
+                'inicio': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.inicio)),
+                'segundos': time.perf_counter() - self.t0,
+                'maquina': {'sistema': platform.platform(), 'nucleos': os.cpu_count(),
+                            'python': platform.python_version()},
+                'memoria_pico_bytes': memoria_pico(),
+                'etapas': {nombre: etapa.reporte() for nombre, etapa in self.etapas.items()},
+                'contadores': dict(self.contadores),
+            }
+
+        if self.perfil == 'cprofile':
+            texto = io.StringIO()
+            pstats.Stats(self.perfilador, stream=texto).sort_stats('cumulative').print_stats(funciones)
+            reporte['perfil'] = texto.getvalue()
+        elif self.perfil == 'muestreo':
+            reporte['muestras'] = dict(sorted(self.muestras.items(), key=lambda m: -m[1]))
+
+        return reporte
+
+    def guardar(self, archivo: str):
+        """
+        Guarda el reporte en un archivo JSON. Con cProfile además guarda las estadísticas completas en archivo.prof
+        (para abrirlas con pstats o snakeviz), y con muestreo las pilas en archivo.pilas (para flamegraph.pl).
+        """
+        carpeta = os.path.dirname(archivo)
+        if carpeta and not os.path.isdir(carpeta):
+            os.makedirs(carpeta, exist_ok=True)
+
+        with open(archivo, 'w') as salida:
+            json.dump(self.reporte(), salida, indent=2)
+
+        base = os.path.splitext(archivo)[0]
+        if self.perfil == 'cprofile':
+            self.perfilador.dump_stats(f'{base}.prof')
+        elif self.perfil == 'muestreo':
+            with open(f'{base}.pilas', 'w') as salida:
+                for pila, cantidad in self.muestras.items():
+                    salida.write(f'{pila} {cantidad}\n')
+
+
+# métricas donde registran las etapas
+_actuales = Metricas()
+
+
+def actuales() -> Metricas:
+    """
+    :return: las métricas activas.
+    """
+    return _actuales
+
+
+def activar(metricas: Metricas = None) -> Metricas:
+    """
+    Reemplaza las métricas activas, para empezar una nueva corrida.
+
+    :param metricas: las nuevas métricas, None crea unas vacías sin perfil.
+
+    :return: las métricas activas.
+    """
+    global _actuales
+    _actuales = metricas if metricas is not None else Metricas()
+    return _actuales
+
+
+def etapa(nombre: str):
+    """
+    Mide una etapa en las métricas activas (ver Metricas.etapa).
+    """
+    return _actuales.etapa(nombre)
+
+
+def contar(nombre: str, cantidad: int = 1):
+    """
+    Suma la cantidad al contador dado de las métricas activas.
+    """
+    _actuales.contar(nombre, cantidad)
@@ -0,0 +1,230 @@
+import os
+import sys
+import time
+
+import numpy
+
+from BusquedaKNN import agrupar_caracteristicas
+from Etiquetas import Etiquetas
+from Indices import Index, Exacto, KDTree, medir_recall, muestra_busquedas
+
+
+class Proyeccion:
+    """
+    Proyección lineal de los vectores de características a menos dimensiones con PCA, opcionalmente con blanqueo
+    (cada componente dividida por su desviación estándar). Se ajusta sobre las características del corpus y se guarda
+    junto a ellas, para aplicarla igual a los vectores del corpus y a las búsquedas.
+    """
+
+    def __init__(self, media: numpy.ndarray, componentes: numpy.ndarray, varianzas: numpy.ndarray,
+                 blanquear: bool = False, etiquetas: str = ''):
+        """
+        :param media: vector con la media de los datos.
+        :param componentes: matriz (dimension, d) con una componente principal por fila, de mayor a menor varianza.
+        :param varianzas: varianza de todas las componentes principales (d,), de mayor a menor.
+        :param blanquear: si es True, cada componente se divide por su desviación estándar.
+        :param etiquetas: huella de la tabla de etiquetas del corpus sobre el que se ajustó.
+        """
+        self.media = media.astype(numpy.float32)
+        self.componentes = componentes.astype(numpy.float32)
+        self.varianzas = varianzas
+        self.blanquear = blanquear
+        self.etiquetas = etiquetas
+
+        # matriz (d, dimension) que proyecta los datos centrados
+        self.matriz = self.componentes.T.copy()
+        if blanquear:
+            self.matriz /= numpy.sqrt(numpy.maximum(varianzas[:self.dimension], 1e-6)).astype(numpy.float32)
+
+    @property
+    def dimension(self) -> int:
+        return self.componentes.shape[0]
+
+    def varianza_explicada(self) -> float:
+        """
+        :return: la fracción de la varianza de los datos que conservan las componentes de la proyección.
+        """
+        return float(self.varianzas[:self.dimension].sum() / self.varianzas.sum())
+
+    @staticmethod
+    def ajustar(datos: numpy.ndarray, dimension: int, blanquear: bool = False, muestra: int = 500000,
+                semilla: int = 0, etiquetas: str = '') -> 'Proyeccion':
+        """
+        Ajusta la proyección sobre una muestra de los datos.
+
+        :param datos: matriz con un vector de características por fila.
+        :param dimension: número de dimensiones de salida.
+        :param blanquear: si es True, blanquea las componentes.
+        :param muestra: número de filas con las que ajustar.
+        :param semilla: semilla de la muestra.
+        :param etiquetas: huella de la tabla de etiquetas de los datos.
+
+        :return: la proyección ajustada.
+        """
+        rng = numpy.random.RandomState(semilla)
+        seleccion = numpy.sort(rng.choice(datos.shape[0], min(muestra, datos.shape[0]), replace=False))
+        muestra = numpy.asarray(datos[seleccion], dtype=numpy.float64)
+
+        media = muestra.mean(axis=0)
+        muestra -= media
+        covarianza = muestra.T @ muestra / max(muestra.shape[0] - 1, 1)
+
+        # eigh retorna los valores propios de menor a mayor
+        varianzas, vectores = numpy.linalg.eigh(covarianza)
+        orden = numpy.argsort(varianzas)[::-1]
+        varianzas = numpy.maximum(varianzas[orden], 0)
+        componentes = vectores[:, orden[:dimension]].T
+
+        return Proyeccion(media, componentes, varianzas, blanquear=blanquear, etiquetas=etiquetas)
+
+    def aplicar(self, datos: numpy.ndarray, filas: int = 65536) -> numpy.ndarray:
+        """
+        Proyecta los datos por bloques de filas.
+
+        :param datos: matriz con un vector de características por fila (por ejemplo el memmap del corpus).
+        :param filas: filas por bloque.
+
+        :return: matriz (n, dimension) de tipo float32 con los datos proyectados.
+        """
+        datos = datos.reshape(-1, self.media.shape[0])
+        proyectados = numpy.empty((datos.shape[0], self.dimension), dtype=numpy.float32)
+        for inicio in range(0, datos.shape[0], filas):
+            bloque = numpy.asarray(datos[inicio:inicio + filas], dtype=numpy.float32) - self.media
+            proyectados[inicio:inicio + filas] = bloque @ self.matriz
+
+        return proyectados
+
+    @staticmethod
+    def archivo(carpeta: str, dimension: int, blanquear: bool = False) -> str:
+        return f'{carpeta}/proyeccion_{"blanqueo" if blanquear else "pca"}_{dimension}.npz'
+
+    def guardar(self, carpeta: str):
+        if not os.path.isdir(carpeta):
+            os.makedirs(carpeta, exist_ok=True)
+
+        numpy.savez(Proyeccion.archivo(carpeta, self.dimension, self.blanquear), media=self.media,
+                    componentes=self.componentes, varianzas=self.varianzas, blanquear=self.blanquear,
+                    etiquetas=self.etiquetas)
+
+    @staticmethod
+    def cargar(carpeta: str, dimension: int, blanquear: bool = False) -> 'Proyeccion':
+        with numpy.load(Proyeccion.archivo(carpeta, dimension, blanquear)) as archivo:
+            return Proyeccion(archivo['media'], archivo['componentes'], archivo['varianzas'],
+                              blanquear=bool(archivo['blanquear']), etiquetas=str(archivo['etiquetas']))
+
+    @staticmethod
+    def obtener(carpeta: str, datos: numpy.ndarray, etiquetas: Etiquetas, dimension: int,
+                blanquear: bool = False) -> 'Proyeccion':
+        """
+        Recarga la proyección guardada en la carpeta del corpus si se ajustó sobre las mismas etiquetas, o la ajusta
+        y la guarda.
+
+        :param carpeta: carpeta de las características del corpus.
+        :param datos: las características del corpus.
+        :param etiquetas: la tabla de etiquetas del corpus.
+        :param dimension: número de dimensiones de salida.
+        :param blanquear: si es True, blanquea las componentes.
+
+        :return: la proyección.
+        """
+        if os.path.isfile(Proyeccion.archivo(carpeta, dimension, blanquear)):
+            proyeccion = Proyeccion.cargar(carpeta, dimension, blanquear)
+            if proyeccion.etiquetas == etiquetas.huella():
+                return proyeccion
+
+            print(f'la proyección guardada en {Proyeccion.archivo(carpeta, dimension, blanquear)} está obsoleta, '
+                  f'se reajustará')
+
+        proyeccion = Proyeccion.ajustar(datos, dimension, blanquear=blanquear, etiquetas=etiquetas.huella())
+        proyeccion.guardar(carpeta)
+        return proyeccion
+
+
+class Proyectado(Index):
+    """
+    Índice sobre los datos proyectados: proyecta el corpus al construirlo y cada búsqueda antes de enviarla al índice
+    interno (por defecto un KDTree), así se usa igual que cualquier otro índice.
+    """
+
+    def __init__(self, datos, etiquetas, proyeccion: Proyeccion, clase=KDTree, **kwargs):
+        """
+        :param datos: matriz con un vector de características por fila.
+        :param etiquetas: tabla con la etiqueta de cada fila de datos.
+        :param proyeccion: la proyección a aplicar.
+        :param clase: clase del índice interno.
+        :param kwargs: parámetros del índice interno (por ejemplo trees, cores y cache).
+        """
+        self.etiquetas = etiquetas
+        self.proyeccion = proyeccion
+
+        t0 = time.time()
+        self.indice = clase(proyeccion.aplicar(datos), etiquetas, **kwargs)
+        t1 = time.time()
+
+        self.cargado = self.indice.cargado
+        self.build_time = t1 - t0
+
+    @property
+    def cores(self) -> int:
+        return self.indice.cores
+
+    @cores.setter
+    def cores(self, cores: int):
+        self.indice.cores = cores
+
+    def search(self, busquedas, k=1, checks=10, distancias=False):
+        """
+        Proyecta las búsquedas y busca sus k vecinos más cercanos en el índice interno. Las distancias retornadas
+        son en el espacio proyectado.
+        """
+        return self.indice.search(self.proyeccion.aplicar(numpy.asarray(busquedas)), k=k, checks=checks,
+                                  distancias=distancias)
+
+
+def comparar_proyecciones(carpeta: str, tamano=(10, 10), dimensiones=(100, 50, 32, 16), checks=(50, 100, 500),
+                          k: int = 20, trees: int = 10, n_busquedas: int = 1000, ruido: float = 4.0):
+    """
+    Compara velocidad contra recall@k de un KDTree sobre los datos originales y sobre proyecciones PCA y blanqueadas
+    de distintas dimensiones, con la búsqueda exacta en el espacio original como referencia. Las búsquedas son frames
+    del corpus al azar con ruido gaussiano, para simular frames reencodeados.
+
+    :param carpeta: la carpeta con las características del corpus.
+    :param tamano: el tamaño de las características.
+    :param dimensiones: dimensiones de salida a probar.
+    :param checks: números de checks a probar.
+    :param k: el número de vecinos a buscar.
+    :param trees: número de árboles del KDTree.
+    :param n_busquedas: número de búsquedas.
+    :param ruido: desviación estándar del ruido agregado a las búsquedas.
+    """
+    etiquetas, caracteristicas = agrupar_caracteristicas(carpeta, recargar=True, tamano=tamano)
+
+    busquedas = muestra_busquedas(caracteristicas, n_busquedas, ruido=ruido)
+
+    oraculo = Exacto(caracteristicas, etiquetas)
+    indices = [('original', lambda: KDTree(caracteristicas, etiquetas, trees=trees, cores=0))]
+    for dimension in dimensiones:
+        for blanquear in (False, True):
+            def construir(dimension=dimension, blanquear=blanquear):
+                proyeccion = Proyeccion.obtener(carpeta, caracteristicas, etiquetas, dimension, blanquear)
+                print(f'  varianza explicada: {proyeccion.varianza_explicada():.3f}')
+                return Proyectado(caracteristicas, etiquetas, proyeccion, trees=trees, cores=0)
+
+            indices.append((f'{"blanqueo" if blanquear else "pca"} {dimension}', construir))
+
+    for nombre, construir in indices:
+        print(nombre)
+        indice = construir()
+        print(f'  construcción: {indice.build_time:.1f} segundos')
+
+        for c in checks:
+            t0 = time.time()
+            indice.search(busquedas, k=k, checks=c)
+            t1 = time.time()
+
+            recall = medir_recall(indice, oraculo, busquedas, k=k, checks=c)
+            print(f'  checks={c}: {busquedas.shape[0] / (t1 - t0):.0f} búsquedas/s, recall@{k} {recall:.3f}')
+
+
+if __name__ == '__main__':
+    comparar_proyecciones(sys.argv[1] if len(sys.argv) > 1 else '../videos/Shippuden_car_(10, 10)_6')
@@ -0,0 +1,223 @@
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import time
+from typing import List, Tuple
+
+import numpy
+
+from BusquedaKNN import agrupar_caracteristicas
+from Cuantizacion import ProductoCuantizado
+from Etiquetas import Etiquetas
+from Indices import Exacto, KDTree, KMeansTree, Linear, muestra_busquedas, pyflann
+from Metricas import memoria_pico
+
+# configuraciones a medir: (nombre del índice, clase, parámetros de construcción, checks a probar)
+CONFIGURACIONES = [
+    ('Exacto', Exacto, {}, (0,)),
+    ('Linear', Linear, {}, (0,)),
+    *[('KDTree', KDTree, {'trees': trees}, (32, 128, 512)) for trees in (1, 4, 10, 16)],
+    *[('KMeansTree', KMeansTree, {'branching': branching}, (32, 128, 512)) for branching in (16, 32, 64)],
+    ('ProductoCuantizado', ProductoCuantizado, {'subespacios': 20, 'listas': 256, 'sondas': 16, 'reordenar': 100},
+     (0,)),
+]
+
+# clases que necesitan pyflann
+FLANN = (Linear, KDTree, KMeansTree)
+
+
+def corpus_sintetico(frames: int = 200000, dimension: int = 100, videos: int = 50, semilla: int = 0
+                     ) -> Tuple[Etiquetas, numpy.ndarray]:
+    """
+    Genera un corpus sintético parecido a las características de videos: cada video es una secuencia de tomas, y
+    dentro de cada toma los vectores cambian de a poco (una caminata aleatoria desde una imagen al azar).
+
+    :param frames: número total de frames.
+    :param dimension: dimensión de los vectores.
+    :param videos: número de videos.
+    :param semilla: semilla del generador.
+
+    :return: las etiquetas y una matriz (frames, dimension) de uint8, en ese orden.
+    """
+    rng = numpy.random.RandomState(semilla)
+
+    # tomas de entre 1 y 60 frames, cada una parte en una imagen al azar
+    largos = rng.randint(1, 61, size=frames // 20 + 1)
+    largos = largos[:numpy.searchsorted(numpy.cumsum(largos), frames) + 1]
+    largos[-1] -= largos.sum() - frames
+    inicios = numpy.cumsum(largos) - largos
+
+    pasos = rng.normal(0, 3, size=(frames, dimension)).astype(numpy.float32)
+    pasos[inicios] = rng.uniform(0, 255, size=(inicios.shape[0], dimension))
+    caracteristicas = numpy.clip(_acumular_tomas(pasos, inicios), 0, 255).astype(numpy.uint8)
+
+    cantidades = numpy.full(videos, frames // videos)
+    cantidades[:frames % videos] += 1
+    tiempos = (numpy.arange(frames) - numpy.repeat(numpy.cumsum(cantidades) - cantidades, cantidades)) / 6
+    etiquetas = Etiquetas.de_videos([f'sintetico_{i}' for i in range(videos)], cantidades,
+                                    tiempos.astype(numpy.float32))
+
+    return etiquetas, caracteristicas
+
+
+def _acumular_tomas(pasos: numpy.ndarray, inicios: numpy.ndarray) -> numpy.ndarray:
+    # suma acumulada de los pasos que se reinicia al inicio de cada toma
+    acumulado = numpy.cumsum(pasos, axis=0)
+    previos = numpy.zeros_like(pasos[inicios])
+    previos[1:] = acumulado[inicios[1:] - 1]
+
+    largos = numpy.diff(numpy.append(inicios, pasos.shape[0]))
+    return acumulado - numpy.repeat(previos, largos, axis=0)
+
+
+def _medir(conexion, clase, parametros: dict, checks: Tuple[int], datos: numpy.ndarray, etiquetas: Etiquetas,
+           busquedas: numpy.ndarray, exactos: numpy.ndarray, k: int, individuales: int):
+    """
+    Proceso de una configuración: construye el índice y mide cada valor de checks. Envía una lista de resultados o
+    la excepción.
+    """
+    try:
+        memoria_inicial = memoria_pico()
+        t0 = time.perf_counter()
+        indice = clase(datos, etiquetas, **parametros)
+        construccion = time.perf_counter() - t0
+        memoria_construccion = memoria_pico()
+
+        resultados = []
+        for c in checks:
+            # búsquedas de a una, como al buscar frame a frame
+            t0 = time.perf_counter()
+            for i in range(min(individuales, busquedas.shape[0])):
+                indice.search(busquedas[i:i + 1], k=k, checks=c)
+            tiempo_individual = time.perf_counter() - t0
+
+            # todas las búsquedas en una llamada
+            t0 = time.perf_counter()
+            encontrados = indice.search(busquedas, k=k, checks=c)
+            tiempo_lote = time.perf_counter() - t0
+
+            aciertos = (encontrados[:, :, None] == exactos[:, None, :]).any(axis=2).sum()
+            resultados.append({
+                'checks': c,
+                'construccion_segundos': construccion,
+                'memoria_pico_bytes': memoria_pico(),
+                'memoria_construccion_bytes': memoria_construccion - memoria_inicial,
+                'qps_individual': min(individuales, busquedas.shape[0]) / max(tiempo_individual, 1e-9),
+                'qps_lote': busquedas.shape[0] / max(tiempo_lote, 1e-9),
+                'recall': float(aciertos) / exactos.size,
+            })
+
+        conexion.send(resultados)
+    except Exception as e:
+        conexion.send(e)
+
+    conexion.close()
+
+
+def medir_configuraciones(etiquetas: Etiquetas, datos: numpy.ndarray, configuraciones=None, k: int = 20,
+                          n_busquedas: int = 1000, individuales: int = 200, ruido: float = 4.0) -> List[dict]:
+    """
+    Mide cada configuración de índice en su propio proceso, para que la memoria pico de una no afecte a las otras:
+    tiempo de construcción, memoria pico, búsquedas por segundo (de a una y en un lote) y recall@k contra la búsqueda
+    exacta. Las búsquedas son frames del corpus al azar con ruido gaussiano.
+
+    :param etiquetas: las etiquetas del corpus.
+    :param datos: las características del corpus.
+    :param configuraciones: lista de (nombre, clase, parámetros, checks), por defecto CONFIGURACIONES.
+    :param k: el número de vecinos a buscar.
+    :param n_busquedas: número de búsquedas del lote.
+    :param individuales: número de búsquedas de a una.
+    :param ruido: desviación estándar del ruido agregado a las búsquedas.
+
+    :return: una lista con un diccionario por configuración y valor de checks.
+    """
+    if configuraciones is None:
+        configuraciones = CONFIGURACIONES
+
+    busquedas = muestra_busquedas(datos, n_busquedas, ruido=ruido)
+
+    exactos = Exacto(datos, etiquetas).search(busquedas, k=k)
+
+    resultados = []
+    for nombre, clase, parametros, checks in configuraciones:
+        if pyflann is None and clase in FLANN:
+            print(f'{nombre} {parametros}: pyflann no está instalado, se omite')
+            continue
+
+        conexion, conexion_trabajador = multiprocessing.Pipe()
+        proceso = multiprocessing.Process(target=_medir, args=(conexion_trabajador, clase, parametros, checks, datos,
+                                                               etiquetas, busquedas, exactos, k, individuales))
+        proceso.start()
+        conexion_trabajador.close()
+        respuesta = conexion.recv()
+        proceso.join()
+
+        if isinstance(respuesta, Exception):
+            print(f'{nombre} {parametros}: error {type(respuesta).__name__}: {respuesta}')
+            continue
+
+        for resultado in respuesta:
+            resultado = dict(indice=nombre, parametros=parametros, **resultado)
+            resultados.append(resultado)
+            print(f'{nombre} {parametros} checks={resultado["checks"]}: '
+                  f'construcción {resultado["construccion_segundos"]:.2f} s, '
+                  f'memoria pico {resultado["memoria_pico_bytes"] / 2 ** 20:.0f} MB, '
+                  f'{resultado["qps_individual"]:.0f} búsquedas/s de a una, '
+                  f'{resultado["qps_lote"]:.0f} búsquedas/s en lote, recall@{k} {resultado["recall"]:.3f}')
+
+    return resultados
+
+
+def guardar_resultados(archivo: str, resultados: List[dict], corpus: dict, k: int):
+    """
+    Guarda los resultados en un archivo JSON, junto a la descripción del corpus y de la máquina, para comparar
+    distintas versiones.
+    """
+    carpeta = os.path.dirname(archivo)
+    if carpeta and not os.path.isdir(carpeta):
+        os.makedirs(carpeta, exist_ok=True)
+
+    with open(archivo, 'w') as salida:
+        json.dump({
+            'fecha': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'maquina': {'sistema': platform.platform(), 'procesador': platform.processor(),
+                        'nucleos': os.cpu_count(), 'python': platform.python_version(),
+                        'numpy': numpy.__version__},
+            'corpus': corpus,
+            'k': k,
+            'resultados': resultados,
+        }, salida, indent=2)
+
+
+def main(carpeta: str = None, salida: str = 'rendimiento.json', frames: int = 200000, k: int = 20):
+    """
+    Mide todas las configuraciones sobre un corpus guardado, o sobre uno sintético si no se da la carpeta.
+
+    :param carpeta: la carpeta con las características del corpus, None para usar un corpus sintético.
+    :param salida: archivo JSON donde guardar los resultados.
+    :param frames: número de frames del corpus sintético.
+    :param k: el número de vecinos a buscar.
+    """
+    if carpeta is None:
+        etiquetas, datos = corpus_sintetico(frames=frames)
+        corpus = {'tipo': 'sintetico', 'frames': datos.shape[0], 'dimension': datos.shape[1]}
+    else:
+        etiquetas, datos = agrupar_caracteristicas(carpeta, recargar=True)
+        corpus = {'tipo': 'carpeta', 'carpeta': carpeta, 'frames': datos.shape[0], 'dimension': datos.shape[1],
+                  'etiquetas': etiquetas.huella()}
+
+    resultados = medir_configuraciones(etiquetas, datos, k=k)
+    guardar_resultados(salida, resultados, corpus, k)
+    print(f'resultados guardados en {salida}')
+
+
+if __name__ == '__main__':
+    # python Rendimiento.py [carpeta] [--salida=archivo.json] [--frames=N]
+    opciones = dict(argumento[2:].split('=', 1) for argumento in sys.argv[1:] if argumento.startswith('--') and
+                    '=' in argumento)
+    posicionales = [argumento for argumento in sys.argv[1:] if not argumento.startswith('--')]
+
+    main(posicionales[0] if posicionales else None, salida=opciones.get('salida', 'rendimiento.json'),
+         frames=int(opciones.get('frames', 200000)))
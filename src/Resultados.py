@@ -0,0 +1,116 @@
+import os
+
+import numpy
+
+from Etiquetas import Etiquetas
+
+
+class ResultadosKNN:
+    """
+    Resultado de buscar los k frames más cercanos de cada frame de un video, guardado por columnas:
+        - tiempos: arreglo (n,) con el tiempo de cada frame del video.
+        - ids: matriz (n, k) con los ids de los vecinos en la tabla de etiquetas del índice.
+        - distancias: matriz (n, k) con la distancia a cada vecino (None si no se conoce).
+        - etiquetas: la tabla de etiquetas del índice.
+
+    En formato binario se guarda como una carpeta con un .npy por columna, que se leen con memmap sin copiarlos, y
+    un etiquetas.txt con la carpeta de la tabla de etiquetas y su huella. En formato de texto se guarda como un
+    archivo con una linea 'etiquetas carpeta huella' y luego una linea 'tiempo $ id id ...' por frame. La carpeta
+    de etiquetas se guarda como ruta absoluta, y al cargar se verifica que la tabla no haya cambiado.
+    """
+
+    ARCHIVO_TIEMPOS = 'tiempos.npy'
+    ARCHIVO_IDS = 'ids.npy'
+    ARCHIVO_DISTANCIAS = 'distancias.npy'
+    ARCHIVO_ETIQUETAS = 'etiquetas.txt'
+
+    def __init__(self, tiempos: numpy.ndarray, ids: numpy.ndarray, distancias: numpy.ndarray,
+                 etiquetas: Etiquetas):
+        self.tiempos = tiempos
+        self.ids = ids
+        self.distancias = distancias
+        self.etiquetas = etiquetas
+
+    def __len__(self):
+        return self.tiempos.shape[0]
+
+    @property
+    def k(self) -> int:
+        return self.ids.shape[1]
+
+    def _carpeta_etiquetas(self, carpeta_log: str) -> str:
+        # guardar la tabla de etiquetas junto al log si no está guardada
+        if self.etiquetas.carpeta is None:
+            self.etiquetas.guardar(carpeta_log)
+
+        return os.path.abspath(self.etiquetas.carpeta)
+
+    @staticmethod
+    def _cargar_etiquetas(carpeta: str, huella: str, ruta: str) -> Etiquetas:
+        # cargar la tabla de etiquetas, verificando que sea la misma con que se guardaron los resultados
+        etiquetas = Etiquetas.cargar(carpeta)
+        if etiquetas.huella() != huella:
+            raise Exception(f'la tabla de etiquetas de {carpeta} cambió desde que se guardaron los resultados {ruta}')
+
+        return etiquetas
+
+    def guardar_bin(self, carpeta: str):
+        """
+        Guarda los resultados en formato binario, en la carpeta dada (una por video).
+        """
+        if not os.path.isdir(carpeta):
+            os.makedirs(carpeta, exist_ok=True)
+
+        numpy.save(f'{carpeta}/{ResultadosKNN.ARCHIVO_TIEMPOS}', numpy.asarray(self.tiempos, dtype=numpy.float32))
+        numpy.save(f'{carpeta}/{ResultadosKNN.ARCHIVO_IDS}', numpy.asarray(self.ids, dtype=numpy.int32))
+        if self.distancias is not None:
+            numpy.save(f'{carpeta}/{ResultadosKNN.ARCHIVO_DISTANCIAS}',
+                       numpy.asarray(self.distancias, dtype=numpy.float32))
+
+        with open(f'{carpeta}/{ResultadosKNN.ARCHIVO_ETIQUETAS}', 'w') as archivo:
+            archivo.write(f'{self._carpeta_etiquetas(os.path.dirname(carpeta))}\n{self.etiquetas.huella()}\n')
+
+    def guardar_txt(self, archivo: str):
+        """
+        Exporta los resultados en formato de texto.
+        """
+        carpeta_etiquetas = self._carpeta_etiquetas(os.path.dirname(archivo))
+
+        formato = '%.3f $ ' + ' '.join(['%d'] * self.k)
+        with open(archivo, 'w') as log:
+            log.write(f'etiquetas {carpeta_etiquetas} {self.etiquetas.huella()}\n')
+            numpy.savetxt(log, numpy.column_stack((self.tiempos, self.ids)), fmt=formato)
+
+    @staticmethod
+    def cargar(ruta: str) -> 'ResultadosKNN':
+        """
+        Carga resultados guardados en formato binario (si la ruta es una carpeta) o de texto (si es un archivo).
+        """
+        if os.path.isdir(ruta):
+            return ResultadosKNN.cargar_bin(ruta)
+
+        return ResultadosKNN.cargar_txt(ruta)
+
+    @staticmethod
+    def cargar_bin(carpeta: str) -> 'ResultadosKNN':
+        tiempos = numpy.load(f'{carpeta}/{ResultadosKNN.ARCHIVO_TIEMPOS}', mmap_mode='r')
+        ids = numpy.load(f'{carpeta}/{ResultadosKNN.ARCHIVO_IDS}', mmap_mode='r')
+
+        distancias = None
+        if os.path.isfile(f'{carpeta}/{ResultadosKNN.ARCHIVO_DISTANCIAS}'):
+            distancias = numpy.load(f'{carpeta}/{ResultadosKNN.ARCHIVO_DISTANCIAS}', mmap_mode='r')
+
+        with open(f'{carpeta}/{ResultadosKNN.ARCHIVO_ETIQUETAS}', 'r') as archivo:
+            carpeta_etiquetas, huella = archivo.read().splitlines()[:2]
+        etiquetas = ResultadosKNN._cargar_etiquetas(carpeta_etiquetas, huella, carpeta)
+
+        return ResultadosKNN(tiempos, ids, distancias, etiquetas)
+
+    @staticmethod
+    def cargar_txt(archivo: str) -> 'ResultadosKNN':
+        with open(archivo, 'r') as log:
+            carpeta_etiquetas, huella = log.readline().rstrip('\n').split(' ', 1)[1].rsplit(' ', 1)
+            etiquetas = ResultadosKNN._cargar_etiquetas(carpeta_etiquetas, huella, archivo)
+            datos = numpy.loadtxt(log, ndmin=2, converters={1: lambda _: 0})
+
+        return ResultadosKNN(datos[:, 0].astype(numpy.float32), datos[:, 2:].astype(numpy.int32), None, etiquetas)
@@ -0,0 +1,565 @@
+import io
+import json
+import os
+import queue
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import OrderedDict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Tuple
+
+import numpy
+
+from Almacen import sincronizar_carpeta
+from Etiquetas import Etiquetas
+from Flujo import buscar_clips_flujo
+from Indices import Index
+
+PUERTO = 8765
+
+# parámetros de búsqueda de clips que se pueden dar en un pedido a /clips, con su tipo
+PARAMETROS_CLIPS = {'k': int, 'max_errores_continuos': int, 'tiempo_minimo': float, 'max_offset': float}
+
+
+class _Pedido:
+    __slots__ = ('busquedas', 'k', 'checks', 'ids', 'distancias', 'error', 'listo')
+
+    def __init__(self, busquedas: numpy.ndarray, k: int, checks: int):
+        self.busquedas = busquedas
+        self.k = k
+        self.checks = checks
+        self.ids = None
+        self.distancias = None
+        self.error = None
+        self.listo = threading.Event()
+
+
+class Agrupador(Index):
+    """
+    Índice que junta las búsquedas concurrentes de varios threads en una sola llamada al índice real: un thread
+    toma el primer pedido de la cola, espera hasta `espera` segundos a que lleguen más (o hasta juntar max_lote
+    búsquedas), y hace una llamada al índice por cada grupo de pedidos con el mismo k, checks y tipo.
+    """
+
+    def __init__(self, indice: Index, espera: float = 0.002, max_lote: int = 4096):
+        """
+        :param indice: el índice real.
+        :param espera: segundos máximos a esperar más pedidos antes de buscar.
+        :param max_lote: número de búsquedas con el que se busca sin esperar más.
+        """
+        self.indice = indice
+        self.cargado = indice.cargado
+        self.build_time = indice.build_time
+        self.espera = espera
+        self.max_lote = max_lote
+
+        self.llamadas = 0
+        self.pedidos = 0
+        self.busquedas = 0
+
+        self.cola = queue.Queue()
+        self.thread = threading.Thread(target=self._ciclo, daemon=True)
+        self.thread.start()
+
+    @property
+    def cores(self) -> int:
+        return self.indice.cores
+
+    @cores.setter
+    def cores(self, cores: int):
+        self.indice.cores = cores
+
+    @property
+    def etiquetas(self) -> Etiquetas:
+        # la tabla del índice real, que un índice incremental reemplaza al actualizarse
+        return self.indice.etiquetas
+
+    def search(self, busquedas, k=1, checks=10, distancias=False):
+        """
+        Encola las búsquedas y espera su resultado.
+        """
+        pedido = _Pedido(numpy.atleast_2d(numpy.asarray(busquedas)), k, checks)
+        self.cola.put(pedido)
+        pedido.listo.wait()
+
+        if pedido.error is not None:
+            raise pedido.error
+
+        if distancias:
+            return pedido.ids, pedido.distancias
+        return pedido.ids
+
+    def _ciclo(self):
+        while True:
+            pedidos = [self.cola.get()]
+            if pedidos[0] is None:
+                return
+
+            # juntar los pedidos que lleguen durante la espera
+            limite = time.perf_counter() + self.espera
+            filas = pedidos[0].busquedas.shape[0]
+            while filas < self.max_lote:
+                restante = limite - time.perf_counter()
+                if restante <= 0:
+                    break
+                try:
+                    pedido = self.cola.get(timeout=restante)
+                except queue.Empty:
+                    break
+                if pedido is None:
+                    self.cola.put(None)
+                    break
+
+                pedidos.append(pedido)
+                filas += pedido.busquedas.shape[0]
+
+            grupos: Dict[tuple, List[_Pedido]] = {}
+            for pedido in pedidos:
+                grupos.setdefault((pedido.k, pedido.checks, pedido.busquedas.dtype.str), []).append(pedido)
+
+            for (k, checks, _), grupo in grupos.items():
+                self._buscar(grupo, k, checks)
+
+    def _buscar(self, grupo: List[_Pedido], k: int, checks: int):
+        try:
+            ids, dists = self.indice.search(numpy.concatenate([pedido.busquedas for pedido in grupo]), k=k,
+                                            checks=checks, distancias=True)
+            self.llamadas += 1
+            self.pedidos += len(grupo)
+            self.busquedas += ids.shape[0]
+
+            inicio = 0
+            for pedido in grupo:
+                fin = inicio + pedido.busquedas.shape[0]
+                pedido.ids, pedido.distancias = ids[inicio:fin], dists[inicio:fin]
+                inicio = fin
+        except Exception as e:
+            for pedido in grupo:
+                pedido.error = e
+
+        for pedido in grupo:
+            pedido.listo.set()
+
+    def cerrar(self):
+        self.cola.put(None)
+        self.thread.join()
+
+
+class Latencias:
+    """
+    Latencia de los últimos pedidos de cada tipo, para reportar percentiles.
+    """
+
+    def __init__(self, maximo: int = 10000):
+        self.maximo = maximo
+        self.tiempos: Dict[str, deque] = {}
+        self.totales: Dict[str, int] = {}
+        self.lock = threading.Lock()
+
+    def registrar(self, ruta: str, segundos: float):
+        with self.lock:
+            self.tiempos.setdefault(ruta, deque(maxlen=self.maximo)).append(segundos)
+            self.totales[ruta] = self.totales.get(ruta, 0) + 1
+
+    def reporte(self) -> dict:
+        with self.lock:
+            tiempos = {ruta: numpy.array(valores) * 1000 for ruta, valores in self.tiempos.items()}
+            totales = dict(self.totales)
+
+        return {ruta: {
+            'pedidos': totales[ruta],
+            'promedio_ms': float(valores.mean()),
+            'p50_ms': float(numpy.percentile(valores, 50)),
+            'p95_ms': float(numpy.percentile(valores, 95)),
+            'p99_ms': float(numpy.percentile(valores, 99)),
+            'max_ms': float(valores.max()),
+        } for ruta, valores in tiempos.items()}
+
+
+class _Manejador(BaseHTTPRequestHandler):
+    """
+    Rutas del servicio:
+        - GET /info: configuración del índice (carpeta de la tabla de etiquetas, checks, tipo de características) y
+          versión del corpus.
+        - GET /estadisticas: latencias por ruta y tamaño de los lotes del índice.
+        - POST /buscar?k=20&checks=500: cuerpo .npy con una búsqueda por fila, responde un .npz con ids, distancias
+          y la versión del corpus de los ids.
+        - POST /clips: cuerpo JSON {"archivo": video, "carpeta_resultados": carpeta}, busca los clips del video en
+          flujo y responde {"clips": [...], "version": v} con una línea de texto por clip.
+        - POST /actualizar: si el índice es Incremental, relee el almacén del corpus (ver Incremental.actualizar).
+
+    La versión del corpus cambia con cada actualización; los clientes recargan la tabla de etiquetas (ver /info)
+    cuando una respuesta trae otra versión.
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        ruta = urllib.parse.urlparse(self.path).path
+        servicio = self.server.servicio
+
+        if ruta == '/info':
+            self._responder_json(servicio.info())
+        elif ruta == '/estadisticas':
+            self._responder_json(servicio.estadisticas())
+        else:
+            self._responder_json({'error': f'ruta {ruta} no existe'}, estado=404)
+
+    def do_POST(self):
+        t0 = time.perf_counter()
+        url = urllib.parse.urlparse(self.path)
+        parametros_url = dict(urllib.parse.parse_qsl(url.query))
+        servicio = self.server.servicio
+        cuerpo = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+        try:
+            if url.path == '/buscar':
+                busquedas = numpy.load(io.BytesIO(cuerpo), allow_pickle=False)
+                ids, distancias, version = servicio.buscar(busquedas, k=int(parametros_url.get('k', 20)),
+                                                           checks=int(parametros_url.get('checks', servicio.checks)))
+                salida = io.BytesIO()
+                numpy.savez(salida, ids=ids, distancias=distancias, version=numpy.int64(version))
+                self._responder(salida.getvalue(), 'application/octet-stream')
+
+            elif url.path == '/actualizar':
+                self._responder_json(servicio.actualizar())
+
+            elif url.path == '/clips':
+                pedido = json.loads(cuerpo)
+                parametros = {nombre: tipo(pedido[nombre]) for nombre, tipo in PARAMETROS_CLIPS.items()
+                              if nombre in pedido}
+                clips, version = servicio.buscar_clips(pedido['archivo'], pedido.get('carpeta_resultados'),
+                                                       **parametros)
+                self._responder_json({'clips': clips, 'version': version})
+
+            else:
+                self._responder_json({'error': f'ruta {url.path} no existe'}, estado=404)
+                return
+
+        except Exception as e:
+            self._responder_json({'error': f'{type(e).__name__}: {e}'}, estado=500)
+            return
+
+        servicio.latencias.registrar(url.path, time.perf_counter() - t0)
+
+    def _responder_json(self, datos: dict, estado: int = 200):
+        self._responder(json.dumps(datos).encode(), 'application/json', estado)
+
+    def _responder(self, cuerpo: bytes, tipo: str, estado: int = 200):
+        self.send_response(estado)
+        self.send_header('Content-Type', tipo)
+        self.send_header('Content-Length', str(len(cuerpo)))
+        self.end_headers()
+        self.wfile.write(cuerpo)
+
+    def log_message(self, formato, *args):
+        pass
+
+
+class Servicio:
+    """
+    Servicio HTTP local que mantiene el índice y la tabla de etiquetas del corpus en memoria, para buscar frames
+    cercanos o clips sin volver a cargar nada en cada ejecución. Cada pedido se atiende en su propio thread, y las
+    búsquedas concurrentes se juntan en lotes (ver Agrupador). Los clips encontrados se guardan en memoria, para
+    responder sin buscar de nuevo si se pide el mismo video sin cambios con los mismos parámetros.
+    """
+
+    def __init__(self, indice: Index, checks: int, tipo: str = 'gris', tamano: Tuple[int, int] = (10, 10),
+                 fps: int = 6, puerto: int = PUERTO, carpeta_resultados: str = '../videos/AMV_results',
+                 espera: float = 0.002, max_clips: int = 256):
+        """
+        :param indice: el índice del corpus.
+        :param checks: checks por defecto de las búsquedas.
+        :param tipo: tipo de características del índice.
+        :param tamano: tamaño de las características del índice.
+        :param fps: frames por segundo a extraer de los videos.
+        :param puerto: puerto donde escuchar (solo en localhost).
+        :param carpeta_resultados: carpeta por defecto donde guardar los clips encontrados.
+        :param espera: segundos máximos a esperar más búsquedas para juntarlas en un lote.
+        :param max_clips: número de búsquedas de clips a mantener en memoria, 0 para no guardarlas.
+        """
+        self.indice = Agrupador(indice, espera=espera)
+        self.checks = checks
+        self.tipo = tipo
+        self.tamano = tamano
+        self.fps = fps
+        self.carpeta_resultados = carpeta_resultados
+        self.latencias = Latencias()
+
+        # clips de las últimas búsquedas, del usado hace más tiempo al más reciente, y versión del corpus (cambia al
+        # actualizar el índice, invalidando los clips guardados)
+        self.clips = OrderedDict()
+        self.max_clips = max_clips
+        self.version = 0
+        self.lock = threading.Lock()
+
+        # mientras se actualiza el índice no se sabe a qué versión corresponde una búsqueda, se espera que termine
+        self.actualizando = False
+        self.actualizado = threading.Condition(self.lock)
+        self.lock_actualizar = threading.Lock()
+
+        # los clientes leen la tabla de etiquetas desde disco, así que tiene que estar guardada
+        if self.indice.etiquetas.carpeta is None:
+            self.indice.etiquetas.guardar(tempfile.mkdtemp(prefix='etiquetas_'))
+
+        self.servidor = ThreadingHTTPServer(('127.0.0.1', puerto), _Manejador)
+        self.servidor.daemon_threads = True
+        self.servidor.servicio = self
+
+    @property
+    def puerto(self) -> int:
+        return self.servidor.server_address[1]
+
+    def info(self) -> dict:
+        with self.actualizado:
+            self.actualizado.wait_for(lambda: not self.actualizando)
+            return {
+                'etiquetas': os.path.abspath(self.indice.etiquetas.carpeta),
+                'huella': self.indice.etiquetas.huella(),
+                'version': self.version,
+                'checks': self.checks,
+                'tipo': self.tipo,
+            }
+
+    def _version(self) -> int:
+        # la versión del corpus, esperando que termine la actualización en curso si hay una
+        with self.actualizado:
+            self.actualizado.wait_for(lambda: not self.actualizando)
+            return self.version
+
+    def buscar(self, busquedas: numpy.ndarray, k: int, checks: int):
+        """
+        Busca los k vecinos más cercanos con el índice del servicio. Si el índice se actualiza durante la búsqueda,
+        se repite, para que los ids correspondan a la versión retornada.
+
+        :return: una matriz (n, k) con los ids de los vecinos, otra con las distancias, y la versión del corpus.
+        """
+        while True:
+            version = self._version()
+            ids, distancias = self.indice.search(busquedas, k=k, checks=checks, distancias=True)
+
+            with self.lock:
+                if not self.actualizando and self.version == version:
+                    return ids, distancias, version
+
+    def estadisticas(self) -> dict:
+        return {
+            'latencias': self.latencias.reporte(),
+            'indice': {
+                'llamadas': self.indice.llamadas,
+                'pedidos': self.indice.pedidos,
+                'busquedas': self.indice.busquedas,
+                'pedidos_por_llamada': self.indice.pedidos / max(self.indice.llamadas, 1),
+                'busquedas_por_llamada': self.indice.busquedas / max(self.indice.llamadas, 1),
+            },
+        }
+
+    def actualizar(self) -> dict:
+        """
+        Actualiza el índice con los cambios del almacén del corpus, si es incremental.
+
+        :return: el número de filas en el índice principal, en el delta y enmascaradas, y la nueva versión del
+        corpus.
+        """
+        indice = self.indice.indice
+        if not hasattr(indice, 'actualizar'):
+            raise Exception(f'el índice {type(indice).__name__} no se puede actualizar')
+
+        with self.lock_actualizar:
+            with self.lock:
+                self.actualizando = True
+
+            try:
+                sincronizar_carpeta(indice.almacen.carpeta)
+                indice.actualizar()
+
+                # el índice incremental reemplaza su tabla de etiquetas, los clientes la leen desde disco
+                indice.etiquetas.guardar(tempfile.mkdtemp(prefix='etiquetas_'))
+            finally:
+                with self.actualizado:
+                    self.actualizando = False
+                    self.version += 1
+                    version = self.version
+                    self.actualizado.notify_all()
+
+        estado = indice.estado
+        return {'principal': int(estado.ids_principal.shape[0]), 'delta': int(estado.ids_delta.shape[0]),
+                'enmascaradas': estado.enmascaradas, 'version': version}
+
+    def buscar_clips(self, archivo: str, carpeta_resultados: str = None, k: int = 20, max_errores_continuos: int = 12,
+                     tiempo_minimo: float = 1, max_offset: float = 0.15) -> Tuple[List[str], int]:
+        """
+        Busca los clips de un video en flujo con el índice del servicio (ver Flujo.buscar_clips_flujo), o los toma de
+        memoria si ya se buscaron con el mismo video, versión del corpus y parámetros.
+
+        :param archivo: archivo del video.
+        :param carpeta_resultados: carpeta donde guardar los clips encontrados.
+        :param k: el número de frames cercanos a buscar.
+        :param max_errores_continuos: máximos errores continuos para determinar que un clip terminó.
+        :param tiempo_minimo: tiempo mínimo para afirmar que un clip es válido.
+        :param max_offset: máxima distancia entre clips al combinarlos.
+
+        :return: los clips encontrados, como líneas de texto (ver Candidato.texto), y la versión del corpus con la
+        que se buscaron.
+        """
+        carpeta_resultados = carpeta_resultados or self.carpeta_resultados
+        nombre = os.path.splitext(os.path.basename(archivo))[0]
+
+        estado = os.stat(archivo)
+        version = self._version()
+        with self.lock:
+            clave = (os.path.abspath(archivo), estado.st_size, estado.st_mtime_ns, version, self.checks, k,
+                     max_errores_continuos, tiempo_minimo, max_offset)
+            clips = self.clips.get(clave)
+            if clips is not None:
+                self.clips.move_to_end(clave)
+
+        if clips is not None:
+            os.makedirs(carpeta_resultados, exist_ok=True)
+            with open(f'{carpeta_resultados}/{nombre}.txt', 'w') as resultados:
+                resultados.writelines(f'{clip}\n' for clip in clips)
+            return clips, version
+
+        buscar_clips_flujo(archivo, self.indice, carpeta_resultados=carpeta_resultados, fps_extraccion=self.fps,
+                           tamano=self.tamano, k=k, checks=self.checks, max_errores_continuos=max_errores_continuos,
+                           tiempo_minimo=tiempo_minimo, max_offset=max_offset, tipo=self.tipo)
+
+        with open(f'{carpeta_resultados}/{nombre}.txt', 'r') as resultados:
+            clips = resultados.read().splitlines()
+
+        with self.lock:
+            if self.max_clips > 0:
+                self.clips[clave] = clips
+            while len(self.clips) > self.max_clips:
+                self.clips.popitem(last=False)
+
+        return clips, version
+
+    def iniciar(self, bloquear: bool = True):
+        """
+        Empieza a atender pedidos, en este thread si bloquear es True o en uno nuevo si no.
+        """
+        print(f'servicio escuchando en http://127.0.0.1:{self.puerto}')
+        if bloquear:
+            self.servidor.serve_forever()
+        else:
+            threading.Thread(target=self.servidor.serve_forever, daemon=True).start()
+
+    def detener(self):
+        self.servidor.shutdown()
+        self.servidor.server_close()
+        self.indice.cerrar()
+
+
+class Cliente(Index):
+    """
+    Cliente del servicio que se usa como un índice más: las búsquedas se envían al servicio, y la tabla de etiquetas
+    se lee (con memmap) desde la carpeta donde la tiene guardada el servicio, y se recarga cuando una respuesta
+    trae otra versión del corpus.
+    """
+
+    def __init__(self, puerto: int = PUERTO, host: str = '127.0.0.1'):
+        self.url = f'http://{host}:{puerto}'
+        self.cores = 0
+        self.cargado = True
+
+        t0 = time.time()
+        info = self._pedir('GET', '/info')
+        self.etiquetas = Etiquetas.cargar(info['etiquetas'])
+        self.version = info['version']
+        self.checks = info['checks']
+        self.tipo = info['tipo']
+        t1 = time.time()
+
+        self.build_time = t1 - t0
+
+    def _pedir(self, metodo: str, ruta: str, cuerpo: bytes = None, tipo: str = 'application/json'):
+        pedido = urllib.request.Request(f'{self.url}{ruta}', data=cuerpo, method=metodo,
+                                        headers={'Content-Type': tipo})
+        try:
+            with urllib.request.urlopen(pedido) as respuesta:
+                contenido = respuesta.read()
+                if respuesta.headers.get('Content-Type') == 'application/json':
+                    return json.loads(contenido)
+                return contenido
+
+        except urllib.error.HTTPError as e:
+            raise Exception(f'el servicio respondió {e.code}: {json.loads(e.read()).get("error")}')
+
+    def _revisar_version(self, version: int):
+        # si el corpus del servicio cambió, recargar la tabla de etiquetas (la del servicio es al menos tan nueva
+        # como la respuesta)
+        if version != self.version:
+            info = self._pedir('GET', '/info')
+            self.etiquetas = Etiquetas.cargar(info['etiquetas'])
+            self.version = info['version']
+
+    def search(self, busquedas, k=1, checks=10, distancias=False):
+        """
+        Busca los k vecinos más cercanos en el índice del servicio.
+        """
+        cuerpo = io.BytesIO()
+        numpy.save(cuerpo, numpy.atleast_2d(numpy.asarray(busquedas)))
+        respuesta = self._pedir('POST', f'/buscar?k={k}&checks={checks}', cuerpo.getvalue(),
+                                'application/octet-stream')
+
+        with numpy.load(io.BytesIO(respuesta), allow_pickle=False) as resultado:
+            self._revisar_version(int(resultado['version']))
+            if distancias:
+                return resultado['ids'], resultado['distancias']
+            return resultado['ids']
+
+    def buscar_clips(self, archivo: str, carpeta_resultados: str = None, k: int = 20, max_errores_continuos: int = 12,
+                     tiempo_minimo: float = 1, max_offset: float = 0.15) -> List[str]:
+        """
+        Busca los clips de un video en el servicio (ver Servicio.buscar_clips).
+
+        :return: los clips encontrados, como líneas de texto (ver Candidato.texto).
+        """
+        pedido = {'archivo': os.path.abspath(archivo), 'k': k, 'max_errores_continuos': max_errores_continuos,
+                  'tiempo_minimo': tiempo_minimo, 'max_offset': max_offset}
+        if carpeta_resultados is not None:
+            pedido['carpeta_resultados'] = os.path.abspath(carpeta_resultados)
+
+        respuesta = self._pedir('POST', '/clips', json.dumps(pedido).encode())
+        self._revisar_version(respuesta['version'])
+        return respuesta['clips']
+
+    def actualizar(self) -> dict:
+        """
+        Pide al servicio que actualice su índice incremental, y recarga la tabla de etiquetas.
+        """
+        estado = self._pedir('POST', '/actualizar', b'{}')
+        self._revisar_version(estado['version'])
+        return estado
+
+    def estadisticas(self) -> dict:
+        return self._pedir('GET', '/estadisticas')
+
+
+if __name__ == '__main__':
+    from Main import parametros, preparar_indice
+
+    # python Servicio.py [--puerto=8765] y las opciones de índice de Main
+    opciones = dict(argumento[2:].split('=', 1) for argumento in sys.argv[1:] if argumento.startswith('--') and
+                    '=' in argumento)
+    tipo_caracteristicas = opciones.get('hash', 'gris')
+
+    indice_corpus, checks_corpus = preparar_indice(dimension=int(opciones.get('pca', opciones.get('blanqueo', 0))),
+                                                   blanquear='blanqueo' in opciones, tipo=tipo_caracteristicas,
+                                                   umbral_tramos=float(opciones.get('tramos', 0)),
+                                                   recall_objetivo=float(opciones.get('recall', 0)),
+                                                   incremental='--incremental' in sys.argv)
+
+    tamano_corpus, fps_corpus, _ = parametros(tipo_caracteristicas)
+    servicio = Servicio(indice_corpus, checks_corpus, tipo=tipo_caracteristicas, tamano=tamano_corpus,
+                        fps=fps_corpus, puerto=int(opciones.get('puerto', PUERTO)))
+    try:
+        servicio.iniciar()
+    except KeyboardInterrupt:
+        servicio.detener()
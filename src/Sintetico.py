@@ -0,0 +1,450 @@
+import json
+import os
+import re
+import shutil
+import sys
+import time
+from typing import Dict, List, Tuple
+
+import cv2
+import numpy
+
+from Almacen import Almacen
+from Evaluacion import Prediccion, leer_predicciones
+from Extraccion import abrir_video, caracteristicas_videos
+from Main import buscar_clips_amv, parametros
+from Metricas import actuales
+
+
+def _generar_toma(rng: numpy.random.RandomState, frames: int, tamano: Tuple[int, int]) -> numpy.ndarray:
+    """
+    Genera una toma: un fondo suave que se desplaza de a poco y algunas figuras que se mueven en línea recta.
+
+    :param rng: generador de números aleatorios.
+    :param frames: número de frames de la toma.
+    :param tamano: ancho y alto de los frames.
+
+    :return: un arreglo (frames, alto, ancho, 3) de uint8.
+    """
+    ancho, alto = tamano
+
+    # fondo de baja frecuencia más grande que el frame, para desplazar la ventana visible
+    fondo = cv2.resize(rng.uniform(0, 255, size=(4, 6, 3)).astype(numpy.float32), (ancho * 3 // 2, alto * 3 // 2),
+                       interpolation=cv2.INTER_CUBIC)
+    fondo = numpy.clip(fondo, 0, 255).astype(numpy.uint8)
+    desde = rng.uniform(0, 1, size=2) * (ancho // 2, alto // 2)
+    hasta = rng.uniform(0, 1, size=2) * (ancho // 2, alto // 2)
+
+    figuras = []
+    for _ in range(rng.randint(2, 6)):
+        figuras.append((rng.randint(0, 2), tuple(int(c) for c in rng.randint(0, 256, size=3)),
+                        rng.randint(alto // 12, alto // 3), rng.uniform(0, 1, size=2) * tamano,
+                        rng.uniform(-3, 3, size=2) * tamano / 100))
+
+    toma = numpy.empty((frames, alto, ancho, 3), dtype=numpy.uint8)
+    for i in range(frames):
+        x, y = (desde + (hasta - desde) * i / max(frames - 1, 1)).astype(int)
+        frame = fondo[y:y + alto, x:x + ancho].copy()
+
+        for circulo, color, radio, posicion, velocidad in figuras:
+            cx, cy = (posicion + velocidad * i).astype(int)
+            if circulo:
+                cv2.circle(frame, (cx, cy), radio, color, thickness=-1)
+            else:
+                cv2.rectangle(frame, (cx - radio, cy - radio // 2), (cx + radio, cy + radio // 2), color,
+                              thickness=-1)
+
+        toma[i] = frame
+
+    return toma
+
+
+def generar_video(archivo: str, duracion: float, fps: float = 24, tamano: Tuple[int, int] = (320, 180),
+                  semilla: int = 0) -> int:
+    """
+    Genera un video de tomas aleatorias de entre 1 y 4 segundos (ver _generar_toma).
+
+    :param archivo: archivo .mp4 a crear.
+    :param duracion: duración del video en segundos.
+    :param fps: frames por segundo del video.
+    :param tamano: ancho y alto del video.
+    :param semilla: semilla del generador.
+
+    :return: el número de frames del video.
+    """
+    rng = numpy.random.RandomState(semilla)
+    total = int(duracion * fps)
+
+    escritor = cv2.VideoWriter(archivo, cv2.VideoWriter_fourcc(*'mp4v'), fps, tamano)
+    if not escritor.isOpened():
+        raise Exception(f'no se pudo crear el video {archivo}')
+
+    escritos = 0
+    while escritos < total:
+        frames = min(int(rng.uniform(1, 4) * fps), total - escritos)
+        for frame in _generar_toma(rng, frames, tamano):
+            escritor.write(frame)
+        escritos += frames
+
+    escritor.release()
+    return total
+
+
+def generar_referencias(carpeta_videos: str, cantidad: int = 4, duracion: float = 60, fps: float = 24,
+                        semilla: int = 0) -> List[str]:
+    """
+    Genera los videos de referencia (el corpus) en la carpeta Shippuden de carpeta_videos.
+
+    :return: los nombres de los videos generados.
+    """
+    carpeta = f'{carpeta_videos}/Shippuden'
+    os.makedirs(carpeta, exist_ok=True)
+
+    nombres = []
+    for i in range(cantidad):
+        nombres.append(f'capitulo_{i:02d}')
+        generar_video(f'{carpeta}/{nombres[-1]}.mp4', duracion, fps=fps, semilla=semilla * 1000 + i)
+        print(f'{i + 1}/{cantidad} referencia {nombres[-1]} generada')
+
+    return nombres
+
+
+def _transformar(frame: numpy.ndarray, escala: float, calidad: int) -> numpy.ndarray:
+    # cambia el tamaño y recomprime el frame con JPEG para simular otra codificación
+    if escala != 1:
+        frame = cv2.resize(frame, (int(frame.shape[1] * escala), int(frame.shape[0] * escala)),
+                           interpolation=cv2.INTER_AREA)
+    if calidad > 0:
+        _, codificado = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, calidad])
+        frame = cv2.imdecode(codificado, cv2.IMREAD_COLOR)
+
+    return frame
+
+
+def _leer_frames(archivo: str, indices: List[int]) -> Dict[int, numpy.ndarray]:
+    """
+    Lee los frames dados de un video decodificándolo en orden una sola vez, sin buscar por posición (que en
+    algunos formatos no es exacto).
+    """
+    pendientes = sorted(set(indices))
+    frames = {}
+
+    video = abrir_video(archivo)
+    i = 0
+    for indice in pendientes:
+        while i < indice and video.grab():
+            i += 1
+        retval, frame = video.read()
+        i += 1
+        if not retval:
+            break
+        frames[indice] = frame
+
+    video.release()
+    return frames
+
+
+def generar_compilacion(carpeta_videos: str, nombre: str, clips: int = 8, duracion_min: float = 1.5,
+                        duracion_max: float = 4, fps: float = 24, escala: float = 1, calidad: int = 0,
+                        relleno: float = 0, semilla: int = 0) -> dict:
+    """
+    Genera una compilación (un AMV sintético) cortando segmentos al azar de los videos de referencia, y guarda
+    la verdad (el capítulo, el inicio y la duración de cada segmento) en AMV_verdad/{nombre}.json.
+
+    :param carpeta_videos: carpeta con los videos de referencia en Shippuden, la compilación se guarda en AMV.
+    :param nombre: nombre de la compilación.
+    :param clips: número de segmentos.
+    :param duracion_min: duración mínima de cada segmento en segundos.
+    :param duracion_max: duración máxima de cada segmento en segundos.
+    :param fps: frames por segundo de la compilación, si son distintos a los de las referencias se remuestrea.
+    :param escala: factor de escala de los frames.
+    :param calidad: si es mayor a 0, recomprime cada frame con JPEG con esta calidad (1 a 100).
+    :param relleno: probabilidad de insertar antes de cada segmento entre 1 y 2 segundos de video que no está en
+    el corpus.
+    :param semilla: semilla del generador.
+
+    :return: la verdad de la compilación.
+    """
+    rng = numpy.random.RandomState(semilla)
+    carpeta_referencias = f'{carpeta_videos}/Shippuden'
+    referencias = sorted(re.split('[/.]', video)[-2] for video in os.listdir(carpeta_referencias)
+                         if video.endswith('.mp4'))
+    if not referencias:
+        raise Exception(f'no hay videos de referencia en {carpeta_referencias}')
+
+    # fps y frames de cada referencia
+    propiedades = {}
+    for referencia in referencias:
+        video = abrir_video(f'{carpeta_referencias}/{referencia}.mp4')
+        propiedades[referencia] = (video.get(cv2.CAP_PROP_FPS), int(video.get(cv2.CAP_PROP_FRAME_COUNT)))
+        video.release()
+
+    # elegir segmentos: (capítulo, frame inicial, frames de la compilación que cubre)
+    segmentos = []
+    for _ in range(clips):
+        referencia = referencias[rng.randint(len(referencias))]
+        fps_referencia, total = propiedades[referencia]
+        duracion = min(rng.uniform(duracion_min, duracion_max), (total - 1) / fps_referencia)
+        inicio = rng.randint(0, total - int(duracion * fps_referencia))
+        segmentos.append((referencia, inicio, int(duracion * fps)))
+
+    def frame_referencia(segmento, j: int) -> int:
+        referencia, inicio, _ = segmento
+        return inicio + int(j * propiedades[referencia][0] / fps)
+
+    # leer los frames necesarios de cada referencia en una sola pasada
+    frames = {}
+    for referencia in referencias:
+        indices = [frame_referencia(segmento, j) for segmento in segmentos if segmento[0] == referencia
+                   for j in range(segmento[2])]
+        if indices:
+            frames[referencia] = _leer_frames(f'{carpeta_referencias}/{referencia}.mp4', indices)
+
+    os.makedirs(f'{carpeta_videos}/AMV', exist_ok=True)
+    archivo = f'{carpeta_videos}/AMV/{nombre}.mp4'
+    escritor = None
+    escritos = 0
+    verdad = []
+
+    def escribir(frame: numpy.ndarray):
+        nonlocal escritor, escritos
+        frame = _transformar(frame, escala, calidad)
+        if escritor is None:
+            escritor = cv2.VideoWriter(archivo, cv2.VideoWriter_fourcc(*'mp4v'), fps,
+                                       (frame.shape[1], frame.shape[0]))
+        escritor.write(frame)
+        escritos += 1
+
+    for segmento in segmentos:
+        if rng.uniform() < relleno:
+            alto, ancho = next(iter(frames[segmento[0]].values())).shape[:2]
+            for frame in _generar_toma(rng, int(rng.uniform(1, 2) * fps), (ancho, alto)):
+                escribir(frame)
+
+        referencia, inicio, cantidad = segmento
+        inicio_video = escritos / fps
+        for j in range(cantidad):
+            escribir(frames[referencia][frame_referencia(segmento, j)])
+
+        verdad.append({'inicio_video': inicio_video, 'duracion': cantidad / fps, 'capitulo': referencia,
+                       'inicio_cap': inicio / propiedades[referencia][0]})
+
+    escritor.release()
+
+    resultado = {'video': nombre, 'fps': fps, 'escala': escala, 'calidad': calidad, 'relleno': relleno,
+                 'duracion': escritos / fps, 'clips': verdad}
+
+    os.makedirs(f'{carpeta_videos}/AMV_verdad', exist_ok=True)
+    with open(f'{carpeta_videos}/AMV_verdad/{nombre}.json', 'w') as salida:
+        json.dump(resultado, salida, indent=2)
+
+    print(f'compilación {nombre} generada: {len(verdad)} segmentos en {escritos / fps:.1f} segundos')
+    return resultado
+
+
+# variantes de las compilaciones generadas: (fps, escala, calidad JPEG, probabilidad de relleno)
+VARIANTES = [
+    (24, 1, 0, 0),
+    (30, 1, 40, 0.3),
+    (24, 0.5, 0, 0.3),
+    (25, 0.75, 60, 0.5),
+]
+
+
+def generar_conjunto(carpeta_videos: str, referencias: int = 4, compilaciones: int = 4, semilla: int = 0):
+    """
+    Genera los videos de referencia y las compilaciones, recorriendo las VARIANTES (recodificadas, con otro
+    tamaño y con segmentos de relleno).
+    """
+    generar_referencias(carpeta_videos, cantidad=referencias, semilla=semilla)
+
+    for i in range(compilaciones):
+        fps, escala, calidad, relleno = VARIANTES[i % len(VARIANTES)]
+        generar_compilacion(carpeta_videos, f'compilacion_{i:02d}', fps=fps, escala=escala, calidad=calidad,
+                            relleno=relleno, semilla=semilla * 1000 + i)
+
+
+def _union(intervalos: List[Tuple[float, float]]) -> float:
+    # largo total de la unión de los intervalos
+    total = 0
+    fin_anterior = -numpy.inf
+    for inicio, fin in sorted(intervalos):
+        inicio = max(inicio, fin_anterior)
+        if fin > inicio:
+            total += fin - inicio
+        fin_anterior = max(fin_anterior, fin)
+
+    return total
+
+
+def puntuar(predicciones: List[Prediccion], verdad: List[dict], tolerancia: float = 2) -> dict:
+    """
+    Compara los clips encontrados con la verdad. Un tramo de un clip encontrado es correcto si se sobrepone en el
+    video a un segmento del mismo capítulo y su desfase (inicio en el capítulo menos inicio en el video) difiere en
+    a lo más tolerancia segundos del desfase del segmento.
+
+    :param predicciones: los clips encontrados.
+    :param verdad: los segmentos de la compilación (ver generar_compilacion).
+    :param tolerancia: diferencia máxima de desfase en segundos (al combinar candidatos, la detección puede correr el
+    inicio de un clip en el capítulo hasta un par de segundos, lo que en la evaluación interactiva se da por correcto).
+
+    :return: la precisión y el recall por tiempo (segundos correctos sobre segundos encontrados y segundos cubiertos
+    sobre segundos de la verdad), su F1, y los clips correctos y segmentos detectados (con al menos la mitad de su
+    duración correcta o cubierta).
+    """
+    cubiertos = [[] for _ in verdad]
+    tiempo_correcto = 0
+    correctos = 0
+
+    for prediccion in predicciones:
+        inicio = prediccion.inicio_video
+        fin = inicio + prediccion.duracion
+        desfase = prediccion.inicio_cap - prediccion.inicio_video
+
+        correcto = 0
+        for i, segmento in enumerate(verdad):
+            if segmento['capitulo'] != prediccion.capitulo or \
+                    abs(segmento['inicio_cap'] - segmento['inicio_video'] - desfase) > tolerancia:
+                continue
+
+            sobre_inicio = max(inicio, segmento['inicio_video'])
+            sobre_fin = min(fin, segmento['inicio_video'] + segmento['duracion'])
+            if sobre_fin > sobre_inicio:
+                correcto += sobre_fin - sobre_inicio
+                cubiertos[i].append((sobre_inicio, sobre_fin))
+
+        prediccion.correcta = correcto >= prediccion.duracion / 2
+        correctos += prediccion.correcta
+        tiempo_correcto += correcto
+
+    tiempo_predicho = sum(prediccion.duracion for prediccion in predicciones)
+    tiempo_verdad = sum(segmento['duracion'] for segmento in verdad)
+    cobertura = [_union(intervalos) for intervalos in cubiertos]
+
+    precision = tiempo_correcto / tiempo_predicho if tiempo_predicho > 0 else 0
+    recall = sum(cobertura) / tiempo_verdad if tiempo_verdad > 0 else 0
+    return {
+        'precision': precision,
+        'recall': recall,
+        'f1': 2 * precision * recall / (precision + recall) if precision + recall > 0 else 0,
+        'clips': len(predicciones),
+        'clips_correctos': int(correctos),
+        'segmentos': len(verdad),
+        'segmentos_detectados': sum(c >= segmento['duracion'] / 2 for c, segmento in zip(cobertura, verdad)),
+        'segundos_encontrados': tiempo_predicho,
+        'segundos_correctos': tiempo_correcto,
+        'segundos_verdad': tiempo_verdad,
+        'segundos_cubiertos': sum(cobertura),
+    }
+
+
+def evaluar_conjunto(carpeta_videos: str, tolerancia: float = 2, **opciones) -> dict:
+    """
+    Busca los clips de cada compilación con Main.buscar_clips_amv (sin la evaluación interactiva), compara los
+    resultados con la verdad y mide el tiempo de cada etapa. Primero extrae las características de las referencias
+    si no se han extraído.
+
+    :param carpeta_videos: carpeta generada con generar_conjunto.
+    :param tolerancia: ver puntuar.
+    :param opciones: opciones de Main.buscar_clips_amv (flujo, dimension, tipo, umbral_tramos, etc.).
+
+    :return: el resultado de cada compilación y el total (sumando tiempos y clips de todas).
+    """
+    tamano, fps, sufijo = parametros(opciones.get('tipo', 'gris'))
+    if not Almacen.existe(f'{carpeta_videos}/Shippuden_{sufijo}'):
+        caracteristicas_videos(f'{carpeta_videos}/Shippuden', fps, tamano, procesos=0,
+                               tipo=opciones.get('tipo', 'gris'))
+
+    archivos = sorted(archivo for archivo in os.listdir(f'{carpeta_videos}/AMV_verdad') if archivo.endswith('.json'))
+    resultados = {}
+    for archivo in archivos:
+        with open(f'{carpeta_videos}/AMV_verdad/{archivo}', 'r') as entrada:
+            verdad = json.load(entrada)
+        video = verdad['video']
+
+        t0 = time.perf_counter()
+        buscar_clips_amv(video, carpeta_videos=carpeta_videos, evaluar=False, **opciones)
+        tiempo = time.perf_counter() - t0
+
+        resultado = puntuar(leer_predicciones(video, f'{carpeta_videos}/AMV_results'), verdad['clips'],
+                            tolerancia=tolerancia)
+        resultado['segundos'] = tiempo
+        resultado['segundos_video'] = verdad['duracion']
+        resultado['etapas'] = {etapa.nombre: etapa.segundos for etapa in actuales().etapas.values()}
+        resultados[video] = resultado
+
+    return {'videos': resultados, 'total': _totalizar(list(resultados.values()))}
+
+
+def _totalizar(resultados: List[dict]) -> dict:
+    # suma los tiempos y clips de todas las compilaciones y recalcula las métricas por tiempo
+    total = {}
+    for clave in ('clips', 'clips_correctos', 'segmentos', 'segmentos_detectados', 'segundos_encontrados',
+                  'segundos_correctos', 'segundos_verdad', 'segundos_cubiertos', 'segundos', 'segundos_video'):
+        total[clave] = sum(resultado[clave] for resultado in resultados)
+
+    total['etapas'] = {}
+    for resultado in resultados:
+        for nombre, segundos in resultado['etapas'].items():
+            total['etapas'][nombre] = total['etapas'].get(nombre, 0) + segundos
+
+    precision = total['segundos_correctos'] / total['segundos_encontrados'] if total['segundos_encontrados'] else 0
+    recall = total['segundos_cubiertos'] / total['segundos_verdad'] if total['segundos_verdad'] else 0
+    total['precision'] = precision
+    total['recall'] = recall
+    total['f1'] = 2 * precision * recall / (precision + recall) if precision + recall > 0 else 0
+    return total
+
+
+def resumir(evaluacion: dict):
+    """
+    Imprime la precisión, el recall y el tiempo de cada compilación y del total, y el tiempo de cada etapa.
+    """
+    print(f'\n{"video":20s} {"clips":>9s} {"segmentos":>9s} {"precision":>9s} {"recall":>7s} {"f1":>6s} '
+          f'{"tiempo":>7s}')
+    for nombre, resultado in [*evaluacion['videos'].items(), ('total', evaluacion['total'])]:
+        print(f'{nombre[:20]:20s} {resultado["clips_correctos"]:4d}/{resultado["clips"]:<4d} '
+              f'{resultado["segmentos_detectados"]:4d}/{resultado["segmentos"]:<4d} {resultado["precision"]:9.3f} '
+              f'{resultado["recall"]:7.3f} {resultado["f1"]:6.3f} {resultado["segundos"]:7.1f}')
+
+    print('\ntiempo por etapa:')
+    for nombre, segundos in evaluacion['total']['etapas'].items():
+        print(f'  {nombre:12s} {segundos:8.2f} segundos')
+
+
+def main(carpeta_videos: str, regenerar: bool = False, referencias: int = 4, compilaciones: int = 4,
+         semilla: int = 0, tolerancia: float = 2, reporte: str = None, **opciones):
+    """
+    Genera el conjunto sintético (si no existe o si se pide regenerarlo), evalúa la búsqueda de clips sobre él e
+    imprime los resultados.
+    """
+    if regenerar and os.path.isdir(carpeta_videos):
+        shutil.rmtree(carpeta_videos)
+
+    if not os.path.isdir(f'{carpeta_videos}/AMV_verdad'):
+        generar_conjunto(carpeta_videos, referencias=referencias, compilaciones=compilaciones, semilla=semilla)
+
+    evaluacion = evaluar_conjunto(carpeta_videos, tolerancia=tolerancia, **opciones)
+    resumir(evaluacion)
+
+    if reporte is not None:
+        with open(reporte, 'w') as salida:
+            json.dump(evaluacion, salida, indent=2)
+        print(f'evaluación guardada en {reporte}')
+
+
+if __name__ == '__main__':
+    # python Sintetico.py [carpeta] [--regenerar] [--referencias=N] [--compilaciones=N] [--semilla=S]
+    # [--tolerancia=T] [--reporte=archivo.json] [--flujo] y las opciones de búsqueda de Main (--pca, --blanqueo,
+    # --hash, --tramos, --cache=MB, con --cache=0 se miden todas las etapas)
+    argumentos = dict(argumento[2:].split('=', 1) for argumento in sys.argv[1:] if argumento.startswith('--') and
+                      '=' in argumento)
+    entradas = [argumento for argumento in sys.argv[1:] if not argumento.startswith('--')]
+
+    main(entradas[0] if entradas else '../videos_sinteticos', regenerar='--regenerar' in sys.argv,
+         referencias=int(argumentos.get('referencias', 4)), compilaciones=int(argumentos.get('compilaciones', 4)),
+         semilla=int(argumentos.get('semilla', 0)), tolerancia=float(argumentos.get('tolerancia', 2)),
+         reporte=argumentos.get('reporte'), flujo='--flujo' in sys.argv,
+         dimension=int(argumentos.get('pca', argumentos.get('blanqueo', 0))), blanquear='blanqueo' in argumentos,
+         tipo=argumentos.get('hash', 'gris'), umbral_tramos=float(argumentos.get('tramos', 0)),
+         tamano_cache=int(float(argumentos.get('cache', 2048)) * 1024 ** 2))